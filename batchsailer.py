@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from polartable import sailPolar
+
+'''
+Planar ice sailer dynamics for large batches of craft, NumPy only
+
+For strategy search and Monte Carlo runs, the full ODE model (a body,
+geoms and contact joints per craft) is too expensive. Here each craft is
+a planar rigid body on flat ice (position x, y, heading psi, body
+velocities u, v and yaw rate r), and the state of all craft is kept as
+a structure of arrays, one array per variable, so that every step is a
+fixed number of vector operations, independent of the number of craft.
+
+Per step:
+
+- the sail force is calculated as in sailforce.sailForces, in the
+  horizontal plane, with the yaw moment of its point of application
+- friction along the three runners (mu 0.001) uses the static load
+  on each runner, regularised around zero speed
+- the runners take no side slip (ODE uses mu2 = 1000): the velocity is
+  projected on the two constraints, no lateral velocity at the rear
+  axle and across the steered front runner
+- position and heading follow with the new velocities (semi-implicit
+  Euler, as ODE's world.step)
+
+Heel, pitch, lifting runners and collisions are not modelled. The
+parameters are those of IceSailer, see paramsFromCraft; the __main__
+section compares with the ODE model on testsails.py-style runs.
+'''
+
+# gravity, as in icesailer; this module does not need ODE
+g0 = 9.813
+
+# friction along the runners, as in coll_callback
+_mu = 0.001
+
+# speed below which the runner friction is scaled down [m/s]
+_vslip = 0.01
+
+# IceSailer parameters, cg at the origin, x forward, z down
+DEFAULTS = dict(
+    mass=250.0,                     # total mass
+    Izz=250.0/12*(5.3**2 + 5.0**2), # yaw inertia, as ode setBoxTotal
+    skates=((2.5, 0.0, 0.5),        # front, left and right skate centre
+            (-2.8, -2.3, 0.5),
+            (-2.8, 2.3, 0.5)),
+    xmast=2.0,                      # sail force reference, forward
+    arm=0.5,                        # force on sail aft of the mast
+    zmast=-2.0,                     # height of the sail force
+    S=6.0)                          # sail surface
+
+
+def paramsFromCraft(craft) -> dict:
+    '''
+    Parameters of an ODE IceSailer, for a BatchSailers with the same craft
+
+    Parameters
+    ----------
+    craft : IceSailer
+        Craft to copy the mass, skate positions and sail data from.
+
+    Returns
+    -------
+    dict
+        Parameters, see DEFAULTS.
+    '''
+    m = craft.body.getMass()
+    return dict(mass=m.mass, Izz=np.array(m.I)[2,2],
+                skates=tuple(s for s, name in craft.xscates),
+                xmast=craft.xmast, arm=craft.arm, zmast=craft.zmast,
+                S=craft.S)
+
+
+class BatchSailers:
+    '''
+    Planar dynamics of a batch of identical ice sailers
+    '''
+
+    def __init__(self, n: int, params: dict = None, dt: float = 1.0/120.0,
+                 polar=None) -> None:
+        '''
+        Create a batch of craft, at the origin and at rest
+
+        Parameters
+        ----------
+        n : int
+            Number of craft.
+        params : dict, optional
+            Craft parameters, see DEFAULTS and paramsFromCraft.
+        dt : float [s]
+            Time step. The default is IceSailer.dt_max.
+        polar : SailPolar, optional
+            Lift and drag tables. The default is the shared sailPolar().
+
+        Returns
+        -------
+        None.
+
+        '''
+        p = dict(DEFAULTS, **(params or {}))
+        self.n = n
+        self.dt = dt
+        self.mass = p['mass']
+        self.Izz = p['Izz']
+        self.S = p['S']
+        self.arm = p['arm']
+        self.xmast = p['xmast']
+        self.zmast = p['zmast']
+        polar = polar or sailPolar()
+        self.cl_table, self.cd_table = polar.cl_table, polar.cd_table
+
+        # runner geometry; front runner, and the rear axle
+        skates = np.array(p['skates'], dtype=float)
+        self.xf = skates[0,0]
+        self.xr = skates[1,0]
+        self.yr = skates[2,1]
+
+        # static runner loads, front and per rear runner
+        wheelbase = self.xf - self.xr
+        self.Nf = self.mass*g0*(-self.xr)/wheelbase
+        self.Nr = 0.5*(self.mass*g0 - self.Nf)
+
+        # state, one array per variable
+        self.x = np.zeros(n)        # position north
+        self.y = np.zeros(n)        # position east
+        self.psi = np.zeros(n)      # heading
+        self.u = np.zeros(n)        # forward speed, body axes
+        self.v = np.zeros(n)        # lateral speed, body axes
+        self.r = np.zeros(n)        # yaw rate
+        self._ds = np.zeros(n)      # current sail angle
+        self.ds = np.ones(n)        # mainsheet limit on the sail angle
+        self.dr = np.zeros(n)       # rudder steering
+
+        # outputs, as on IceSailer
+        self.V = np.zeros(n)        # speed [kts]
+        self.Vw = np.zeros(n)       # relative wind speed [kts]
+        self.gamma = np.zeros(n)    # relative wind angle
+        self.alpha = np.zeros(n)    # angle of attack
+
+        self.nsteps = 0
+        self.time = 0.0
+
+    def updateTiller(self, value, idx=slice(None)) -> None:
+        '''
+        Update tiller input, for all or selected craft
+        '''
+        self.dr[idx] = np.clip(value, -1.0, 1.0)
+
+    def updateMainsheet(self, value, idx=slice(None)) -> None:
+        '''
+        Update mainsheet input, for all or selected craft
+        '''
+        self.ds[idx] = np.clip(value, 0.05, 1.0)
+
+    def _coefficients(self, adeg):
+        '''
+        Lift and drag coefficients; the tables of a SailPolar have the
+        same grid, so the index is calculated once
+        '''
+        cl, cd = self.cl_table, self.cd_table
+        x = (adeg - cl.amin)*(1.0/cl.step)
+        i = np.clip(x.astype(int), 0, len(cl.slopes) - 1)
+        x -= i
+        return cl.values[i] + x*cl.slopes[i], cd.values[i] + x*cd.slopes[i]
+
+    def velocity(self):
+        '''
+        Velocity of all craft in world axes, (vx, vy)
+        '''
+        c, s = np.cos(self.psi), np.sin(self.psi)
+        return c*self.u - s*self.v, s*self.u + c*self.v
+
+    def _runnerFriction(self, cosd, sind):
+        '''
+        Friction along the runners, on the static loads; the left runner
+        is at -yr, the right one at yr
+
+        Returns
+        -------
+        tuple of arrays
+            Force forward and to the right, and yaw moment, body axes.
+        '''
+        muNf = _mu*self.Nf*np.clip(
+            (cosd*self.u + sind*(self.v + self.xf*self.r))/_vslip, -1, 1)
+        muNl = _mu*self.Nr*np.clip(
+            (self.u + self.yr*self.r)/_vslip, -1, 1)
+        muNr = _mu*self.Nr*np.clip(
+            (self.u - self.yr*self.r)/_vslip, -1, 1)
+        return (-(muNf*cosd + muNl + muNr), -muNf*sind,
+                -muNf*sind*self.xf - (muNl - muNr)*self.yr)
+
+    def step(self, wind) -> None:
+        '''
+        Advance all craft with one time step
+
+        Parameters
+        ----------
+        wind : Wind, or array of float
+            Wind model providing speeds(locations), or the wind speed in
+            world axes, (2,) or (3,) for all craft, or (n, 2) or (n, 3)
+            per craft.
+
+        Returns
+        -------
+        None.
+
+        '''
+        dt = self.dt
+        c, s = np.cos(self.psi), np.sin(self.psi)
+        vx, vy = c*self.u - s*self.v, s*self.u + c*self.v
+
+        if hasattr(wind, 'speeds'):
+            wind = wind.speeds(
+                np.stack((self.x, self.y, np.zeros(self.n)), axis=1))
+        wind = np.asarray(wind, dtype=float)
+
+        # relative wind, world and body axes
+        rx, ry = wind[...,0] - vx, wind[...,1] - vy
+        V = np.sqrt(rx*rx + ry*ry)
+        self.Vw = 3600.0/1852.0*V
+        self.V = 3600.0/1852.0*np.sqrt(vx*vx + vy*vy)
+        active = V >= 1.0E-8
+        V = np.where(active, V, 1.0)
+        gamma = np.arctan2(s*rx - c*ry, -c*rx - s*ry)
+
+        # angle of attack, lift and drag, sail angle; as in sailForces
+        alpha = gamma - self._ds
+        alpha = np.where(alpha > np.pi, alpha - np.pi, alpha)
+        alpha = np.where(-alpha < -np.pi, alpha + np.pi, alpha)
+        qS = np.where(active, 0.5 * 1.225 * V*V * self.S, 0.0)
+        cl, cd = self._coefficients(np.abs(alpha)/np.pi*180)
+        D = qS * (cd + 0.05)
+        L = qS * cl
+        ds = self._ds + np.minimum(np.abs(L)*0.00005, 0.01)*np.sign(alpha)
+        ds = np.clip(ds, -self.ds, self.ds)
+        L = np.where(alpha < 0, -L, L)
+        self._ds = np.where(active, ds, self._ds)
+        self.gamma = np.where(active, gamma, self.gamma)
+        self.alpha = np.where(active, alpha, self.alpha)
+
+        # sail force in body axes, and its yaw moment
+        Fx = (rx*D - ry*L)/V
+        Fy = (ry*D + rx*L)/V
+        Fu = c*Fx + s*Fy
+        Fv = c*Fy - s*Fx
+        Mz = (self.xmast - self.arm*np.cos(ds))*Fv + \
+            self.arm*np.sin(ds)*Fu
+
+        # friction along the runners, static loads
+        cosd, sind = np.cos(self.dr), np.sin(self.dr)
+        fu, fv, mz = self._runnerFriction(cosd, sind)
+        Fu += fu
+        Fv += fv
+        Mz += mz
+
+        # unconstrained velocity, rotating body axes
+        h = dt/self.mass
+        u = self.u + h*Fu + dt*self.r*self.v
+        v = self.v + h*Fv - dt*self.r*self.u
+        r = self.r + dt/self.Izz*Mz
+
+        # project on the runner constraints, no lateral velocity at the
+        # rear axle (J1) and across the front runner (J2)
+        im, iI = 1.0/self.mass, 1.0/self.Izz
+        j1v, j1r = 1.0, self.xr
+        j2u, j2v, j2r = -sind, cosd, self.xf*cosd
+        a11 = im*j1v*j1v + iI*j1r*j1r
+        a12 = im*j1v*j2v + iI*j1r*j2r
+        a22 = im*(j2u*j2u + j2v*j2v) + iI*j2r*j2r
+        b1 = -(j1v*v + j1r*r)
+        b2 = -(j2u*u + j2v*v + j2r*r)
+        det = a11*a22 - a12*a12
+        l1 = (a22*b1 - a12*b2)/det
+        l2 = (a11*b2 - a12*b1)/det
+        self.u = u + im*l2*j2u
+        self.v = v + im*(l1*j1v + l2*j2v)
+        self.r = r + iI*(l1*j1r + l2*j2r)
+
+        # new position and heading; the heading rotation over one step
+        # is small, cos and sin are updated to first order
+        rdt = dt*self.r
+        c, s = c - s*rdt, s + c*rdt
+        self.x += dt*(c*self.u - s*self.v)
+        self.y += dt*(s*self.u + c*self.v)
+        self.psi += rdt
+
+        self.nsteps += 1
+        self.time = self.nsteps*self.dt
+
+    def run(self, duration: float, wind, callback=None,
+            every: int = 1) -> None:
+        '''
+        Run all craft for a given time
+
+        Parameters
+        ----------
+        duration : float [s]
+            Simulated time span, rounded to a whole number of steps.
+        wind : Wind, or array of float
+            Wind, see step.
+        callback : function(BatchSailers), optional
+            Called after every <every> steps, e.g. for logging.
+        every : int
+            Callback interval, in steps. The default is 1.
+
+        Returns
+        -------
+        None.
+
+        '''
+        for it in range(int(round(duration/self.dt))):
+            self.step(wind)
+            if callback is not None and it % every == every - 1:
+                callback(self)
+
+
+if __name__ == '__main__':
+
+    import time
+
+    # throughput, a large batch with random headings and sheets
+    n = 10000
+    rng = np.random.default_rng(1)
+    batch = BatchSailers(n)
+    batch.psi[:] = rng.uniform(0, 2*np.pi, n)
+    batch.updateMainsheet(rng.uniform(0.05, 1.0, n))
+    t0 = time.perf_counter()
+    batch.run(10.0, (-5.0, 0.0))
+    wall = time.perf_counter() - t0
+    print(f"{n} craft, {batch.time:.0f}s in {wall:.2f}s, "
+          f"{n*batch.time/wall:.0f} boat-seconds per second")
+
+    # comparison with the ODE model, as in testsails.py
+    from icesailer import Wind
+    from simulation import Simulation
+
+    sim = Simulation(Wind((-5, 0, 0)))
+    headings = np.radians(np.arange(0, 360, 10))
+    craft = [ sim.newCraft((250*np.cos(hdg), 250*np.sin(hdg), -0.8),
+                           (0.0, 0.0, hdg)) for hdg in headings ]
+    for c in craft:
+        c.updateMainsheet(0.1)
+    batch = BatchSailers(len(craft), paramsFromCraft(craft[0]), sim.dt)
+    batch.x[:] = 250*np.cos(headings)
+    batch.y[:] = 250*np.sin(headings)
+    batch.psi[:] = headings
+    batch.updateMainsheet(0.1)
+
+    dev = np.zeros(len(craft))
+    for it in range(int(round(60.0/sim.dt))):
+        sim.step()
+        batch.step(sim.wind.speed((0, 0, 0)))
+        if it % 12 == 11:
+            xy = np.array([ c.body.getPosition()[:2] for c in craft ])
+            dev = np.maximum(dev, np.hypot(xy[:,0] - batch.x,
+                                           xy[:,1] - batch.y))
+    V = np.array([ c.V for c in craft ])
+    for hdg, d, vo, vb in zip(np.degrees(headings), dev, V, batch.V):
+        print(f"heading {hdg:5.0f}: speed ODE {vo:5.1f} kts, "
+              f"batch {vb:5.1f} kts, max position difference {d:6.1f} m")
@@ -9,8 +9,12 @@ Created on Wed Jan 22 08:45:46 2020
 import asyncio
 import websockets as ws
 import base64
-#from threading import Lock
+import threading
+from collections import deque
 import numpy as np
+from wireformat import isBinary, encode, decodeHeader, decode, payload
+from statecodec import QUANTIZED, StateEncoder, decodeSnapshot
+from windfield import WindField
 objectlist = []
 
 """
@@ -40,7 +44,8 @@ Communication protocol:
   message "D<id>"
 
 - after an update, a client receives the update / death messages from all
-  other clients
+  other clients; the server sends the latest update of each other craft
+  at a fixed tick rate
   
 - environemnt messages by server:
     
@@ -79,6 +84,14 @@ Communication protocol:
   
     message for penalty
     "SP<id>:<markid>:<penalty>"
+
+- Alternatively, a client can use the binary format for the B, W, U, D and
+  E messages, see wireformat.py. The server replies in the format of the
+  client's birth message, and instead of the other craft's updates sends
+  binary clients a snapshot ("X") of all recently updated craft per tick.
+
+- With the quantized option, the client sends its updates as compact
+  keyframes and deltas, and gets compact snapshots, see statecodec.py.
   
 """
 
@@ -92,112 +105,177 @@ class Communicator:
     """
     _splitchar = ':'.encode('ascii')
 
-    async def _sendData(self, data):
-        pprint("sending")
-        await self.server.send(data)
-        pprint("sending done")
-            
-        
-    async def _getOtherData(self):
-        pprint("entering getOtherData")
+    async def _sendLoop(self):
+        '''
+        Send the newest own state each time it is updated
+
+        States that have been replaced before they could be sent are
+        skipped, a slow connection does not build up a queue.
+        '''
         while True:
-            try:
-                data = None
-                # data = await self.server.recv()
-                data = await asyncio.wait_for(
-                    self.server.recv(), timeout=0.001)
-               
-                # position update from one of the players
-                if data[0] == ord('U'):
-                    index = int(data[1:].split(self._splitchar)[0])
-                    pprint(f"got update on {index}")
-                    ndata = np.frombuffer(
-                        base64.decodebytes(
-                            data[1:].split(self._splitchar)[1]), 
-                        dtype=np.float32)
-                    pos = ndata[:3].astype(float)
-                    quat = ndata[3:7].astype(float)
-                    vel = ndata[7:10].astype(float)
-                    omg = ndata[10:13].astype(float)
-                    dr = ndata[13].astype(float)
-                    ds = ndata[14].astype(float)
-                    try:
-                        self.othercraft[index].follow(
-                            pos, quat, vel, omg, dr, ds)
-                    except IndexError:
-                        print(f"other ship {index} not yet known")
+            await self._newdata.wait()
+            self._newdata.clear()
+            data, self._outgoing = self._outgoing, None
+            if data is not None:
+                pprint("sending")
+                await self.server.send(data)
+                pprint("sending done")
+
+    async def _receiveLoop(self):
+        '''
+        Receive messages as they arrive, queue them for the render thread
+        '''
+        try:
+            while True:
+                self.inbox.append(await self.server.recv())
+        except ws.ConnectionClosed as e:
+            print(f"connection to server closed {e}")
+
+    def _handle(self, data):
+        '''
+        Process a message from the server, called from update
+        '''
+        try:
+            # binary coded update, death or wind
+            if isBinary(data):
+                self._binaryMessage(data)
+
+            # position update from one of the players
+            elif data[0] == ord('U'):
+                index = int(data[1:].split(self._splitchar)[0])
+                pprint(f"got update on {index}")
+                ndata = np.frombuffer(
+                    base64.decodebytes(
+                        data[1:].split(self._splitchar)[1]), 
+                    dtype=np.float32)
+                self._followOther(index, ndata)
                         
-                # deletion/death of the player with given index
-                elif data[0] == ord('D'):
-                    index = int(data[1:])
-                    print(f"got delete on {index}")
-                    del self.othercraft[index]
-
-                # creation/birth of a player, given index and name
-                elif data[0] == ord('B'):
-                    index = int(data[1:].split(self._splitchar)[0])
-                    name = data[1:].split(self._splitchar)[1].decode('ascii')
-                    print(f"new craft detected {index}:{name}")
-                    self.othercraft[index] = \
-                        self.craft.newOtherCraft(name, index)
-
-                # environment (wind speed) update
-                elif data[0] == ord('E'):
-                    ndata = np.frombuffer(
-                        base64.decodebytes(data[1:]), dtype=np.float32)
-                    #print(f"setting wind {ndata}")
-                    self.wind._speed[:2] = ndata.astype(float)
-
-                # visible model added
-                elif data[0] == ord('L'):
-                    name = data[1:].split(self._splitchar)[0].decode('ascii')
-                    posn = np.frombuffer(
-                        base64.decodebytes(data[1:].split(self._splitchar)[1]),
-                        dtype=np.float32).astype('float')
-                    print(f"creating object {name}")
-                    objectlist.append(self.craft.newStaticObject(name, posn))
-                    print(f"object {name}")
-
-                # dynamics world obstruction geometry
-                elif data[0] == ord('O'):
-                    name = data[1:].split(self._splitchar)[0].decode('ascii')
-                    gtype = data[1:].split(self._splitchar)[1].decode('ascii')
-                    coords = np.frombuffer(
-                        base64.decodebytes(data[1:].split(self._splitchar)[2]),
-                        dtype=np.float32).astype(float)
-                    self.craft.newObstacle(
-                        name, gtype, coords)
-
-                # mark location/type in the sail race
-                elif data[0] == ord('M'):
-                    cmd, name, info, xy = data.split(self._splitchar)
-                    name = name.decode('ascii')
-                    info = info.decode('ascii')
-                    coords = np.frombuffer(
-                        base64.decodebytes(xy), 
-                        dtype=np.float32).astype('float')
-                    mtype = cmd.decode('ascii')[1]
-                    print(f'adding mark {name}, type {mtype}, '
-                          f'info {info} at {coords}')
-                    self.marklist.append((mtype, name, info, coords))
-
-                # sailing advance, craft rounding a mark, penalty or finish
-                elif data[0] == ord('S'):
-                    midx, time = data[2:].split(self._splitchar)
-                    midx = int(midx)
-                    evtype = data[1:2].decode('ascii')
-                    time = float(time)
-                    self.craft.eventlist.append((evtype, midx, time))
-                    print(f'sail event for {self.idx}: {evtype} at {midx}')
-
-                else:
-                    raise ConnectionError("unknown data message")
-
-            except asyncio.TimeoutError:
-                return
-            except Exception as e:
-                print(f"exception in _getotherData {e}, data={data}")
-        pprint("exit otherdata")
+            # deletion/death of the player with given index
+            elif data[0] == ord('D'):
+                index = int(data[1:])
+                print(f"got delete on {index}")
+                self.othercraft.pop(index).close()
+
+            # creation/birth of a player, given index and name
+            elif data[0] == ord('B'):
+                index = int(data[1:].split(self._splitchar)[0])
+                name = data[1:].split(self._splitchar)[1].decode('ascii')
+                print(f"new craft detected {index}:{name}")
+                self.othercraft[index] = \
+                    self.craft.newOtherCraft(name, index)
+
+            # environment (wind speed) update
+            elif data[0] == ord('E'):
+                ndata = np.frombuffer(
+                    base64.decodebytes(data[1:]), dtype=np.float32)
+                #print(f"setting wind {ndata}")
+                self.wind._speed[:2] = ndata.astype(float)
+
+            # visible model added
+            elif data[0] == ord('L'):
+                name = data[1:].split(self._splitchar)[0].decode('ascii')
+                posn = np.frombuffer(
+                    base64.decodebytes(data[1:].split(self._splitchar)[1]),
+                    dtype=np.float32).astype('float')
+                print(f"creating object {name}")
+                objectlist.append(self.craft.newStaticObject(name, posn))
+                print(f"object {name}")
+
+            # dynamics world obstruction geometry
+            elif data[0] == ord('O'):
+                name = data[1:].split(self._splitchar)[0].decode('ascii')
+                gtype = data[1:].split(self._splitchar)[1].decode('ascii')
+                coords = np.frombuffer(
+                    base64.decodebytes(data[1:].split(self._splitchar)[2]),
+                    dtype=np.float32).astype(float)
+                self.craft.newObstacle(
+                    name, gtype, coords)
+
+            # mark location/type in the sail race
+            elif data[0] == ord('M'):
+                cmd, name, info, xy = data.split(self._splitchar)
+                name = name.decode('ascii')
+                info = info.decode('ascii')
+                coords = np.frombuffer(
+                    base64.decodebytes(xy), 
+                    dtype=np.float32).astype('float')
+                mtype = cmd.decode('ascii')[1]
+                print(f'adding mark {name}, type {mtype}, '
+                      f'info {info} at {coords}')
+                self.marklist.append((mtype, name, info, coords))
+
+            # sailing advance, craft rounding a mark, penalty or finish
+            elif data[0] == ord('S'):
+                midx, time = data[2:].split(self._splitchar)
+                midx = int(midx)
+                evtype = data[1:2].decode('ascii')
+                time = float(time)
+                self.craft.eventlist.append((evtype, midx, time))
+                print(f'sail event for {self.idx}: {evtype} at {midx}')
+
+            else:
+                raise ConnectionError("unknown data message")
+
+        except Exception as e:
+            print(f"exception in _handle {e}, data={data}")
+
+    def _followOther(self, index, ndata):
+        '''
+        Update another craft with position, velocity and control data
+        '''
+        pos = ndata[:3].astype(float)
+        quat = ndata[3:7].astype(float)
+        vel = ndata[7:10].astype(float)
+        omg = ndata[10:13].astype(float)
+        dr = float(ndata[13])
+        ds = float(ndata[14])
+        try:
+            self.othercraft[index].follow(
+                pos, quat, vel, omg, dr, ds)
+        except (KeyError, IndexError):
+            print(f"other ship {index} not yet known")
+
+    def _snapshot(self, ndata):
+        '''
+        Update all other craft from a snapshot, skipping the own craft
+        '''
+        for row in ndata.reshape((-1, 16)):
+            index = int(row[0])
+            if index != self.idx:
+                self._followOther(index, row[1:])
+
+    def _binaryMessage(self, data):
+        '''
+        Handle a message in binary format
+        '''
+        mtype = decodeHeader(data)[0]
+        if mtype == b'Z':
+            # compact snapshot, not float data
+            for index, row in zip(*decodeSnapshot(payload(data))):
+                if index != self.idx:
+                    self._followOther(int(index), row)
+            return
+        elif mtype == b'F':
+            # wind field grid, replaces the uniform wind
+            self.wind.field = WindField.fromMessage(payload(data))
+            return
+        elif mtype == b'G':
+            if self.wind.field is not None:
+                self.wind.field.applyDelta(payload(data))
+            return
+        mtype, index, seq, ndata = decode(data)
+        if mtype == b'U':
+            pprint(f"got update {seq} on {index}")
+            self._followOther(index, ndata)
+        elif mtype == b'X':
+            self._snapshot(ndata)
+        elif mtype == b'D':
+            print(f"got delete on {index}")
+            self.othercraft.pop(index).close()
+        elif mtype == b'E':
+            self.wind._speed[:2] = ndata.astype(float)
+        else:
+            raise ConnectionError(f"unknown binary message {mtype}")
             
     async def _initCommunication(self, server: str, data: bytes) -> None:
         
@@ -214,32 +292,48 @@ class Communicator:
         # read confirmation; gives my index
         print("waiting for server reply")
         conf = await self.server.recv()
-        if conf[:1] != 'W'.encode('ascii'):
-            raise ConnectionError("incorrect reply on init")
-
-        # decode confirmation message, zoom to initial position
-        self.idx = int(conf[1:].split(self._splitchar)[0])
-        print("server reply with index", self.idx)
-        
-        # assume the initial position   
-        ndata = np.frombuffer(
-            base64.decodebytes(conf.split(self._splitchar)[1]), 
-            dtype=np.float32)
+        if isBinary(conf):
+            mtype, self.idx, seq, ndata = decode(conf)
+            if mtype != b'W':
+                raise ConnectionError("incorrect reply on init")
+            print("server reply with index", self.idx)
+
+        else:
+            if conf[:1] != 'W'.encode('ascii'):
+                raise ConnectionError("incorrect reply on init")
+
+            # decode confirmation message, zoom to initial position
+            self.idx = int(conf[1:].split(self._splitchar)[0])
+            print("server reply with index", self.idx)
+
+            # assume the initial position
+            ndata = np.frombuffer(
+                base64.decodebytes(conf.split(self._splitchar)[1]), 
+                dtype=np.float32)
         print(ndata)
-        self.craft.body.setPosition(ndata[:3].astype(float))
-        self.craft.body.setQuaternion(ndata[3:].astype(float))
-        self.craft.resetCamera()
+
+        # from now on, send and receive in the background
+        self._newdata = asyncio.Event()
+        self.task_receive = asyncio.ensure_future(self._receiveLoop())
+        self.task_send = asyncio.ensure_future(self._sendLoop())
        
         print("_initCommunication done")
+        return ndata
         
     async def _closeCommunication(self) -> None:
-        data = 'D{self.idx}'.encode('ascii')
+        self.task_receive.cancel()
+        self.task_send.cancel()
+        if self.binary:
+            data = encode(b'D', self.idx, self.seq)
+        else:
+            data = 'D{self.idx}'.encode('ascii')
         await self.server.send(data)
         await self.server.close()
                     
     def __init__(self, myname, 
                  craft, craftdict, marklist, wind,
-                 server="ws://127.0.0.1:8300"):
+                 server="ws://127.0.0.1:8300", binary=False,
+                 quantized=False):
         """
         Create a new game connection
 
@@ -258,6 +352,14 @@ class Communicator:
         server : String, optional
             URL to the server websocket. The default
             is "ws://127.0.0.1:8300".
+        binary : bool, optional
+            Use the binary message format (see wireformat.py) for
+            updates. The default is False, ASCII/base64 messages.
+        quantized : bool, optional
+            Send compact, quantized updates and receive compact
+            snapshots (see statecodec.py); implies binary. The default
+            is False.
+
         Returns
         -------
         None.
@@ -270,44 +372,56 @@ class Communicator:
         self.wind = wind
         self.task_receive = None
         self.task_send = None
+        self.binary = binary or quantized
+        self.encoder = StateEncoder() if quantized else None
+        self.seq = 0
+
+        # received messages, and newest own state, exchanged with the
+        # network thread; deque append/popleft are thread safe
+        self.inbox = deque()
+        self._outgoing = None
         
         # step 1, in this time frame, send name receive 
         # confirmation
-        data = f"B{myname}".encode('ascii')
-        pprint("creating async communication task")
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._initCommunication(server, data))
+        if self.binary:
+            data = encode(b'B', 0, QUANTIZED if quantized else 0,
+                          myname.encode('ascii'))
+        else:
+            data = f"B{myname}".encode('ascii')
+        pprint("creating async communication thread")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='communicator', daemon=True)
+        self.thread.start()
+        ndata = asyncio.run_coroutine_threadsafe(
+            self._initCommunication(server, data), self.loop).result()
+
+        # assume the initial position
+        self.craft.body.setPosition(ndata[:3].astype(float))
+        self.craft.body.setQuaternion(ndata[3:].astype(float))
+        self.craft.resetCamera()
                 
     def __del__(self) -> None:
         try:
-            loop = asyncio.get_event_loop()
-            loop.run_until_complete(self._closeCommunication())
+            asyncio.run_coroutine_threadsafe(
+                self._closeCommunication(), self.loop).result(timeout=1.0)
         except Exception as e:
             print(f"problem closing off {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
         print("communicator ended")
         
-    async def _ioCycle(self, data):
-        tasks = [ asyncio.create_task(self._sendData(data)), 
-                  asyncio.create_task(self._getOtherData()) ]
-        try:
-            await asyncio.wait(tasks)
-        except Exception as e:
-            print(e)
-        #try:
-        #    for t in tasks:
-        #        t.cancel()
-        #except Exception as e:
-        #    print(f"problem cancelling {e}")
-        #print(res)
-        
     def update(self, data):
         """
-        Check for other player data and send own data
+        Process received player data and send own data
+
+        This never waits for the network; the data is handed to the
+        communication thread, and the messages that arrived since the
+        previous call are processed.
 
         Parameters
         ----------
-        data : TYPE
-            DESCRIPTION.
+        data : array of float32
+            Own position, quaternion, velocity, rotation, dr and ds.
 
         Returns
         -------
@@ -315,10 +429,27 @@ class Communicator:
 
         """
         #print("update")
-        dbytes = f'U{self.idx}:'.encode('ascii') + \
+        self.seq += 1
+        if self.encoder is not None:
+            # a keyframe still waiting must not be replaced by a delta
+            pending = self._outgoing
+            dbytes = self.encoder.encode(
+                self.idx, self.seq, data,
+                force=pending is not None and pending[1] == ord('K'))
+        elif self.binary:
+            dbytes = encode(b'U', self.idx, self.seq, data)
+        else:
+            dbytes = f'U{self.idx}:'.encode('ascii') + \
                 base64.b64encode(data)
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._ioCycle(dbytes))
+
+        # nothing to send when within the dead band
+        if dbytes is not None:
+            self._outgoing = dbytes
+            self.loop.call_soon_threadsafe(self._newdata.set)
+
+        # handle what arrived since the last frame
+        while self.inbox:
+            self._handle(self.inbox.popleft())
         
         
 if __name__ == '__main__':
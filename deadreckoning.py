@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from collections import deque
+
+'''
+Smoothing of the motion of remote craft
+
+The states of other craft arrive at the server tick rate, with jitter.
+Snapping the craft to each received state makes them stutter. A
+RemoteTrack keeps a short history of received states, with their local
+arrival time, and gives the pose to show at any time:
+
+- normally, a little in the past (the interpolation delay), between two
+  received states, with a cubic Hermite curve through the positions and
+  velocities, and interpolated attitude
+- when no newer state arrived in time, extrapolated from the last state
+  with its linear and angular velocity, for a limited time
+
+When a new state shows that the displayed pose was off, the error is
+not applied at once, but faded out over a short time; when the error
+is larger than a threshold, the craft is snapped to the new pose.
+
+The interpolation delay adapts to the measured interval between
+received states.
+'''
+
+
+def qmul(p, q):
+    '''
+    Quaternion product, (w, x, y, z) convention as in ODE
+    '''
+    pw, px, py, pz = p
+    qw, qx, qy, qz = q
+    return np.array((pw*qw - px*qx - py*qy - pz*qz,
+                     pw*qx + px*qw + py*qz - pz*qy,
+                     pw*qy - px*qz + py*qw + pz*qx,
+                     pw*qz + px*qy - py*qx + pz*qw))
+
+
+def qconj(q):
+    return np.array((q[0], -q[1], -q[2], -q[3]))
+
+
+def qrotate(q, w, dt):
+    '''
+    Rotate attitude q with world-frame angular velocity w over time dt
+    '''
+    angle = np.sqrt(np.dot(w, w))*dt
+    if angle < 1e-9:
+        return q
+    axis = w*(dt/angle)
+    dq = np.concatenate(((np.cos(0.5*angle),), np.sin(0.5*angle)*axis))
+    return qmul(dq, q)
+
+
+def qangle(q):
+    '''
+    Rotation angle of a quaternion [rad]
+    '''
+    return 2.0*np.arccos(min(1.0, abs(q[0])))
+
+
+def nlerp(p, q, f):
+    '''
+    Normalized linear interpolation of attitudes, shortest path
+    '''
+    if np.dot(p, q) < 0.0:
+        q = -q
+    r = (1.0 - f)*p + f*q
+    return r / np.sqrt(np.dot(r, r))
+
+
+class RemoteTrack:
+    '''
+    History of the states of one remote craft, with smoothed poses
+    '''
+
+    def __init__(self, history: int = 8, delay: float = None,
+                 maxextrap: float = 0.5, tcorrect: float = 0.2,
+                 snapdist: float = 3.0, snapangle: float = 0.5) -> None:
+        '''
+        Create an empty track
+
+        Parameters
+        ----------
+        history : int
+            Number of received states kept.
+        delay : float [s], optional
+            Interpolation delay. The default (None) adapts the delay to
+            1.5 times the average interval between received states.
+        maxextrap : float [s]
+            Maximum time to extrapolate past the last received state.
+        tcorrect : float [s]
+            Time constant for fading out prediction errors.
+        snapdist : float [m]
+            Position error above which the craft snaps to the new pose.
+        snapangle : float [rad]
+            Attitude error above which the craft snaps to the new pose.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.states = deque(maxlen=history)
+        self.fixeddelay = delay
+        self.delay = delay if delay is not None else 0.1
+        self.interval = None
+        self.maxextrap = maxextrap
+        self.tcorrect = tcorrect
+        self.snapdist = snapdist
+        self.snapangle = snapangle
+
+        # correction still to be faded out, and time of the last pose
+        self.dpos = np.zeros(3)
+        self.dquat = np.array((1.0, 0.0, 0.0, 0.0))
+        self.tpose = None
+        self.nsnaps = 0
+
+    def add(self, t: float, pos, quat, vel, omg) -> None:
+        '''
+        Add a received state
+
+        Parameters
+        ----------
+        t : float [s]
+            Local arrival time. The time stored with the state is
+            smoothed, to remove arrival jitter.
+        pos, quat, vel, omg : arrays of float
+            Position, attitude quaternion, linear and angular velocity
+            (world frame).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self.states:
+            t0 = self.states[-1][0]
+            if self.interval is None:
+                self.interval = max(t - t0, 1e-3)
+            if t - t0 < 0.25*self.interval:
+                # several states in one frame; keep the newest
+                self.states.pop()
+            else:
+                # average interval, and a time on a smoothed clock, the
+                # arrival jitter would distort the interpolation
+                self.interval = 0.9*self.interval + 0.1*(t - t0)
+                tpred = t0 + self.interval
+                if abs(t - tpred) < 2*self.interval:
+                    t = tpred + 0.2*(t - tpred)
+                if self.fixeddelay is None:
+                    self.delay = min(1.5*self.interval, self.maxextrap)
+
+        # pose shown now, before and after adding the new state
+        before = None if self.tpose is None else self.pose(self.tpose)
+        self.states.append((t, np.array(pos, dtype=float),
+                            np.array(quat, dtype=float),
+                            np.array(vel, dtype=float),
+                            np.array(omg, dtype=float)))
+        if before is None:
+            return
+        raw = self._raw(self.tpose - self.delay)
+        dpos = before[0] - raw[0]
+        dquat = qmul(before[1], qconj(raw[1]))
+        if np.sqrt(np.dot(dpos, dpos)) > self.snapdist or \
+           qangle(dquat) > self.snapangle:
+            self.dpos = np.zeros(3)
+            self.dquat = np.array((1.0, 0.0, 0.0, 0.0))
+            self.nsnaps += 1
+        else:
+            self.dpos = dpos
+            self.dquat = dquat
+
+    def _raw(self, t: float):
+        '''
+        Interpolated or extrapolated pose at t, without correction
+        '''
+        s1 = self.states[-1]
+        if t >= s1[0] or len(self.states) == 1:
+            # extrapolate from the last state
+            dt = min(max(t - s1[0], 0.0), self.maxextrap)
+            return s1[1] + s1[3]*dt, qrotate(s1[2], s1[4], dt), s1[3], s1[4]
+
+        # find the surrounding states
+        for i in range(len(self.states) - 2, -1, -1):
+            s0 = self.states[i]
+            if s0[0] <= t:
+                break
+        else:
+            return s0[1], s0[2], s0[3], s0[4]
+        s1 = self.states[i+1]
+
+        # Hermite curve through the positions, with the velocities
+        h = s1[0] - s0[0]
+        f = (t - s0[0])/h
+        f2, f3 = f*f, f*f*f
+        pos = (2*f3 - 3*f2 + 1)*s0[1] + (f3 - 2*f2 + f)*h*s0[3] + \
+            (-2*f3 + 3*f2)*s1[1] + (f3 - f2)*h*s1[3]
+        vel = (1.0 - f)*s0[3] + f*s1[3]
+        return pos, nlerp(s0[2], s1[2], f), vel, (1.0 - f)*s0[4] + f*s1[4]
+
+    def pose(self, t: float):
+        '''
+        Pose to show at time t
+
+        Parameters
+        ----------
+        t : float [s]
+            Local time, same clock as the arrival times.
+
+        Returns
+        -------
+        tuple of arrays, or None
+            Position, quaternion, linear and angular velocity; None if
+            no states were received yet.
+        '''
+        if not self.states:
+            return None
+
+        # fade out the remaining correction
+        if self.tpose is not None and t > self.tpose:
+            fade = np.exp(-(t - self.tpose)/self.tcorrect)
+            self.dpos = self.dpos*fade
+            self.dquat = nlerp(np.array((1.0, 0.0, 0.0, 0.0)),
+                               self.dquat, fade)
+        self.tpose = t
+
+        pos, quat, vel, omg = self._raw(t - self.delay)
+        return pos + self.dpos, qmul(self.dquat, quat), vel, omg
+
+
+if __name__ == '__main__':
+
+    # a craft on a circle, states received at 10 Hz with jitter, shown at
+    # 60 Hz; compare snapping to each state with the smoothed track
+    rng = np.random.default_rng(0)
+    R, V = 100.0, 15.0
+    w = V/R
+
+    def truth(t):
+        psi = w*t
+        pos = np.array((R*np.sin(psi), R*(1 - np.cos(psi)), -0.8))
+        vel = np.array((V*np.cos(psi), V*np.sin(psi), 0.0))
+        quat = np.array((np.cos(0.5*psi), 0.0, 0.0, np.sin(0.5*psi)))
+        return pos, quat, vel, np.array((0.0, 0.0, w))
+
+    tsend = np.arange(0.0, 30.0, 0.1)
+    tarrive = tsend + 0.03 + rng.exponential(0.02, tsend.shape)
+    tarrive = np.maximum.accumulate(tarrive)
+    track = RemoteTrack()
+    snapped = None
+    ia = 0
+    err = dict(snap=[], track=[])
+    step = dict(snap=[], track=[])
+    last = dict(snap=None, track=None)
+    for t in np.arange(1.0, 29.0, 1/60):
+        while ia < len(tarrive) and tarrive[ia] <= t:
+            state = truth(tsend[ia])
+            track.add(tarrive[ia], *state)
+            snapped = state[0]
+            ia += 1
+        shown = dict(snap=snapped, track=track.pose(t)[0])
+        # deviation from the true path, and step from the previous frame
+        for k, p in shown.items():
+            err[k].append(abs(np.hypot(p[0], p[1] - R) - R))
+            if last[k] is not None:
+                step[k].append(np.linalg.norm(p - last[k]))
+            last[k] = p
+
+    for k in ('snap', 'track'):
+        s = np.array(step[k])
+        print(f"{k:6s} path deviation max {np.max(err[k]):.3f} m, "
+              f"frame step mean {s.mean():.3f} m, std {s.std():.3f} m, "
+              f"max {s.max():.3f} m")
+    print(f"delay {track.delay:.3f} s, snaps {track.nsnaps}")
@@ -19,8 +19,7 @@ from math import pi, sin, cos, sqrt, atan, asin, acos, atan2
 from numpy import degrees, deg2rad, radians
 
 import numpy as np
-from scipy import interpolate
-import csv
+from polartable import sailPolar
 
 # LineSegs
 
@@ -720,25 +719,10 @@ class Hud(DirectFrame):
         self.display_goal.setScale(0.01)
         self.display_goal.setPos(Vec3(0.0,0.0))
 
-        # get the cl alpha curve for the sail
-        clcda = csv.reader(open('cl-alpha.csv'))
-        clcda.__next__()   # skip header
-        alpha=[]
-        cl=[]
-        for row in clcda:
-            alpha.append(row[0])
-            cl.append(row[1])
-        self.cl_alpha = interpolate.splrep(alpha, cl)
-        
-        # and the cd alpha curve
-        clcda = csv.reader(open('cd-alpha.csv'))
-        clcda.__next__()
-        alpha=[]
-        cd=[]
-        for row in clcda:
-            alpha.append(row[0])
-            cd.append(row[1])
-        self.cd_alpha = interpolate.splrep(alpha, cd)
+        # get the cl/cd alpha curves for the sail, shared with the craft
+        polar = sailPolar()
+        self.cl_alpha, self.cd_alpha = polar.cl_alpha, polar.cd_alpha
+        self.cl_table, self.cd_table = polar.cl_table, polar.cd_table
         self.doprint = -30
 
         # list of race marks
@@ -906,8 +890,8 @@ class Hud(DirectFrame):
         if alpha > np.pi: alpha -= np.pi
         if -alpha < -np.pi: alpha += np.pi
 
-        cl = interpolate.splev(abs(alpha)/np.pi*180, self.cl_alpha)
-        cd = interpolate.splev(abs(alpha)/np.pi*180, self.cd_alpha)
+        cl = self.cl_table(abs(alpha)/np.pi*180)
+        cd = self.cd_table(abs(alpha)/np.pi*180)
 
         qS = 0.5 * rho* (Vw*0.5144) *(Vw*0.5144) *S
         D = qS * (cd + 0.05)
@@ -1148,6 +1132,19 @@ class Hud(DirectFrame):
 
 
         # return the control inputs as a pair of values
+        return self.controls()
+
+    def controls(self):
+        '''
+        Current control inputs, without updating the displays
+
+        Returns
+        -------
+        float [deg]
+            Tiller commanded angle.
+        float [deg]
+            Mainsheet commanded angle.
+        '''
         return self.tiller_gui['value'], self.mainsheet_gui['value']
     
     
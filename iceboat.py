@@ -13,7 +13,6 @@ from direct.task import Task
 from panda3d.core import Vec3, WindowProperties, CardMaker, Texture
 from communicator import Communicator
 from configparser import ConfigParser
-from odegrid import terrainGeom
 
 # head-up display and controls
 from hud import Hud
@@ -21,13 +20,19 @@ from hud import Hud
 # generic utilities
 import copy
 
-# dynamic simulation with ode
-import ode
+# dynamic simulation with ode, craft dynamics without visualisation
+from icesailer import Wind, IceSailer
+from simulation import Simulation, PhysicsThread, CraftPose
+from scheduler import Scheduler
+from odegrid import courseExtent
 
-# numpy and scipy for cl/cd table
+# numpy for calculations, cl/cd tables
 import numpy as np
-from scipy import interpolate
-import csv
+from polartable import sailPolar
+
+# smoothing of the motion of other craft
+from deadreckoning import RemoteTrack
+import time
 
 # imaging for 'licence plates'
 from PIL import Image, ImageDraw, ImageFont
@@ -38,402 +43,6 @@ from io import BytesIO
 
 from math import pi, sin, cos, sqrt
 
-# weight of the world....
-g0 = 9.813
-
-def phithetapsiToQuaternion(phi, tht, psi):
-    '''
-    Create an ODE-compatible quaternion from Euler-Rodriquez angles
-
-    Parameters
-    ----------
-    phi : float [rad]
-        Roll angle.
-    tht : float [rad]
-        Pitch angle.
-    psi : float [rad]
-        Yaw angle.
-
-    Returns
-    -------
-    4-tuple of float
-        Quaternion describing attitude.
-        
-    '''
-    return (np.cos(0.5*phi)*np.cos(0.5*tht)*np.cos(0.5*psi) +
-            np.sin(0.5*phi)*np.sin(0.5*tht)*np.sin(0.5*psi),
-            np.sin(0.5*phi)*np.cos(0.5*tht)*np.cos(0.5*psi) -
-            np.cos(0.5*phi)*np.sin(0.5*tht)*np.sin(0.5*psi),
-            np.cos(0.5*phi)*np.sin(0.5*tht)*np.cos(0.5*psi) +
-            np.sin(0.5*phi)*np.cos(0.5*tht)*np.sin(0.5*psi),
-            np.cos(0.5*phi)*np.cos(0.5*tht)*np.sin(0.5*psi) -
-            np.sin(0.5*phi)*np.sin(0.5*tht)*np.cos(0.5*psi))
-
-
-class Wind:
-    """
-    Constant wind speed and direction model
-
-    Maybe to be updated with variable + location-dependent wind?
-    This uses a North - East - Down axis system
-    """
-    def __init__(self, spd = (-2, -4, 0)):
-        '''
-        Create a wind object
-
-        Parameters
-        ----------
-        spd : 3-tuple of float
-            Wind speed represented as a vector. This indicates the direction
-            of the wind, e.g. (5, 0, 0) means 5 m/s to the north, which is
-            a wind from the south. The default is (-2, -4, 0).
-
-        Returns
-        -------
-        None.
-
-        '''
-        self._speed = np.array(spd)
-        
-    def speed(self, loc):
-        '''
-        Return wind speed
-
-        @param loc   Location 
-        '''
-        return self._speed
-
-    
-class IceSailer:
-    """
-    Ice sailing dynamics with ODE
-    """
-
-    # global time step
-    dt_max = 1.0/120.0
-    
-    # maximum mainsheet angle
-    ds_max = 1.0
-    
-    def __init__(self, world, space, x=(0,0,0), psi=0) -> None:
-        """
-        Create a new ice sailer craft
-
-        @param world    ODE dynamics/collision world in which to create 
-                        the craft
-        @param space    3d space for the craft's geometric objects    
-        @param x        Initial position vector for the craft, x=north, 
-                        y=east, z=down, origin of the body is at cg center 
-        @param psi      Initial heading of the craft, degrees
-        """
-
-        # helper params, base properties
-        self.length = length = 5.3
-        self.xcg = xcg = 2.8
-        self.xmast = xmast = 2
-        mastheight = 6
-        self.mastbase = mastbase = 0.8
-        width = 5.0
-        self.skate_width = skate_width = 2.3
-        mass = 250
-        skate_radius = 0.3
-        
-        self.skate = []
-        self.trans = []
-        self.psi = np.radians(psi)  # initial heading
-        self.gamma = 0              # initial relative wind
-        self.Vw = 0                 # initial relative wind speed
-        self.dr = 0.0               # rudder steering
-        self.ds = IceSailer.ds_max  # mainsheet steering (max angle)
-        self._ds = 0                # current sail angle
-        self.S = 6                  # m2 of sail surface??
-        self.arm = 0.5              # force on sail attaches 0.5 m aft of mast  
-        self.xmast = xmast          # mast position forward of (000) datum
-        self.zmast = -mastbase - 0.2*mastheight # force sail z
-        self.V = 0                  # total speed
-        
-        # first step, create a composite body
-        self.body = ode.Body(world)
-        m = ode.Mass()
-
-        # approximate, to get inertia?
-        m.setBoxTotal(mass, length, width, mastbase)
-        print('mass',  m)
-        self.body.setMass(m)
-
-        # positions of the skates
-        self.xscates = \
-            ( ((length-xcg, 0, mastbase-skate_radius), "front"), 
-              ((     -xcg, -skate_width, mastbase-skate_radius), "left"), 
-              ((     -xcg,  skate_width, mastbase-skate_radius), "right") )
-
-        # each skate is a sphere in ODE, the contact dynamics will
-        # later create the skating direction
-        for (s, name) in self.xscates:
-            self.skate.append(ode.GeomSphere(None, skate_radius))
-            self.skate[-1].nam = name
-            self.trans.append(ode.GeomTransform(space))
-            self.trans[-1].nam = "t_" + name
-
-            # define callbacks on the geometry, these give the lateral/
-            # longitudinal direction of the skate
-            if s[1]:
-                self.trans[-1].align = self.heading
-            else:
-                self.trans[-1].align = self.steer
-            self.trans[-1].setGeom(self.skate[-1])
-            self.skate[-1].setPosition(s)
-            self.trans[-1].setBody(self.body)
-            
-        # the body has the three skates added to it now.
-
-        # forward beam is simplified
-        # initially aligned along the z axis
-        bar_radius = 0.2
-        self.hull = ode.GeomCapsule(None, bar_radius, length-2*bar_radius)
-        self.hull.nam = "hull"
-        self.trans.append(ode.GeomTransform(space))
-        self.trans[-1].setGeom(self.hull)
-        self.trans[-1].nam = 't_hull'
-
-        # rotate the beam 90 deg along y axis
-        q = ( np.cos(np.pi/4.0), 0, np.sin(np.pi/4), 0)
-        self.hull.setQuaternion(q)
-
-        # and shift it forward/backward to match cg
-        self.hull.setPosition((0.5*length-xcg, 0, -0.0*mastbase))
-
-        # attach it to the body
-        self.trans[-1].setBody(self.body)
-
-        # cross beam also simplified
-        self.hullc = ode.GeomCapsule(None, bar_radius, width-2*bar_radius)
-        self.hullc.name = "hullc"
-        self.trans.append(ode.GeomTransform(space))
-        self.trans[-1].setGeom(self.hull)
-        self.trans[-1].nam = 't_hullc'
-
-        # rotate 90 deg along x axis
-        q = ( np.cos(np.pi/4.0), np.sin(np.pi/4), 0, 0)
-        self.hullc.setQuaternion(q)
-
-        # and shift it backward to match cg
-        self.hull.setPosition((-xcg, 0, -0.0*mastbase))
-
-        # attach it to the body
-        self.trans[-1].setBody(self.body)
-        
-        # fix the mast
-        self.mast = ode.GeomCylinder(None, bar_radius, mastheight-2*bar_radius)
-        self.mast.nam = "mast"
-        self.trans.append(ode.GeomTransform(space))
-        self.trans[-1].setGeom(self.mast)
-        self.trans[-1].nam = 't_mast'
-
-        # move it up by 0.5 height + the base height
-        self.mast.setPosition((self.xmast-xcg, 0, -0.5*mastheight))
-
-        # attach to the body
-        self.trans[-1].setBody(self.body)
-
-        # put the body at a specific position
-        self.body.setPosition(x)
-        try:
-            self.body.setQuaternion(
-                phithetapsiToQuaternion(psi[0],0.5*psi[1],psi[2]))
-        except TypeError:
-            self.body.setQuaternion([np.cos(0.5*self.psi), 0, 0, 
-                                     np.sin(0.5 * self.psi)]) 
-
-        # get the cl alpha curve for the sail
-        clcda = csv.reader(open('cl-alpha.csv'))
-        clcda.__next__()   # skip header
-        alpha=[]
-        cl=[]
-        for row in clcda:
-            alpha.append(row[0])
-            cl.append(row[1])
-        self.cl_alpha = interpolate.splrep(alpha, cl)
-        
-        # and the cd alpha curve
-        clcda = csv.reader(open('cd-alpha.csv'))
-        clcda.__next__()
-        alpha=[]
-        cd=[]
-        for row in clcda:
-            alpha.append(row[0])
-            cd.append(row[1])
-        self.cd_alpha = interpolate.splrep(alpha, cd)
-        self.doprint = -30
-
-    def heading(self):
-        """return the current orientation vector of the craft, 
-        for the purpose of calculating side forces on the rear skates"""
-        
-        R = self.body.getRotation()
-        
-        if self.doprint == 0:
-            print("skate orient", np.array((R[0], R[3], R[6])))
-            
-        return np.array((R[0], R[3], R[6]))
-    
-    def steer(self):
-        """
-        Orientation of the front scate
-
-        return the current orientation vector of the front skate
-        for the purpose of calculating side forces.
-        """
-        
-        R = self.body.getRotation()
-        nose = np.array((R[0], R[3], R[6]))
-        cosa = np.cos(self.dr)
-        sina = np.sin(self.dr)
-        rot = np.array( ((cosa, -sina, 0), 
-                         (sina, cosa, 0), 
-                         (0, 0, 0) ) )
-        if self.doprint == 0:
-            print("nose orient", rot @ nose)
-        return rot @ nose
-
-    def force(self, wind):
-        """
-        Calculate the wind force on the sail
-
-        @param wind:       wind parameters
-        """
-
-        # get the horizontal speed as a vector, in world coordinates
-        spd = np.array(self.body.getLinearVel())
-
-        # get wind speed calculate relative speed, world coordinates
-        rspd = wind.speed(self.body.getPosition()) - spd
-        rspd[2] = 0
-
-        # total speed vector size and "heading"
-        V = np.linalg.norm(rspd)
-        self.Vw = 3600.0/1852.0*V
-        self.V = 3600.0/1852.0*np.linalg.norm(spd)
-        if V < 1.0E-8: 
-            # don't continue, don't apply force, and return
-            return
-        
-        # convert the relative speed vector to body coordinates
-        rspd_b = self.body.vectorFromWorld(rspd)
-
-        if self.doprint == 0:
-            print("windspeed", wind.speed(self.body.getPosition()),
-                  "ownspeed", self.body.getLinearVel(),
-                  "\nrel", rspd, "relb", rspd_b)
-       
-        # relative wind angle
-        Psi_wr = np.arctan2(-rspd_b[1], -rspd_b[0])
-        self.gamma = Psi_wr
-
-        # angle of attack 
-        alpha = self.alpha = Psi_wr - self._ds
-        if alpha > np.pi: alpha -= np.pi
-        if -alpha < -np.pi: alpha += np.pi
-        
-        # lift and drag coefficients. Correct alpha for range
-        cl = interpolate.splev(abs(alpha)/np.pi*180, self.cl_alpha)
-        cd = interpolate.splev(abs(alpha)/np.pi*180, self.cd_alpha) 
-
-        # dynamic pressure, and from there drag and lift
-        qS = 0.5 * 1.225 * V*V * self.S
-        D = qS * (cd + 0.05)
-        L = qS * cl
-        
-        # let the sail follow the wind force/aoa
-        # incorrect!
-        self._ds += min(abs(L)*0.00005, 0.01)*np.sign(alpha)
-        if self._ds > self.ds:
-            self._ds = self.ds
-        elif self._ds < -self.ds:
-            self._ds = -self.ds
-        
-        if alpha < 0: L = -L
-
-        if self.doprint == 0:
-            print("gamma", round(np.degrees(Psi_wr)),
-                  "ds", round(np.degrees(self.ds)),
-                  "_ds", round(np.degrees(self._ds)),
-                  "alpha",  round(np.degrees(alpha)),
-                  "D", D, "L", L)
-
-        # Lift and drag are defined relative to the wind axes
-        # this transforms the (D, L) vector to world coordinates
-        wtrans = np.matrix( ( ( rspd[0]/V, -rspd[1]/V, 0), 
-                              ( rspd[1]/V,  rspd[0]/V, 0),
-                              (     0,          0,    1) ) )
-        Wforce = wtrans * np.matrix ( ((D,), (L,) ,(0,)) )
-        if self.doprint == 0:
-            print("Wind force", Wforce[0,0], Wforce[1,0])
-
-        # apply the force
-        self.body.addForceAtRelPos(
-            Wforce, 
-            (self.xmast - self.arm*np.cos(self._ds), 
-             -self.arm*np.sin(self._ds), self.zmast))
-        
-    def copyState(self):
-        return (self.body.getPosition(), self.body.getQuaternion(), 
-                self.body.getLinearVel(), self.body.getAngularVel(), 
-                self.dr, self._ds)
-    
-        
-    def updateTiller(self, value):
-        '''
-        Update tiller input
-        
-        @param value new input
-        '''
-        self.dr = max(min(1.0, value), -1.0)
-
-
-    def updateMainsheet(self, value):
-        '''
-        Update mainsheet input
-        
-        @param value new input
-        '''
-        self.ds = max(min(1.0, value), 0.05)
-        
-        
-    def newObstacle(self, name, otype, coords):
-        '''
-        Place a new fixed-obstacle geom in the world. 
-
-        Parameters
-        ----------
-        name : str
-            Descriptive label for the obstacle.
-        otype : str
-            Obstacle type, currently implemented 'sphere', 'capsule', 
-            'cylinder' and 'box'.
-        coords : numpy array
-            Coordinates, x, y, z, sx, sy, xz, phi, theta, psi.
-
-        Returns
-        -------
-        None.
-
-        '''
-        global fixed_obstacles
-        if otype == 'sphere':
-            ngeom = ode.GeomSphere(space, coords[3])
-        elif otype == 'box':
-            ngeom = ode.GeomBox(space, lengths=coords[3:6])
-        elif otype == 'capsule':
-            ngeom = ode.GeomCapsule(space, radius=coords[4], length=coords[3])
-        elif otype == 'cylinder':
-            ngeom = ode.GeomCylinder(space, radius=coords[4], length=coords[3])
-        ngeom.setPosition(coords[:3])
-        ngeom.setQuaternion(phithetapsiToQuaternion(*(np.radians(coords[6:]))))
-        ngeom.nam = name
-        print(f"new obstacle {name}, type {otype}, at {coords}")
-        fixed_obstacles.append(ngeom)
-        
 def loadCraft(self, name, render, loader):
     ''' 
     Helper function to load icecraft models
@@ -509,6 +118,9 @@ class OtherCraft(IceSailer):
         loadCraft(self, name, craft.render, craft.loader)
         self.body.setPosition((0.0, 100.0*index, 100))
         self.body.disable()
+
+        # received states, for interpolation and extrapolation
+        self.track = RemoteTrack()
         
     def force(self, wind):
         return
@@ -517,10 +129,8 @@ class OtherCraft(IceSailer):
         return
         
     def follow(self, xrem, qrem, vrem, wrem, dr, ds):
-        self.body.setPosition(xrem)
-        self.body.setQuaternion(qrem)
-        self.body.setLinearVel(vrem)
-        self.body.setAngularVel(wrem)
+        # the body is moved to the smoothed pose in updateCoordinates
+        self.track.add(time.monotonic(), xrem, qrem, vrem, wrem)
         self.dr = dr
         self._ds = ds
         if not self.body.isEnabled():
@@ -528,12 +138,34 @@ class OtherCraft(IceSailer):
             print(f"Start of {self.index}:{self.name} at {xrem}")
             self.body.enable()
         
-    def updateCoordinates(self):
+    def updateBody(self):
+        """
+        Move the ODE body to the smoothed pose from the received states
+        """
+        pose = self.track.pose(time.monotonic())
+        if pose is not None:
+            self.body.setPosition(pose[0].tolist())
+            self.body.setQuaternion(pose[1].tolist())
+            self.body.setLinearVel(pose[2].tolist())
+            self.body.setAngularVel(pose[3].tolist())
+
+    def updateCoordinates(self, snapshot=None):
         """
         Update Panda data to reflect ODE simulation
+
+        @param snapshot  Snapshot from the physics thread, if running;
+                         otherwise the body is moved here, also for
+                         collisions
         """
-        qW, qx, qy, qz = self.body.getQuaternion()
-        x, y, z = self.body.getPosition()
+        if snapshot is None:
+            self.updateBody()
+            qW, qx, qy, qz = self.body.getQuaternion()
+            x, y, z = self.body.getPosition()
+        else:
+            pose = snapshot.poses.get(self)
+            if pose is None:
+                return
+            (x, y, z), (qW, qx, qy, qz) = pose.pos, pose.quat
         self.frame.setPosQuat((x, -y, -z), (qW, qx, -qy, -qz))
         self.psi = np.arctan2(
             2.0*qx*qy + qW*qz,
@@ -557,22 +189,28 @@ class MyCraft(ShowBase,IceSailer):
     Inherits from the IceSailer ODE dynamics, and adds visual representation &
     interaction with Panda3d
     '''
+
+    # update rates of the network and head-up display
+    netrate = 20.0
+    hudrate = 15.0
     
-    def __init__(self, world, space, x, psi, name='Anon.'):
+    def __init__(self, sim, x, psi, name='Anon.'):
         ''' 
         Create the ownship
 
-        @param world   ODE world
-        @param space   ODE contact/collision space
+        @param sim     Simulation, with ODE world and contact/collision space
         @param x       initial craft cg position
         @param psi     initial heading (1 value), or initial (phi, theta, psi)
         @param name    Name/label of the craft
         '''
 
         ShowBase.__init__(self)
-        IceSailer.__init__(self, world, space, x, psi)
+        IceSailer.__init__(self, sim.world, sim.space, x, psi)
+        self.sim = sim
+        sim.addCraft(self)
 
         self.comm = None
+        self.physics = None
         # additional objects in the world
         self.objects = []
         
@@ -593,9 +231,15 @@ class MyCraft(ShowBase,IceSailer):
         self.scene = self.loader.loadModel("blender/terrain.egg")
         self.scene.reparentTo(self.render)
 
-        # Add the skateAlong procedure to the task manager.
+        # Add the skateAlong procedure to the task manager, it runs the
+        # work per frame at the rates of each part
         self.taskMgr.add(self.skateAlong, "skateAlong")
-        self.lasttime = 0
+        self.scheduler = Scheduler()
+        self.scheduler.add('physics', self.stepPhysics, priority=0)
+        self.scheduler.add('draw', self.drawCraft, priority=0)
+        self.scheduler.add('camera', self.updateCamera, priority=0)
+        self.scheduler.add('network', self.updateNetwork, self.netrate, 1)
+        self.scheduler.add('hud', self.updateHud, self.hudrate, 2)
 
         # use this helper function to load the 3D models
         loadCraft(self, name, self.render, self.loader)
@@ -620,7 +264,7 @@ class MyCraft(ShowBase,IceSailer):
         self.objects.append(new_object)
         
     def newOtherCraft(self, name, index):
-        return OtherCraft(name, index, world, space)
+        return OtherCraft(name, index, self.sim.world, self.sim.space)
         
     def updateCoordinates(self):
         """
@@ -628,34 +272,53 @@ class MyCraft(ShowBase,IceSailer):
         """
         global othercraft
 
-        qW, qx, qy, qz = self.body.getQuaternion()
-        x, y, z = self.body.getPosition()
+        if self.physics is None:
+            # drawn between the last two physics states
+            (x, y, z), (qW, qx, qy, qz) = self.sim.pose(self)
+            self.own = CraftPose(
+                self.body.getPosition(), self.body.getQuaternion(),
+                self.body.getLinearVel(), self.body.getAngularVel(),
+                self.dr, self._ds, self.V, self.Vw, self.gamma)
+            self.others = [ o.body.getPosition()[:2]
+                            for o in othercraft.values() ]
+        else:
+            # newest snapshot from the physics thread, no ODE access
+            snapshot = self.physics.snapshot
+            self.own = snapshot.poses[self]
+            (x, y, z), (qW, qx, qy, qz) = self.own.pos, self.own.quat
+            self.others = [ p.pos[:2] for c, p in snapshot.poses.items()
+                            if c is not self ]
         self.frame.setPosQuat((x, -y, -z), (qW, qx, -qy, -qz))
+        own = self.own
+        qW, qx, qy, qz = own.quat
         self.psi = np.arctan2(
             2.0*qx*qy + qW*qz,
             qW*qW + qx*qx - qy*qy - qz*qz) 
-        self.skate.setH(np.degrees(-self.dr))
-        self.mast.setH(np.degrees(-self._ds))
+        self.skate.setH(np.degrees(-own.dr))
+        self.mast.setH(np.degrees(-own.ds))
 
         if self.doprint == 0:
-            print("position", self.body.getPosition(), 
+            print("position", own.pos, 
                   "heading", np.degrees(self.psi))
             self.doprint = 60
         self.doprint -= 1
-            
-        # also call the hud with the information
-        tiller, mainsheet = self.hud.update(
-            x, y, np.degrees(self.psi), self.V,
-            np.degrees(self.gamma), self.Vw, np.degrees(self._ds), 
-            [o.body.getPosition()[:2] for o in othercraft.values()],
-            self.eventlist)
-        print("user input(tiller,mainsheet):.%2f,%.2f" %(tiller,mainsheet))
-        # and set returned control values
-        #tiller = tiller + 0.1
-        #mainsheet = mainsheet - 0.1
+
+        # control inputs, every frame
+        tiller, mainsheet = self.hud.controls()
         self.updateTiller(tiller)
         self.updateMainsheet(mainsheet)
-        #print("mod input(tiller,mainsheet):.%2f,%.2f" %(tiller,mainsheet))
+
+    def updateHud(self, dt):
+        """
+        Update the head-up display with the newest craft data
+        """
+        own = self.own
+        x, y, z = own.pos
+        tiller, mainsheet = self.hud.update(
+            x, y, np.degrees(self.psi), own.V,
+            np.degrees(own.gamma), own.Vw, np.degrees(own.ds), 
+            self.others, self.eventlist)
+        print("user input(tiller,mainsheet):.%2f,%.2f" %(tiller,mainsheet))
 
         # Show info
         if len(marklist) != 0:
@@ -674,55 +337,49 @@ class MyCraft(ShowBase,IceSailer):
             print ("relative position to mark1: %.2f , %.2f" %(marklist[1][3][0]-x, marklist[1][3][1]-y))
             print ("distance to mark1: %.2f" %(sqrt(pow(marklist[1][3][0]-x,2)+pow(marklist[1][3][1]-y,2))))
 
-
-
-
+    def updateNetwork(self, dt):
+        """
+        Send the own state, and handle the received messages
+        """
         if self.comm:
+            own = self.own
             data = np.zeros((15,), dtype=np.float32)
-            data[:3] = self.body.getPosition()
-            data[3:7] = self.body.getQuaternion()
-            data[7:10] = self.body.getLinearVel()
-            data[10:13] = self.body.getAngularVel()
-            data[13] = self.dr
-            data[14] = self._ds
-            self.comm.update(data)
-        
-    def skateAlong(self, task):
-        '''
-        Callback routine to update simulation
-        
-        @param task   Panda3d task information
-        '''
-
-        # all craft to be updated
-        global craft, othercraft, wind, space, \
-            contactgroup, coll_callback
-        
-        dt = task.time - self.lasttime
-        if np.abs(dt - 2*IceSailer.dt_max) > 0.5*IceSailer.dt_max:
-            #print("strange time jump", dt)
-            pass
-
-        self.lasttime = task.time
-        for i in range(2):
-            # owncraft wind force
-            craft.force(wind)
-
-            # calculate collisions
-            space.collide( (world, contactgroup), coll_callback)
+            data[:3] = own.pos
+            data[3:7] = own.quat
+            data[7:10] = own.vel
+            data[10:13] = own.omg
+            data[13] = own.dr
+            data[14] = own.ds
+            if self.physics is None:
+                self.comm.update(data)
+            else:
+                # received messages may add or remove craft and
+                # obstacles, the physics thread must wait
+                with self.physics.lock:
+                    self.comm.update(data)
 
-            # update the world
-            world.step(IceSailer.dt_max)
+    def stepPhysics(self, dt):
+        """
+        Owncraft wind force, collisions and world update, in fixed
+        steps keeping up with the frame time
+        """
+        self.sim.advance(dt)
 
-            # clear contacts for next round
-            contactgroup.empty()
+    def drawCraft(self, dt):
+        """
+        Move all objects around according to the ODE result
+        """
+        global craft, othercraft
 
-        # move all objects around according to the ODE result
+        snapshot = None if self.physics is None else self.physics.snapshot
         craft.updateCoordinates()
-        for k, c in othercraft.items():
-            c.updateCoordinates()
-        
-        # update camera position
+        for k, c in list(othercraft.items()):
+            c.updateCoordinates(snapshot)
+
+    def updateCamera(self, dt):
+        """
+        Follow the craft with the camera
+        """
         dist = self.frame.getPos() - self.campos
         tomove = dist.length() - self.followdist
         if tomove > 0:
@@ -733,11 +390,41 @@ class MyCraft(ShowBase,IceSailer):
         chi = np.arctan2(dist[1], dist[0])
         self.camera.setHpr(np.degrees(chi)-90, -10, 0)
 
+    def skateAlong(self, task):
+        '''
+        Callback routine to update simulation
+        
+        Physics, drawing and camera run every frame, the network and
+        HUD at their own rates; see scheduler.py.
+
+        @param task   Panda3d task information
+        '''
+        self.scheduler.run(task.time)
+
         # tell the simulation to continue
         return Task.cont
     
     def setCommunicator(self, comm):
         self.comm = comm
+
+    def startPhysicsThread(self):
+        '''
+        Step the simulation on a separate thread from now on
+
+        The thread moves the other craft to their received poses, and
+        steps the world; the Panda task only draws the newest snapshot.
+        '''
+        def moveOthers():
+            for c in othercraft.values():
+                c.updateBody()
+
+        self.physics = PhysicsThread(
+            self.sim, moveOthers, lambda: othercraft.values())
+        self.scheduler.remove('physics')
+        self.physics.start()
+
+    def reportSchedule(self, dt):
+        print(self.scheduler.report())
         
     def resetCamera(self):
         x, y, z = self.body.getPosition()
@@ -751,72 +438,23 @@ class MyCraft(ShowBase,IceSailer):
         self.camera.setPos(self.campos[0], self.campos[1], self.campos[2])
         self.camera.setHpr(np.degrees(self.psi)-90, 0, 0)
 
-# collision callback function
-def coll_callback(args, geom1, geom2):
-    '''
-    Collision callback function
-
-    This creates collision contacts, and sets their parameters
-    '''
-    contacts = ode.collide(geom1, geom2)
-    if not contacts:
-        return
-
-    if geom2.nam != "ground":
-        print("%i collisions %s %s" % 
-              (len(contacts), geom1.nam, geom2.nam))
-        
-    orient = None
-    try:
-        orient = geom1.align()
-    except AttributeError:
-        try:
-            orient = geom2.align()
-        except AttributeError:
-            pass
-        
-    world, contactgroup = args
-    for c in contacts:
-        if orient is not None:
-            # skating contact, small friction along the orientation, large
-            # across
-            # print("orientation %s" % orient)
-            c.setFDir1(orient)
-            c.setMu(0.001)
-            c.setMu2(1000)
-            c.setMode(c.getMode() | ode.ContactMu2 | ode.ContactFDir1| ode.ContactApprox1)
-            c.setSlip2(0)
-            c.setSlip1(0)
-        else:
-            # non-skating, uniform mu
-            c.setMu(10)
-
-        c.setBounce(0.02)
-        j = ode.ContactJoint(world, contactgroup, c)
-        j.attach(geom1.getBody(), geom2.getBody())
-
 if __name__ == '__main__':
 
     config = ConfigParser()
     config.read('iceboat.conf')
     serverurl = config.get('server', 'url', fallback=None)
+    protocol = config.get('server', 'protocol', fallback='ascii')
     name = config.get('player', 'name', fallback='anonymous')
+    threaded = config.getboolean('simulation', 'threaded', fallback=False)
+    report = config.getfloat('simulation', 'report', fallback=0.0)
     
-    # ode world
-    world = ode.World()
-    world.setERP(0.8)
-    world.setCFM(1E-5)
+    # fit the sail polar once, before any craft is created
+    sailPolar(sidecar=True)
+
+    # ode world, with flat ground plane and terrain as obstacle
     wind = Wind((-2, 5, 0))
-    world.setGravity((0, 0, g0))
-    
-    # flat ground plane
-    space = ode.Space()
-    ground = ode.GeomPlane(space, (0, 0, -1), 0)
-    ground.nam = "ground"
-    
-    # terrain as obstacle
-    terrain = terrainGeom('blender/terrain.egg', space)[0]
-    terrain.nam = "terrain"
+    sim = Simulation(wind, terrain='blender/terrain.egg',
+                     extent=courseExtent('server.conf'))
     
     # a dictionary for other craft in the world
     othercraft = dict()
@@ -849,19 +487,23 @@ if __name__ == '__main__':
             img.save('PS-plate.png')
 
     # dynamics of the own craft
-    craft = MyCraft(world, space, (0, 2, -0.8), (0.0, 0.0, -0.2), name)
-        
-    # a list for fixed obstacles
-    fixed_obstacles = list()
+    craft = MyCraft(sim, (0, 2, -0.8), (0.0, 0.0, -0.2), name)
     
     # create a link to the server, if desired
     if serverurl:
         comm = Communicator(name, craft, othercraft, marklist,
-                            wind, server=serverurl)
+                            wind, server=serverurl,
+                            binary=protocol == 'binary',
+                            quantized=protocol == 'quantized')
         craft.setCommunicator(comm)
+
+    # physics on its own thread, if desired
+    if threaded:
+        craft.startPhysicsThread()
+
+    # time use per part of the frame, if desired
+    if report:
+        craft.scheduler.add('report', craft.reportSchedule, 1.0/report, 3)
         
-    # contacts
-    contactgroup = ode.JointGroup()
-    
     # start Panda3d engine
     craft.run()
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Dec 12 15:16:21 2019
+
+@author: repa
+@licence: GPL-v3.0
+"""
+
+# dynamic simulation with ode
+import ode
+
+# numpy for calculations, cl/cd tables
+import numpy as np
+from math import cos, sin
+from collections import Counter, deque
+from polartable import sailPolar
+
+'''
+Ice sailer dynamics, without any visualisation
+
+This holds the ODE model of the craft, the wind and the collision
+callback. It does not depend on Panda3D, and can be used in headless
+simulations; iceboat.py adds the visual representation.
+'''
+
+# weight of the world....
+g0 = 9.813
+
+# collision categories; ODE only tests a pair of geoms when the category
+# of one is in the collide mask of the other. Fixed geoms have an empty
+# mask, they are tested from the craft side only. Hull and mast keep the
+# ground, a capsized craft rests on the ice.
+CAT_GROUND = 0x01
+CAT_TERRAIN = 0x02
+CAT_OBSTACLE = 0x04
+CAT_SKATE = 0x08
+CAT_HULL = 0x10
+CAT_MAST = 0x20
+
+COLLIDES = {
+    CAT_GROUND: 0,
+    CAT_TERRAIN: 0,
+    CAT_OBSTACLE: 0,
+    CAT_SKATE: CAT_GROUND | CAT_TERRAIN,
+    CAT_HULL: CAT_GROUND | CAT_TERRAIN | CAT_OBSTACLE | CAT_HULL | CAT_MAST,
+    CAT_MAST: CAT_GROUND | CAT_TERRAIN | CAT_OBSTACLE | CAT_HULL | CAT_MAST }
+
+
+# role of each geom in the collision callback: category, and for skates
+# the function giving the skating direction
+_roles = dict()
+
+
+def setCategory(geom, category, align=None):
+    '''
+    Set the category and collide bits of a geom, and its collision role
+
+    Parameters
+    ----------
+    geom : ode geom
+        Geom placed in a collision space.
+    category : int
+        One of the CAT_ values.
+    align : function, optional
+        For skates, returns the skating direction (world frame).
+
+    Returns
+    -------
+    None.
+
+    '''
+    geom.setCategoryBits(category)
+    geom.setCollideBits(COLLIDES[category])
+    _roles[geom] = (category, align)
+
+
+def forgetGeom(geom) -> None:
+    '''
+    Remove a geom from the collision role table
+    '''
+    _roles.pop(geom, None)
+
+
+def geomCategory(geom) -> int:
+    '''
+    Collision category of a geom, 0 when not set
+    '''
+    return _roles.get(geom, (0, None))[0]
+
+
+def phithetapsiToQuaternion(phi, tht, psi):
+    '''
+    Create an ODE-compatible quaternion from Euler-Rodriquez angles
+
+    Parameters
+    ----------
+    phi : float [rad]
+        Roll angle.
+    tht : float [rad]
+        Pitch angle.
+    psi : float [rad]
+        Yaw angle.
+
+    Returns
+    -------
+    4-tuple of float
+        Quaternion describing attitude.
+        
+    '''
+    return (np.cos(0.5*phi)*np.cos(0.5*tht)*np.cos(0.5*psi) +
+            np.sin(0.5*phi)*np.sin(0.5*tht)*np.sin(0.5*psi),
+            np.sin(0.5*phi)*np.cos(0.5*tht)*np.cos(0.5*psi) -
+            np.cos(0.5*phi)*np.sin(0.5*tht)*np.sin(0.5*psi),
+            np.cos(0.5*phi)*np.sin(0.5*tht)*np.cos(0.5*psi) +
+            np.sin(0.5*phi)*np.cos(0.5*tht)*np.sin(0.5*psi),
+            np.cos(0.5*phi)*np.cos(0.5*tht)*np.sin(0.5*psi) -
+            np.sin(0.5*phi)*np.sin(0.5*tht)*np.cos(0.5*psi))
+
+
+class Wind:
+    """
+    Wind speed and direction model
+
+    Uniform wind, or a location-dependent WindField when one is set.
+    This uses a North - East - Down axis system
+    """
+    def __init__(self, spd = (-2, -4, 0)):
+        '''
+        Create a wind object
+
+        Parameters
+        ----------
+        spd : 3-tuple of float
+            Wind speed represented as a vector. This indicates the direction
+            of the wind, e.g. (5, 0, 0) means 5 m/s to the north, which is
+            a wind from the south. The default is (-2, -4, 0).
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._speed = np.array(spd, dtype=float)
+
+        # optional spatially varying field (windfield.WindField), set
+        # when the server sends one
+        self.field = None
+        
+    def speed(self, loc):
+        '''
+        Return wind speed
+
+        @param loc   Location
+        '''
+        if self.field is not None:
+            return self.field.speed(loc)
+        return self._speed
+
+    def speeds(self, locs):
+        '''
+        Return wind speed for a number of locations
+
+        @param locs  Array of locations, (N, 3)
+        '''
+        if self.field is not None:
+            return self.field.speeds(locs)
+        return np.broadcast_to(self._speed, (len(locs), 3))
+
+    
+class IceSailer:
+    """
+    Ice sailing dynamics with ODE
+    """
+
+    # global time step
+    dt_max = 1.0/120.0
+    
+    # maximum mainsheet angle
+    ds_max = 1.0
+    
+    def __init__(self, world, space, x=(0,0,0), psi=0) -> None:
+        """
+        Create a new ice sailer craft
+
+        @param world    ODE dynamics/collision world in which to create 
+                        the craft
+        @param space    3d space; the craft's geometric objects are put in
+                        a sub-space of this space
+        @param x        Initial position vector for the craft, x=north, 
+                        y=east, z=down, origin of the body is at cg center 
+        @param psi      Initial heading of the craft, degrees
+        """
+
+        # helper params, base properties
+        self.length = length = 5.3
+        self.xcg = xcg = 2.8
+        self.xmast = xmast = 2
+        mastheight = 6
+        self.mastbase = mastbase = 0.8
+        width = 5.0
+        self.skate_width = skate_width = 2.3
+        mass = 250
+        skate_radius = 0.3
+        
+        self.skate = []
+        self.trans = []
+        self.space = space          # collision space, also for obstacles
+        self.craftspace = ode.SimpleSpace(space)    # own parts
+        self.obstacles = []         # fixed obstacles placed by this craft
+        self.psi = np.radians(psi)  # initial heading
+        self.gamma = 0              # initial relative wind
+        self.Vw = 0                 # initial relative wind speed
+        self.dr = 0.0               # rudder steering
+        self.ds = IceSailer.ds_max  # mainsheet steering (max angle)
+        self._ds = 0                # current sail angle
+        self.S = 6                  # m2 of sail surface??
+        self.arm = 0.5              # force on sail attaches 0.5 m aft of mast  
+        self.xmast = xmast          # mast position forward of (000) datum
+        self.zmast = -mastbase - 0.2*mastheight # force sail z
+        self.V = 0                  # total speed
+        
+        # first step, create a composite body
+        self.body = ode.Body(world)
+        m = ode.Mass()
+
+        # approximate, to get inertia?
+        m.setBoxTotal(mass, length, width, mastbase)
+        print('mass',  m)
+        self.body.setMass(m)
+
+        # positions of the skates
+        self.xscates = \
+            ( ((length-xcg, 0, mastbase-skate_radius), "front"), 
+              ((     -xcg, -skate_width, mastbase-skate_radius), "left"), 
+              ((     -xcg,  skate_width, mastbase-skate_radius), "right") )
+
+        # each skate is a sphere in ODE, the contact dynamics will
+        # later create the skating direction
+        for (s, name) in self.xscates:
+            self.skate.append(ode.GeomSphere(None, skate_radius))
+            self.skate[-1].nam = name
+            self.trans.append(ode.GeomTransform(self.craftspace))
+            self.trans[-1].nam = "t_" + name
+
+            # define callbacks on the geometry, these give the lateral/
+            # longitudinal direction of the skate
+            setCategory(self.trans[-1], CAT_SKATE,
+                        self.heading if s[1] else self.steer)
+            self.trans[-1].setGeom(self.skate[-1])
+            self.skate[-1].setPosition(s)
+            self.trans[-1].setBody(self.body)
+            
+        # the body has the three skates added to it now.
+
+        # forward beam is simplified
+        # initially aligned along the z axis
+        bar_radius = 0.2
+        self.hull = ode.GeomCapsule(None, bar_radius, length-2*bar_radius)
+        self.hull.nam = "hull"
+        self.trans.append(ode.GeomTransform(self.craftspace))
+        self.trans[-1].setGeom(self.hull)
+        self.trans[-1].nam = 't_hull'
+        setCategory(self.trans[-1], CAT_HULL)
+
+        # rotate the beam 90 deg along y axis
+        q = ( np.cos(np.pi/4.0), 0, np.sin(np.pi/4), 0)
+        self.hull.setQuaternion(q)
+
+        # and shift it forward/backward to match cg
+        self.hull.setPosition((0.5*length-xcg, 0, -0.0*mastbase))
+
+        # attach it to the body
+        self.trans[-1].setBody(self.body)
+
+        # cross beam also simplified
+        self.hullc = ode.GeomCapsule(None, bar_radius, width-2*bar_radius)
+        self.hullc.name = "hullc"
+        self.trans.append(ode.GeomTransform(self.craftspace))
+        self.trans[-1].setGeom(self.hull)
+        self.trans[-1].nam = 't_hullc'
+        setCategory(self.trans[-1], CAT_HULL)
+
+        # rotate 90 deg along x axis
+        q = ( np.cos(np.pi/4.0), np.sin(np.pi/4), 0, 0)
+        self.hullc.setQuaternion(q)
+
+        # and shift it backward to match cg
+        self.hull.setPosition((-xcg, 0, -0.0*mastbase))
+
+        # attach it to the body
+        self.trans[-1].setBody(self.body)
+        
+        # fix the mast
+        self.mast = ode.GeomCylinder(None, bar_radius, mastheight-2*bar_radius)
+        self.mast.nam = "mast"
+        self.trans.append(ode.GeomTransform(self.craftspace))
+        self.trans[-1].setGeom(self.mast)
+        self.trans[-1].nam = 't_mast'
+        setCategory(self.trans[-1], CAT_MAST)
+
+        # move it up by 0.5 height + the base height
+        self.mast.setPosition((self.xmast-xcg, 0, -0.5*mastheight))
+
+        # attach to the body
+        self.trans[-1].setBody(self.body)
+
+        # the sub-space as a whole, for the broad phase in the main space
+        self.craftspace.setCategoryBits(CAT_SKATE | CAT_HULL | CAT_MAST)
+        self.craftspace.setCollideBits(
+            COLLIDES[CAT_SKATE] | COLLIDES[CAT_HULL] | COLLIDES[CAT_MAST])
+
+        # put the body at a specific position
+        self.body.setPosition(x)
+        try:
+            self.body.setQuaternion(
+                phithetapsiToQuaternion(psi[0],0.5*psi[1],psi[2]))
+        except TypeError:
+            self.body.setQuaternion([np.cos(0.5*self.psi), 0, 0, 
+                                     np.sin(0.5 * self.psi)]) 
+
+        # cl/cd curves and lookup tables for the sail, shared by all craft
+        polar = sailPolar()
+        self.cl_alpha, self.cd_alpha = polar.cl_alpha, polar.cd_alpha
+        self.cl_table, self.cd_table = polar.cl_table, polar.cd_table
+        self.doprint = -30
+
+    def heading(self):
+        """return the current orientation vector of the craft, 
+        for the purpose of calculating side forces on the rear skates"""
+        
+        R = self.body.getRotation()
+        
+        if self.doprint == 0:
+            print("skate orient", (R[0], R[3], R[6]))
+            
+        return (R[0], R[3], R[6])
+    
+    def steer(self):
+        """
+        Orientation of the front scate
+
+        return the current orientation vector of the front skate
+        for the purpose of calculating side forces.
+        """
+        
+        R = self.body.getRotation()
+        cosa = cos(self.dr)
+        sina = sin(self.dr)
+
+        # nose direction rotated over the steering angle, horizontal
+        orient = (cosa*R[0] - sina*R[3], sina*R[0] + cosa*R[3], 0.0)
+        if self.doprint == 0:
+            print("nose orient", orient)
+        return orient
+
+    def force(self, wind):
+        """
+        Calculate the wind force on the sail
+
+        @param wind:       wind parameters
+        """
+
+        # get the horizontal speed as a vector, in world coordinates
+        spd = np.array(self.body.getLinearVel())
+
+        # get wind speed calculate relative speed, world coordinates
+        rspd = wind.speed(self.body.getPosition()) - spd
+        rspd[2] = 0
+
+        # total speed vector size and "heading"
+        V = np.linalg.norm(rspd)
+        self.Vw = 3600.0/1852.0*V
+        self.V = 3600.0/1852.0*np.linalg.norm(spd)
+        if V < 1.0E-8: 
+            # don't continue, don't apply force, and return
+            return
+        
+        # convert the relative speed vector to body coordinates
+        rspd_b = self.body.vectorFromWorld(rspd)
+
+        if self.doprint == 0:
+            print("windspeed", wind.speed(self.body.getPosition()),
+                  "ownspeed", self.body.getLinearVel(),
+                  "\nrel", rspd, "relb", rspd_b)
+       
+        # relative wind angle
+        Psi_wr = np.arctan2(-rspd_b[1], -rspd_b[0])
+        self.gamma = Psi_wr
+
+        # angle of attack 
+        alpha = self.alpha = Psi_wr - self._ds
+        if alpha > np.pi: alpha -= np.pi
+        if -alpha < -np.pi: alpha += np.pi
+        
+        # lift and drag coefficients. Correct alpha for range
+        cl = self.cl_table(abs(alpha)/np.pi*180)
+        cd = self.cd_table(abs(alpha)/np.pi*180)
+
+        # dynamic pressure, and from there drag and lift
+        qS = 0.5 * 1.225 * V*V * self.S
+        D = qS * (cd + 0.05)
+        L = qS * cl
+        
+        # let the sail follow the wind force/aoa
+        # incorrect!
+        self._ds += min(abs(L)*0.00005, 0.01)*np.sign(alpha)
+        if self._ds > self.ds:
+            self._ds = self.ds
+        elif self._ds < -self.ds:
+            self._ds = -self.ds
+        
+        if alpha < 0: L = -L
+
+        if self.doprint == 0:
+            print("gamma", round(np.degrees(Psi_wr)),
+                  "ds", round(np.degrees(self.ds)),
+                  "_ds", round(np.degrees(self._ds)),
+                  "alpha",  round(np.degrees(alpha)),
+                  "D", D, "L", L)
+
+        # Lift and drag are defined relative to the wind axes
+        # this transforms the (D, L) vector to world coordinates
+        wtrans = np.matrix( ( ( rspd[0]/V, -rspd[1]/V, 0), 
+                              ( rspd[1]/V,  rspd[0]/V, 0),
+                              (     0,          0,    1) ) )
+        Wforce = wtrans * np.matrix ( ((D,), (L,) ,(0,)) )
+        if self.doprint == 0:
+            print("Wind force", Wforce[0,0], Wforce[1,0])
+
+        # apply the force
+        self.body.addForceAtRelPos(
+            Wforce, 
+            (self.xmast - self.arm*np.cos(self._ds), 
+             -self.arm*np.sin(self._ds), self.zmast))
+        
+    def copyState(self):
+        return (self.body.getPosition(), self.body.getQuaternion(), 
+                self.body.getLinearVel(), self.body.getAngularVel(), 
+                self.dr, self._ds)
+
+    def close(self):
+        '''
+        Take the craft out of the collision space, and release its geoms
+
+        The collision role table refers to the geoms and, for the skates,
+        to the heading and steer methods; without this, a removed craft
+        is never released.
+        '''
+        for t in self.trans:
+            forgetGeom(t)
+        self.space.remove(self.craftspace)
+        self.body.disable()
+    
+        
+    def updateTiller(self, value):
+        '''
+        Update tiller input
+        
+        @param value new input
+        '''
+        self.dr = max(min(1.0, value), -1.0)
+
+
+    def updateMainsheet(self, value):
+        '''
+        Update mainsheet input
+        
+        @param value new input
+        '''
+        self.ds = max(min(1.0, value), 0.05)
+        
+        
+    def newObstacle(self, name, otype, coords):
+        '''
+        Place a new fixed-obstacle geom in the world. 
+
+        Parameters
+        ----------
+        name : str
+            Descriptive label for the obstacle.
+        otype : str
+            Obstacle type, currently implemented 'sphere', 'capsule', 
+            'cylinder' and 'box'.
+        coords : numpy array
+            Coordinates, x, y, z, sx, sy, xz, phi, theta, psi.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.obstacles.append(obstacleGeom(self.space, name, otype, coords))
+
+
+def obstacleGeom(space, name, otype, coords):
+    '''
+    Create a fixed-obstacle geom
+
+    Parameters
+    ----------
+    space : ode.Space
+        Collision space for the obstacle.
+    name : str
+        Descriptive label for the obstacle.
+    otype : str
+        Obstacle type, currently implemented 'sphere', 'capsule', 
+        'cylinder' and 'box'.
+    coords : numpy array
+        Coordinates, x, y, z, sx, sy, xz, phi, theta, psi.
+
+    Returns
+    -------
+    ode geom
+        The new obstacle.
+
+    '''
+    if otype == 'sphere':
+        ngeom = ode.GeomSphere(space, coords[3])
+    elif otype == 'box':
+        ngeom = ode.GeomBox(space, lengths=coords[3:6])
+    elif otype == 'capsule':
+        ngeom = ode.GeomCapsule(space, radius=coords[4], length=coords[3])
+    elif otype == 'cylinder':
+        ngeom = ode.GeomCylinder(space, radius=coords[4], length=coords[3])
+    ngeom.setPosition(coords[:3])
+    ngeom.setQuaternion(phithetapsiToQuaternion(*(np.radians(coords[6:]))))
+    ngeom.nam = name
+    setCategory(ngeom, CAT_OBSTACLE)
+    print(f"new obstacle {name}, type {otype}, at {coords}")
+    return ngeom
+
+class CollisionStats:
+    '''
+    Counters of the collision callback, instead of printing
+
+    tested counts the narrow-phase tests, contacts the contact points per
+    pair of categories, and events keeps the most recent collisions that
+    are not skating contacts, as (first name, second name, number of
+    contact points).
+    '''
+
+    def __init__(self, nevents: int = 100):
+        self.tested = 0
+        self.contacts = Counter()
+        self.events = deque(maxlen=nevents)
+
+    def reset(self):
+        self.tested = 0
+        self.contacts.clear()
+        self.events.clear()
+
+
+collisionstats = CollisionStats()
+
+
+def _contactTemplate(cat1: int, cat2: int):
+    '''
+    Contact parameters for a pair of categories
+
+    Returns
+    -------
+    tuple
+        Contact mode, mu, mu2, bounce, and which geom (1 or 2) is the
+        skate, 0 when not skating.
+    '''
+    if cat1 == CAT_SKATE or cat2 == CAT_SKATE:
+        # skating contact, small friction along the orientation, large
+        # across
+        return (ode.ContactBounce | ode.ContactMu2 | ode.ContactFDir1 |
+                ode.ContactApprox1,
+                0.001, 1000.0, 0.02, 1 if cat1 == CAT_SKATE else 2)
+
+    # non-skating, uniform mu
+    return (ode.ContactBounce, 10.0, 0.0, 0.02, 0)
+
+
+# contact parameters per pair of categories, filled when first needed
+_templates = dict()
+_norole = (0, None)
+
+
+# collision callback function
+def coll_callback(args, geom1, geom2):
+    '''
+    Collision callback function
+
+    This creates collision contacts, and sets their parameters. Pairs
+    with a craft sub-space are expanded to the geoms in that sub-space;
+    the parts of one craft are never tested against each other.
+
+    The contact parameters come from a template per pair of geom
+    categories (see setCategory); collisions are counted in
+    collisionstats.
+    '''
+    if geom1.isSpace() or geom2.isSpace():
+        ode.collide2(geom1, geom2, args, coll_callback)
+        return
+
+    contacts = ode.collide(geom1, geom2)
+    collisionstats.tested += 1
+    if not contacts:
+        return
+
+    cat1, align1 = _roles.get(geom1, _norole)
+    cat2, align2 = _roles.get(geom2, _norole)
+    template = _templates.get((cat1, cat2))
+    if template is None:
+        template = _templates[(cat1, cat2)] = _contactTemplate(cat1, cat2)
+    mode, mu, mu2, bounce, skate = template
+
+    collisionstats.contacts[(cat1, cat2)] += len(contacts)
+    world, contactgroup = args
+    body1, body2 = geom1.getBody(), geom2.getBody()
+    if skate:
+        orient = align1() if skate == 1 else align2()
+        for c in contacts:
+            c.setMode(mode)
+            c.setFDir1(orient)
+            c.setMu(mu)
+            c.setMu2(mu2)
+            c.setBounce(bounce)
+            ode.ContactJoint(world, contactgroup, c).attach(body1, body2)
+    else:
+        collisionstats.events.append(
+            (getattr(geom1, 'nam', ''), getattr(geom2, 'nam', ''),
+             len(contacts)))
+        for c in contacts:
+            c.setMode(mode)
+            c.setMu(mu)
+            c.setBounce(bounce)
+            ode.ContactJoint(world, contactgroup, c).attach(body1, body2)
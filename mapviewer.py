@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+'''
+Course map, out of the server process
+
+The server publishes the craft positions and decimated trails in a
+shared memory block (MapPublisher); a separate viewer process reads
+snapshots of that block (MapReader) and draws the map with matplotlib.
+The server itself never imports matplotlib, and never waits for the
+drawing.
+
+Shared memory layout, native byte order:
+
+- header, 4 x int64: update counter, maximum number of craft, trail
+  length, unused
+- per craft slot: id (int32, -1 for a free slot), name (32 bytes),
+  position (2 float32), number of trail points written (int32)
+- trails, per slot a ring buffer of (x, y) float32 points
+
+The counter is odd while the publisher writes; a reader retries when
+the counter was odd or changed while copying.
+
+The viewer can be started by the server, see server.py, or separately:
+
+    python mapviewer.py [server.conf]
+'''
+
+DEFAULTNAME = 'iceboat-map'
+_namelen = 32
+
+
+def _layout(maxcraft: int, traillen: int):
+    '''
+    Offsets and shapes of the arrays in the shared block
+    '''
+    fields = (('header', np.int64, (4,)),
+              ('ids', np.int32, (maxcraft,)),
+              ('names', f'S{_namelen}', (maxcraft,)),
+              ('pos', np.float32, (maxcraft, 2)),
+              ('ntrail', np.int32, (maxcraft,)),
+              ('trail', np.float32, (maxcraft, traillen, 2)))
+    layout = []
+    offset = 0
+    for name, dtype, shape in fields:
+        dtype = np.dtype(dtype)
+        layout.append((name, dtype, shape, offset))
+        offset += dtype.itemsize*int(np.prod(shape))
+        offset = (offset + 7) // 8 * 8
+    return layout, offset
+
+
+def _views(buf, maxcraft: int, traillen: int) -> dict:
+    layout, size = _layout(maxcraft, traillen)
+    return { name: np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+             for name, dtype, shape, offset in layout }
+
+
+class MapPublisher:
+    '''
+    Server side, write craft positions and trails to shared memory
+    '''
+
+    def __init__(self, name: str = DEFAULTNAME, maxcraft: int = 64,
+                 traillen: int = 512, decimate: float = 10.0) -> None:
+        '''
+        Create the shared memory block
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block.
+        maxcraft : int
+            Maximum number of craft shown.
+        traillen : int
+            Number of trail points kept per craft.
+        decimate : float [m]
+            Minimum distance between trail points.
+
+        Returns
+        -------
+        None.
+
+        '''
+        size = _layout(maxcraft, traillen)[1]
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=size)
+        except FileExistsError:
+            # left over from a server that did not stop cleanly
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=size)
+        self.name = name
+        self.v = _views(self.shm.buf, maxcraft, traillen)
+        self.v['header'][:] = (0, maxcraft, traillen, 0)
+        self.v['ids'][:] = -1
+        self.traillen = traillen
+        self.decimate2 = decimate**2
+        self.slots = dict()
+        self.lastpoint = dict()
+
+    def publish(self, craft) -> None:
+        '''
+        Write the current positions
+
+        Parameters
+        ----------
+        craft : iterable of (int, str, float, float)
+            Craft id, name, x and y position, for all active craft.
+
+        Returns
+        -------
+        None.
+
+        '''
+        v = self.v
+        v['header'][0] += 1
+        active = set()
+        for index, name, x, y in craft:
+            active.add(index)
+            slot = self.slots.get(index)
+            if slot is None:
+                free = np.flatnonzero(v['ids'] == -1)
+                if not len(free):
+                    continue
+                slot = self.slots[index] = int(free[0])
+                v['ids'][slot] = index
+                v['names'][slot] = name.encode('utf-8')[:_namelen]
+                v['ntrail'][slot] = 0
+                self.lastpoint[index] = None
+            v['pos'][slot] = x, y
+
+            # trail point when far enough from the previous one
+            last = self.lastpoint[index]
+            if last is None or \
+               (x - last[0])**2 + (y - last[1])**2 > self.decimate2:
+                v['trail'][slot, v['ntrail'][slot] % self.traillen] = x, y
+                v['ntrail'][slot] += 1
+                self.lastpoint[index] = (x, y)
+
+        # free the slots of craft that left
+        for index in [ i for i in self.slots if i not in active ]:
+            v['ids'][self.slots.pop(index)] = -1
+            del self.lastpoint[index]
+        v['header'][0] += 1
+
+    def close(self) -> None:
+        '''
+        Remove the shared memory block
+        '''
+        self.v = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class MapReader:
+    '''
+    Viewer side, read consistent snapshots from shared memory
+    '''
+
+    def __init__(self, name: str = DEFAULTNAME) -> None:
+        self.shm = shared_memory.SharedMemory(name)
+        if multiprocessing.parent_process() is None:
+            # separate viewer; the publisher owns the block, it should
+            # not be removed when the viewer exits
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+        header = np.ndarray((4,), dtype=np.int64, buffer=self.shm.buf)
+        self.v = _views(self.shm.buf, int(header[1]), int(header[2]))
+        self.traillen = int(header[2])
+
+    def snapshot(self, retries: int = 100):
+        '''
+        Copy the current state
+
+        Returns
+        -------
+        list of (int, str, array, array)
+            Craft id, name, position, and trail (n, 2) in time order.
+        '''
+        v = self.v
+        for _ in range(retries):
+            count = int(v['header'][0])
+            ids = v['ids'].copy()
+            names = v['names'].copy()
+            pos = v['pos'].copy()
+            ntrail = v['ntrail'].copy()
+            trail = v['trail'].copy()
+            if count % 2 == 0 and int(v['header'][0]) == count:
+                break
+        res = []
+        for slot in np.flatnonzero(ids >= 0):
+            n = ntrail[slot]
+            tr = trail[slot]
+            if n > self.traillen:
+                tr = np.roll(tr, -(n % self.traillen), axis=0)
+            else:
+                tr = tr[:n]
+            res.append((int(ids[slot]), names[slot].decode('utf-8'),
+                        pos[slot], tr))
+        return res
+
+    def close(self) -> None:
+        self.v = None
+        self.shm.close()
+
+
+def viewMap(name: str = DEFAULTNAME, marks=(), interval: float = 1.0):
+    '''
+    Show the course map, until the window is closed
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory block.
+    marks : list of RaceMark
+        Race marks, drawn once.
+    interval : float [s]
+        Update interval.
+
+    Returns
+    -------
+    None.
+
+    '''
+    import matplotlib.pyplot as plt
+
+    reader = MapReader(name)
+    fig = plt.figure(figsize=(5,7))
+    ax = fig.add_subplot(111)
+    for m in marks:
+        m.plotMe(ax)
+    ax.axis('equal')
+    fig.show()
+    lines = dict()
+    try:
+        while plt.fignum_exists(fig.number):
+            craft = reader.snapshot()
+            for index, cname, pos, trail in craft:
+                xy = np.vstack((trail, pos))
+                if (index, cname) not in lines:
+                    lines[(index, cname)], = ax.plot(
+                        xy[:,1], xy[:,0], label=cname)
+                else:
+                    lines[(index, cname)].set_data(xy[:,1], xy[:,0])
+            for key in [ k for k in lines if k not in
+                         { (c[0], c[1]) for c in craft } ]:
+                lines.pop(key).remove()
+            fig.canvas.draw()
+            plt.pause(interval)
+    finally:
+        reader.close()
+
+
+def readMarks(fname: str):
+    '''
+    Read the race marks from a server configuration file
+    '''
+    from configparser import ConfigParser
+    from sailmark import RaceMark
+
+    config = ConfigParser()
+    config.read(fname)
+    marks = []
+    for sname, sprox in config.items():
+        if sname.startswith('mark'):
+            score = sprox.get('score', fallback=0)
+            marks.append(RaceMark(
+                sprox.get('name', fallback=sname[len('mark'):]),
+                sprox.getfloat('x', fallback=0.0),
+                sprox.getfloat('y', fallback=0.0),
+                sprox.getfloat('radial', fallback=0),
+                sprox.getfloat('distance', fallback=100),
+                sprox.get('rounding', fallback='cw'),
+                score if score == 'finish' else int(score),
+                sprox.get('info', fallback='No information')))
+    return marks
+
+
+if __name__ == '__main__':
+
+    import sys
+    from configparser import ConfigParser
+
+    fname = sys.argv[1] if len(sys.argv) > 1 else 'server.conf'
+    config = ConfigParser()
+    config.read(fname)
+    viewMap(config.get('map', 'name', fallback=DEFAULTNAME),
+            readMarks(fname))
@@ -6,9 +6,14 @@ Created on Tue Jan 28 22:57:01 2020
 @author: repa
 """
 
-from panda3d.egg import EggData
+from panda3d.egg import EggData, loadEggData
+from panda3d.core import Filename, NodePath, InternalName, GeomEnums, \
+    Mat3, getDefaultCoordinateSystem
 import numpy as np
+import hashlib
+import os
 import ode
+from icesailer import setCategory, CAT_TERRAIN
 
 '''
 Data on egg format coordinates
@@ -18,14 +23,118 @@ ODE world is set up as x-north, y-east, z-down
 Egg data is x-north, y-west, z-up
 
 Conversion egg -> ODE: x_ode = x_egg, y_ode = -y_egg, z_ode = -z_egg
+
+The terrain vertices and faces, filtered and converted to ODE axes, are
+cached in a .npz file next to the egg file, with the hash of the egg
+file; when the egg file is unchanged, the egg file is not read at all.
+On a cache miss, the egg data is converted to Panda3D geometry and the
+arrays are copied in bulk from the vertex and index buffers; walking
+the egg data vertex by vertex remains as fallback.
+
+For collision, the terrain is split into square tiles, each its own
+trimesh, in a quadtree space over the course. Craft on open ice then
+only meet the tiles near them in the broad phase, and never reach the
+triangle tests of the rest of the shore.
 '''
 
-def terrainGeom(eggfile, space):
-    
-    # read the terrain, assumes specific model shape, with Grid labeled
+# faces with any vertex higher than this (egg y) are not used, assuming
+# we don't get up there with the skates
+_maxheight = 20
+
+# version of the cached data, part of the cache key
+_cacheversion = 2
+
+
+def _eggHash(eggfile):
+    '''
+    Hash of the egg file contents, the key for the cache
+    '''
+    h = hashlib.sha1(f'terrain-{_cacheversion}'.encode('ascii'))
+    with open(eggfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cacheName(eggfile):
+    return os.path.splitext(eggfile)[0] + '.terrain.npz'
+
+
+def _terrainGrid(eggfile):
+    '''
+    Read the egg file, and return the terrain group, labeled Grid
+    '''
     ed = EggData()
-    ed.read(eggfile)
-    grid = ed.findChild('Root').findChild('Grid').getFirstChild()
+    ed.read(Filename.fromOsSpecific(eggfile))
+    return ed, ed.findChild('Root').findChild('Grid')
+
+
+def _bulkExtract(eggfile):
+    '''
+    Vertices and faces from the Panda3D geometry of the terrain
+
+    The egg data of the Grid group is converted to geometry, and the
+    vertex positions and triangle indices are copied from the buffers,
+    without a loop over vertices or triangles. The conversion may
+    duplicate vertices, e.g. at texture seams; these are merged again.
+    The geometry is in Panda3D's default axes; the vertices are
+    converted back to the axes of the egg file (Y-up for the x2egg
+    models), which also restores the winding seen in those axes.
+    '''
+    ed, grid = _terrainGrid(eggfile)
+    sub = EggData()
+    sub.setCoordinateSystem(ed.getCoordinateSystem())
+    sub.addChild(grid)
+    root = NodePath(loadEggData(sub))
+    root.flattenLight()
+
+    ftype = { GeomEnums.NT_float32: '<f4', GeomEnums.NT_float64: '<f8' }
+    itype = { GeomEnums.NT_uint8: '<u1', GeomEnums.NT_uint16: '<u2',
+              GeomEnums.NT_uint32: '<u4' }
+    allverts = []
+    allfaces = []
+    nverts = 0
+    for gnode in root.findAllMatches('**/+GeomNode'):
+        for geom in gnode.node().getGeoms():
+            vdata = geom.getVertexData()
+            fmt = vdata.getFormat()
+            iarray = fmt.getArrayWith(InternalName.getVertex())
+            column = fmt.getColumn(InternalName.getVertex())
+            dtype = np.dtype(ftype[column.getNumericType()])
+            raw = np.frombuffer(vdata.getArray(iarray), dtype=np.uint8)
+            verts = np.ndarray(
+                (vdata.getNumRows(), 3), dtype=dtype, buffer=raw,
+                offset=column.getStart(),
+                strides=(fmt.getArray(iarray).getStride(), dtype.itemsize))
+            allverts.append(verts.astype(float))
+
+            for prim in geom.getPrimitives():
+                tris = prim.decompose()
+                if tris.isIndexed():
+                    idx = np.frombuffer(tris.getVertices(),
+                                        dtype=itype[tris.getIndexType()])
+                else:
+                    idx = np.arange(tris.getFirstVertex(),
+                                    tris.getFirstVertex() +
+                                    tris.getNumVertices())
+                allfaces.append(idx.reshape((-1, 3)).astype(np.int64) +
+                                nverts)
+            nverts += vdata.getNumRows()
+
+    # back to the egg file axes, as in the egg data
+    conv = np.array(Mat3.convertMat(getDefaultCoordinateSystem(),
+                                    ed.getCoordinateSystem()))
+    verts, recode = np.unique(np.concatenate(allverts) @ conv, axis=0,
+                              return_inverse=True)
+    return verts, recode.ravel()[np.concatenate(allfaces)]
+
+
+def _eggWalk(eggfile):
+    '''
+    Vertices and faces from the egg data, vertex by vertex
+    '''
+    # read the terrain, assumes specific model shape, with Grid labeled
+    grid = _terrainGrid(eggfile)[1].getFirstChild()
     
     # vpool is the pool with vertices, recode these into a verts array
     vpool = grid.getFirstChild()
@@ -33,50 +142,224 @@ def terrainGeom(eggfile, space):
     for i in range(vpool.getHighestIndex()+1):
         verts[i,:] = vpool.getVertex(i).getPos3()
     
-    # create room for the indices denoting the triangle faces
-    faces = []
-    # we don't use the "high" triangles, assuming we don't get up
-    # there with the skates, keep an index of used vertices
-    usedv = np.zeros((vpool.getHighestIndex()+1,), dtype=bool)
-    
     # iterate over all triangles
+    faces = []
     c = grid.getNextChild()
     while c:
-        # used vertices
-        vidx = np.array((c.getVertex(0).getIndex(), 
-                         c.getVertex(1).getIndex(), 
-                         c.getVertex(2).getIndex()))
-        
-        # test if we are not looking at high terrain
-        if np.min(verts[vidx,1]) < 20:
-            # remember these are used
-            usedv[vidx] = True
-            # and include this face
-            faces.append(vidx)
-            
+        faces.append((c.getVertex(0).getIndex(), 
+                      c.getVertex(1).getIndex(), 
+                      c.getVertex(2).getIndex()))
         c = grid.getNextChild()
-    
+    return verts, np.array(faces, dtype=np.int64)
+
+
+def _selectFaces(verts, faces):
+    '''
+    Drop the high faces and unused vertices, convert to ODE axes
+    '''
+    # test if we are not looking at high terrain
+    faces = faces[np.min(verts[faces,1], axis=1) < _maxheight]
+
     # since we are not using all vertices; recode to only the used ones
+    usedv = np.zeros((len(verts),), dtype=bool)
+    usedv[faces] = True
     recodev = np.cumsum(usedv) - 1
-    
-    # now recode the face indices
-    faces = np.array([recodev[i] for i in faces])
-    
-    # create an array with only the used vertices
+    faces = recodev[faces]
     verts = verts[usedv,:]
     
     # flip the y and z vertices, to match the ODE world
     verts[:,1:] = -verts[:,:0:-1]
-    
-    print(verts[:3,:])
-    
+    return verts, faces
+
+
+def terrainMesh(eggfile, cache=True):
+    '''
+    Terrain vertices and faces, in ODE coordinates
+
+    Parameters
+    ----------
+    eggfile : str
+        Egg file with the terrain, the model should have a Grid group.
+    cache : bool
+        Use and update the .npz cache next to the egg file.
+
+    Returns
+    -------
+    verts : array (n, 3) of float
+        Vertex positions, x north, y east, z down.
+    faces : array (m, 3) of int
+        Vertex indices of the triangles.
+    '''
+    key = _eggHash(eggfile) if cache else None
+    cachefile = _cacheName(eggfile)
+    if cache and os.path.exists(cachefile):
+        try:
+            with np.load(cachefile) as data:
+                if str(data['key']) == key:
+                    return data['verts'], data['faces']
+        except (OSError, KeyError, ValueError) as e:
+            print(f"cannot use terrain cache {cachefile}: {e}")
+
+    try:
+        verts, faces = _bulkExtract(eggfile)
+    except Exception as e:
+        print(f"bulk terrain extraction failed, walking egg data: {e}")
+        verts, faces = _eggWalk(eggfile)
+    verts, faces = _selectFaces(verts, faces)
+
+    if cache:
+        try:
+            np.savez(cachefile, key=key, verts=verts, faces=faces)
+        except OSError as e:
+            print(f"cannot write terrain cache {cachefile}: {e}")
+    return verts, faces
+
+
+def terrainGeom(eggfile, space, cache=True):
+    '''
+    ODE trimesh geometry for the terrain
+
+    Parameters
+    ----------
+    eggfile : str
+        Egg file with the terrain.
+    space : ode.Space
+        Space for the geometry.
+    cache : bool
+        Use the cached vertices and faces, see terrainMesh.
+
+    Returns
+    -------
+    geom : ode.GeomTriMesh
+        Terrain geometry.
+    verts : array (n, 3) of float
+        Vertices, ODE coordinates.
+    '''
+    verts, faces = terrainMesh(eggfile, cache)
+
     # stack into ODE mesh
     trimeshdata = ode.TriMeshData()
     trimeshdata.build(verts, faces)
     geom = ode.GeomTriMesh(trimeshdata, space)
+    setCategory(geom, CAT_TERRAIN)
     
     return geom, verts
 
+
+def tileMesh(verts, faces, tile=250.0):
+    '''
+    Split a mesh into square tiles
+
+    Parameters
+    ----------
+    verts : array (n, 3) of float
+        Vertices.
+    faces : array (m, 3) of int
+        Triangles, vertex indices.
+    tile : float [m]
+        Tile size; triangles go to the tile with their centre.
+
+    Returns
+    -------
+    list of (verts, faces)
+        Per tile the used vertices and the recoded triangles.
+    '''
+    centre = verts[faces].mean(axis=1)
+    key = np.floor(centre[:,:2]/tile).astype(np.int64)
+    itile = np.unique(key, axis=0, return_inverse=True)[1].ravel()
+    order = np.argsort(itile, kind='stable')
+    split = np.flatnonzero(np.diff(itile[order])) + 1
+    tiles = []
+    for tfaces in np.split(faces[order], split):
+        used, local = np.unique(tfaces, return_inverse=True)
+        tiles.append((verts[used], local.reshape(tfaces.shape)))
+    return tiles
+
+
+def terrainTiles(verts, faces, space, tile=250.0):
+    '''
+    ODE trimesh geometries for the terrain, one per tile
+
+    Parameters
+    ----------
+    verts, faces : arrays
+        Terrain mesh, see terrainMesh.
+    space : ode.Space
+        Space for the geometries, preferably from courseSpace.
+    tile : float [m]
+        Tile size.
+
+    Returns
+    -------
+    list of ode.GeomTriMesh
+        The tiles, all named "terrain".
+    '''
+    geoms = []
+    for tverts, tfaces in tileMesh(verts, faces, tile):
+        trimeshdata = ode.TriMeshData()
+        trimeshdata.build(tverts, tfaces)
+        geom = ode.GeomTriMesh(trimeshdata, space)
+        geom.nam = "terrain"
+        setCategory(geom, CAT_TERRAIN)
+        geoms.append(geom)
+    return geoms
+
+
+def courseSpace(extent, cell=250.0, zrange=(-200.0, 10.0)):
+    '''
+    Quadtree collision space covering the course
+
+    Parameters
+    ----------
+    extent : 4 floats [m]
+        xmin, xmax, ymin, ymax of the course. Geometries outside still
+        collide, but are kept in the top block.
+    cell : float [m]
+        Size of the smallest blocks, about the terrain tile size.
+    zrange : 2 floats [m]
+        Vertical range, z down.
+
+    Returns
+    -------
+    ode.QuadTreeSpace
+    '''
+    xmin, xmax, ymin, ymax = extent
+    center = (0.5*(xmin + xmax), 0.5*(ymin + ymax), 0.5*sum(zrange))
+    halfsize = (0.5*(xmax - xmin), 0.5*(ymax - ymin),
+                0.5*(zrange[1] - zrange[0]))
+    depth = 1 + int(np.clip(np.ceil(np.log2(
+        2*max(halfsize[:2])/cell)), 0, 7))
+    return ode.QuadTreeSpace(center, halfsize, depth)
+
+
+def courseExtent(conffile='server.conf', margin=500.0):
+    '''
+    Course extent from a server configuration file
+
+    The extent is given in a [course] section (xmin, xmax, ymin, ymax),
+    or else taken around all marks, objects, obstructions and the start.
+
+    Returns
+    -------
+    4 floats, or None
+        xmin, xmax, ymin, ymax [m]; None without configuration file.
+    '''
+    from configparser import ConfigParser
+
+    config = ConfigParser()
+    if not config.read(conffile):
+        return None
+    if config.has_section('course'):
+        return tuple(config.getfloat('course', k)
+                     for k in ('xmin', 'xmax', 'ymin', 'ymax'))
+    xy = np.array([ (sprox.getfloat('x'), sprox.getfloat('y'))
+                    for sprox in config.values()
+                    if 'x' in sprox and 'y' in sprox ])
+    if not len(xy):
+        return None
+    return (float(xy[:,0].min() - margin), float(xy[:,0].max() + margin),
+            float(xy[:,1].min() - margin), float(xy[:,1].max() + margin))
+
 if __name__ == '__main__':
 
     from mpl_toolkits.mplot3d import Axes3D
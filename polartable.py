@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy import interpolate
+import csv
+import os
+
+'''
+Lookup tables for the sail lift and drag curves
+
+The cl/cd curves are given as splines fitted on the points in
+cl-alpha.csv and cd-alpha.csv. Evaluating a spline with splev has a
+large overhead per call, so the spline is sampled once on a dense,
+uniform grid, and queries are answered by indexing into that grid and
+interpolating linearly between the two neighbouring samples.
+
+The fitted curves are kept in a process-wide registry, keyed by file
+name and modification time, so that new craft (and the hud) share the
+same tables, without reading and fitting the csv files again.
+'''
+
+# registry of fitted polars, key is (file, mtime, file, mtime)
+_polars = dict()
+
+
+class PolarTable:
+    '''
+    Uniformly sampled table of a spline, with O(1) lookup
+    '''
+
+    def __init__(self, tck, amin: float = 0.0, amax: float = 240.0,
+                 step: float = 0.05) -> None:
+        '''
+        Sample a spline into a table
+
+        Parameters
+        ----------
+        tck : spline representation
+            Spline as returned by scipy.interpolate.splrep.
+        amin : float [deg]
+            Start of the table. The default is 0.0.
+        amax : float [deg]
+            End of the table. The default is 240.0, the absolute angle of
+            attack can run to 180 deg plus the maximum sail angle.
+        step : float [deg]
+            Table spacing. The default is 0.05.
+
+        Returns
+        -------
+        None.
+
+        '''
+        n = int(round((amax - amin)/step)) + 1
+        self.amin = amin
+        self.amax = amin + (n-1)*step
+        self.step = step
+        self.tck = tck
+        self.values = interpolate.splev(
+            np.linspace(amin, self.amax, n), tck)
+        self.slopes = np.diff(self.values)
+
+        # plain lists for the scalar path, faster than numpy scalars
+        self._scale = 1.0/step
+        self._imax = n - 2
+        self._y = self.values.tolist()
+        self._dy = self.slopes.tolist()
+
+    def __call__(self, a):
+        '''
+        Look up the value for one or more angles
+
+        Parameters
+        ----------
+        a : float or array of float [deg]
+            Angle(s) of attack. Outside of the table range the first or
+            last segment is extrapolated linearly.
+
+        Returns
+        -------
+        float or array of float
+            Interpolated value(s).
+        '''
+        if isinstance(a, float):
+            x = (a - self.amin)*self._scale
+            i = int(x)
+            if i < 0:
+                i = 0
+            elif i > self._imax:
+                i = self._imax
+            return self._y[i] + (x - i)*self._dy[i]
+
+        x = (np.asarray(a, dtype=float) - self.amin)*self._scale
+        i = np.clip(x.astype(int), 0, self._imax)
+        return self.values[i] + (x - i)*self.slopes[i]
+
+    def maxError(self, n: int = 100001) -> float:
+        '''
+        Check the accuracy of the table against the spline
+
+        Parameters
+        ----------
+        n : int
+            Number of test points, spread over the table range.
+
+        Returns
+        -------
+        float
+            Maximum absolute difference between table and spline.
+        '''
+        a = np.linspace(self.amin, self.amax, n)
+        return np.max(np.abs(self(a) - interpolate.splev(a, self.tck)))
+
+
+class SailPolar:
+    '''
+    Lift and drag curves of a sail, as splines and lookup tables
+    '''
+
+    def __init__(self, cl_alpha, cd_alpha) -> None:
+        '''
+        Create the lookup tables for a pair of cl/cd splines
+
+        Parameters
+        ----------
+        cl_alpha : spline representation
+            Lift coefficient as function of angle of attack [deg].
+        cd_alpha : spline representation
+            Drag coefficient as function of angle of attack [deg].
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.cl_alpha = cl_alpha
+        self.cd_alpha = cd_alpha
+        self.cl_table = PolarTable(cl_alpha)
+        self.cd_table = PolarTable(cd_alpha)
+
+
+def _fitCurve(fname: str, mtime: int, sidecar: bool):
+    '''
+    Fit a spline on a two-column csv file, or load it from the sidecar
+    '''
+    npzname = os.path.splitext(fname)[0] + '-spline.npz'
+    if sidecar:
+        try:
+            with np.load(npzname) as f:
+                if int(f['mtime']) == mtime:
+                    return (f['t'], f['c'], int(f['k']))
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError) as e:
+            print(f"cannot use spline sidecar {npzname}: {e}")
+
+    rows = csv.reader(open(fname))
+    rows.__next__()   # skip header
+    alpha = []
+    c = []
+    for row in rows:
+        alpha.append(float(row[0]))
+        c.append(float(row[1]))
+    tck = interpolate.splrep(alpha, c)
+
+    if sidecar:
+        np.savez(npzname, t=tck[0], c=tck[1], k=tck[2], mtime=mtime)
+    return tck
+
+
+def sailPolar(clfile: str = 'cl-alpha.csv', cdfile: str = 'cd-alpha.csv',
+              sidecar: bool = False) -> SailPolar:
+    '''
+    Get the (shared) sail polar for a pair of cl/cd files
+
+    The polar is fitted only once per process; when one of the files
+    changes on disk, it is fitted again.
+
+    Parameters
+    ----------
+    clfile : str
+        Csv file with angle of attack [deg] and lift coefficient.
+    cdfile : str
+        Csv file with angle of attack [deg] and drag coefficient.
+    sidecar : bool
+        If True, the spline coefficients are stored in/read from a
+        binary .npz file next to the csv file. The default is False.
+
+    Returns
+    -------
+    SailPolar
+        Splines and lookup tables.
+    '''
+    clfile, cdfile = os.path.abspath(clfile), os.path.abspath(cdfile)
+    clmtime = os.stat(clfile).st_mtime_ns
+    cdmtime = os.stat(cdfile).st_mtime_ns
+    key = (clfile, clmtime, cdfile, cdmtime)
+    polar = _polars.get(key, None)
+    if polar is None:
+        polar = SailPolar(_fitCurve(clfile, clmtime, sidecar),
+                          _fitCurve(cdfile, cdmtime, sidecar))
+        _polars[key] = polar
+    return polar
+
+
+if __name__ == '__main__':
+
+    import time
+
+    polar = sailPolar()
+    for fname, table in (('cl-alpha.csv', polar.cl_table),
+                         ('cd-alpha.csv', polar.cd_table)):
+        print(f'{fname}: max table error {table.maxError():.2e}')
+
+        t0 = time.perf_counter()
+        for a in np.linspace(0, 180, 10000):
+            interpolate.splev(a, table.tck)
+        t1 = time.perf_counter()
+        for a in np.linspace(0, 180, 10000).tolist():
+            table(a)
+        t2 = time.perf_counter()
+        print(f'  splev {(t1-t0)*100:.2f} us/call, '
+              f'table {(t2-t1)*100:.2f} us/call')
+
+    t0 = time.perf_counter()
+    assert sailPolar() is polar
+    print(f'cached polar in {(time.perf_counter()-t0)*1e6:.1f} us')
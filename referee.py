@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import time
+from sailmark import MarkState
+
+'''
+Race referee for all craft at once
+
+RaceMark.update checks one craft against one mark. The Course stacks the
+line and area equations of all marks in arrays, and the Referee keeps
+the race state of all craft (signed distance to each mark line, last
+mark passed, penalty) in arrays. One update evaluates the equations for
+all craft and marks in a few matrix products, and then walks the marks
+in order with boolean masks over the craft, following the same rules as
+RaceMark.update, so that the same SR/SP/SF events result:
+
+- a penalty mark ('no' rounding) is always evaluated; crossing its line
+  within its area gives a penalty, and it is passed automatically
+- other marks are only evaluated when they are the next mark; crossing
+  the line from - to + within the area passes the mark
+
+By default the referee tests swept segments: the path from the previous
+to the current position is intersected with each mark line, and the
+area is checked at the crossing point, so that a fast craft, or a low
+refereeing rate, cannot skip the mark area. The crossing time is
+interpolated on the segment. With swept=False, the sign of the line
+equation and the area are only checked at the samples, exactly as in
+RaceMark.update.
+
+refereeTrack referees a complete recorded track in one go, vectorized
+over time, with the same swept rules; refereeLog does this for a log
+file.
+'''
+
+
+class Course:
+    '''
+    Race marks, as stacked line and area equations
+    '''
+
+    def __init__(self, marks) -> None:
+        '''
+        Compile a list of race marks
+
+        Parameters
+        ----------
+        marks : list of RaceMark
+            Race marks, in order.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.marks = list(marks)
+        self.lineeq = np.array([m.lineeq for m in marks]).reshape((-1, 3))
+        self.area1 = np.array([m.area1 for m in marks]).reshape((-1, 3))
+        self.area2 = np.array([m.area2 for m in marks]).reshape((-1, 3))
+        self.penaltymark = np.array([m.rounding == 'no' for m in marks],
+                                    dtype=bool)
+        self.finish = np.array([m.score == 'finish' for m in marks],
+                               dtype=bool)
+        self.score = np.array([0 if m.score == 'finish' else m.score
+                               for m in marks], dtype=int)
+
+    def __len__(self):
+        return len(self.marks)
+
+    def evaluate(self, pos):
+        '''
+        Signed distances to the mark lines, and the in-area flags
+
+        Parameters
+        ----------
+        pos : array (n, 2)
+            Craft positions, northing, easting.
+
+        Returns
+        -------
+        tuple of arrays (n, m)
+            Line distances, and whether the craft is in the mark area.
+        '''
+        loc = np.empty((len(pos), 3))
+        loc[:,:2] = pos
+        loc[:,2] = 1.0
+        d = loc @ self.lineeq.T
+        inarea = (loc @ self.area1.T > 0) & (loc @ self.area2.T > 0)
+        return d, inarea
+
+    def sweep(self, p0, p1):
+        '''
+        Crossings of the mark lines by the segments from p0 to p1
+
+        Parameters
+        ----------
+        p0, p1 : arrays (n, 2)
+            Start and end points of the segments.
+
+        Returns
+        -------
+        tuple of arrays (n, m)
+            Whether the segment crosses the line (the sign of the line
+            equation, counting 0 as positive, changes), whether it
+            crosses from - to +, the fraction of the segment at the
+            crossing, and whether the crossing point is in the area.
+        '''
+        d0 = self.evaluate(p0)[0]
+        d1 = self.evaluate(p1)[0]
+        cross = (d0 >= 0.0) != (d1 >= 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.where(cross, d0/(d0 - d1), 0.0)
+        dp = p1 - p0
+        px = p0[:,0,None] + s*dp[:,0,None]
+        py = p0[:,1,None] + s*dp[:,1,None]
+        gate = (px*self.area1[:,0] + py*self.area1[:,1] +
+                self.area1[:,2] > 0) & \
+            (px*self.area2[:,0] + py*self.area2[:,1] +
+             self.area2[:,2] > 0)
+        return cross, cross & (d0 < 0.0), s, cross & gate
+
+
+class Referee:
+    '''
+    Race state of all craft, updated in one go
+    '''
+
+    def __init__(self, course: Course, capacity: int = 16,
+                 swept: bool = True) -> None:
+        '''
+        Create a referee for a course
+
+        Parameters
+        ----------
+        course : Course
+            Compiled race marks.
+        capacity : int
+            Initial number of craft slots, grows when needed.
+        swept : bool
+            Test the segments between updates. The default is True;
+            False checks the samples only, as RaceMark.update.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.course = course
+        self.swept = swept
+        self.slots = dict()
+        self.states = [None]*capacity
+        self.d = np.zeros((capacity, len(course)))
+        self.index = np.full((capacity,), -1, dtype=int)
+        self.penalty = np.zeros((capacity,), dtype=int)
+        self.tstart = np.zeros((capacity,))
+        self.prevpos = np.full((capacity, 2), np.nan)
+        self.prevt = np.zeros((capacity,))
+
+    def add(self, cid: int, name: str, tstart: float = None) -> MarkState:
+        '''
+        Start refereeing a craft
+
+        Parameters
+        ----------
+        cid : int
+            Craft id.
+        name : str
+            Name of the craft.
+        tstart : float [s], optional
+            Start time, on the clock of the update times. The default is
+            the current time.monotonic().
+
+        Returns
+        -------
+        MarkState
+            Race state of the craft, gives start and elapsed time.
+        '''
+        free = [ i for i, s in enumerate(self.states) if s is None ]
+        if not free:
+            n = len(self.states)
+            self.states.extend([None]*n)
+            self.d = np.vstack((self.d, np.zeros_like(self.d)))
+            self.index = np.concatenate((self.index, np.full((n,), -1)))
+            self.penalty = np.concatenate((self.penalty, np.zeros((n,), int)))
+            self.tstart = np.concatenate((self.tstart, np.zeros((n,))))
+            self.prevpos = np.vstack((self.prevpos, np.full((n, 2), np.nan)))
+            self.prevt = np.concatenate((self.prevt, np.zeros((n,))))
+            free = [n]
+        slot = free[0]
+        state = MarkState(name, cid)
+        self.states[slot] = state
+        self.slots[cid] = slot
+        self.d[slot] = 0.0
+        self.index[slot] = -1
+        self.penalty[slot] = 0
+        self.tstart[slot] = time.monotonic() if tstart is None else tstart
+        self.prevpos[slot] = np.nan
+        return state
+
+    def remove(self, cid: int) -> None:
+        '''
+        Stop refereeing a craft
+        '''
+        slot = self.slots.pop(cid, None)
+        if slot is not None:
+            self.states[slot] = None
+
+    def update(self, cids, pos, t=None):
+        '''
+        Referee new positions
+
+        Parameters
+        ----------
+        cids : sequence of int
+            Craft ids.
+        pos : array (n, 2)
+            Positions of these craft, northing, easting.
+        t : array (n) of float [s], optional
+            Times of the positions, on the clock of the start times. The
+            default is the current time.monotonic().
+
+        Returns
+        -------
+        list of (int, bytes)
+            Craft id and event message (SR, SP, SF), in mark order.
+        '''
+        slots = np.array([self.slots[c] for c in cids], dtype=int)
+        if not len(slots):
+            return []
+        pos = np.asarray(pos, dtype=float)
+        t = np.full((len(slots),), time.monotonic()) if t is None else \
+            np.asarray(t, dtype=float)
+        index = self.index[slots]
+        penalty = self.penalty[slots]
+        if self.swept:
+            events = self._sweep(slots, pos, t, index, penalty)
+        else:
+            events = self._sample(slots, pos, index, penalty)
+        self.prevpos[slots] = pos
+        self.prevt[slots] = t
+
+        # store, and keep the mark states in sync where changed
+        for i in np.flatnonzero((index != self.index[slots]) |
+                                (penalty != self.penalty[slots])):
+            state = self.states[slots[i]]
+            state.index, state.penalty = int(index[i]), int(penalty[i])
+        self.index[slots] = index
+        self.penalty[slots] = penalty
+
+        # per craft in mark order, as RaceMark.update gives them
+        events.sort(key=lambda e: (e[0], e[1]))
+        return [ (self.states[s].cid, e) for s, _, e in events ]
+
+    def _event(self, slot, im, rtime, penalty):
+        '''
+        Report passing a mark
+        '''
+        c = self.course
+        state = self.states[slot]
+        if c.finish[im]:
+            print(f"ship {state.name}, finished in {rtime}s, "
+                  f"penalty {penalty}")
+            return slot, im, f'SF{im}:{rtime}'.encode('ascii')
+        print(f"ship {state.name} rounded mark {c.marks[im].name}")
+        return slot, im, f'SR{im}:{rtime}'.encode('ascii')
+
+    def _penalty(self, slot, im):
+        '''
+        Report a penalty
+        '''
+        c = self.course
+        print(f"ship {self.states[slot].name} penalty {c.score[im]}s: "
+              f"{c.marks[im].info}")
+        return slot, im, f'SP{im}:{c.score[im]}'.encode('ascii')
+
+    def _sweep(self, slots, pos, t, index, penalty):
+        '''
+        Test the segments from the previous positions
+        '''
+        c = self.course
+        p0 = self.prevpos[slots]
+        valid = ~np.isnan(p0[:,0])
+        p0[~valid] = pos[~valid]
+        cross, upward, s, gate = c.sweep(p0, pos)
+        t0 = np.where(valid, self.prevt[slots], t)
+        rtime = t0[:,None] + s*(t - t0)[:,None] - self.tstart[slots,None]
+        events = []
+
+        for im in range(len(c)):
+            if c.penaltymark[im]:
+                index[valid & (index == im - 1)] = im
+                hit = gate[:,im]
+                events.extend(self._penalty(slots[i], im)
+                              for i in np.flatnonzero(hit))
+                penalty[hit] += c.score[im]
+                continue
+
+            passed = gate[:,im] & upward[:,im] & (index == im - 1)
+            for i in np.flatnonzero(passed):
+                events.append(self._event(
+                    slots[i], im, round(float(rtime[i,im]), 2), penalty[i]))
+            index[passed] = im
+            penalty[passed] += c.score[im]
+        return events
+
+    def _sample(self, slots, pos, index, penalty):
+        '''
+        Test the sign changes at the samples, as RaceMark.update
+        '''
+        c = self.course
+        d, inarea = c.evaluate(pos)
+        dprev = self.d[slots]
+        events = []
+
+        for im in range(len(c)):
+            dm, dp = d[:,im], dprev[:,im]
+            if c.penaltymark[im]:
+                # initial distance only, then always evaluated
+                init = dp == 0.0
+                rest = ~init
+                index[rest & (index == im - 1)] = im
+                hit = rest & inarea[:,im] & (dp*dm < 0.0)
+                events.extend(self._penalty(slots[i], im)
+                              for i in np.flatnonzero(hit))
+                penalty[hit] += c.score[im]
+                upd = init | (rest & (dm != 0.0))
+                dp[upd] = dm[upd]
+                continue
+
+            # only the next mark, when near and not exactly on the line
+            active = (dm != 0.0) & inarea[:,im] & (index == im - 1)
+            init = active & (dp == 0.0)
+            go = active & ~init
+            passed = go & (dp < 0.0) & (dm > 0.0)
+            for i in np.flatnonzero(passed):
+                events.append(self._event(
+                    slots[i], im, self.states[slots[i]].elapsed(),
+                    penalty[i]))
+            index[passed] = im
+            penalty[passed] += c.score[im]
+            dp[active] = dm[active]
+
+        self.d[slots] = dprev
+        return events
+
+
+def refereeTrack(course: Course, t, pos):
+    '''
+    Referee a recorded track, with swept segments
+
+    Gives the same events as feeding the samples one by one to a
+    Referee, but processes all samples per mark at once.
+
+    Parameters
+    ----------
+    course : Course
+        Compiled race marks.
+    t : array (k) of float [s]
+        Race time of the samples.
+    pos : array (k, 2)
+        Positions, northing, easting.
+
+    Returns
+    -------
+    list of (float, bytes)
+        Race time and event message, in time order.
+    '''
+    t = np.asarray(t, dtype=float)
+    pos = np.asarray(pos, dtype=float)
+    if len(t) < 2:
+        return []
+    cross, upward, s, gate = course.sweep(pos[:-1], pos[1:])
+    tc = t[:-1,None] + s*np.diff(t)[:,None]
+
+    # segment in which the previous mark was passed
+    events = []
+    seg = 0
+    passed = True
+    for im in range(len(course)):
+        if course.penaltymark[im]:
+            for k in np.flatnonzero(gate[:,im]):
+                events.append((k, im, tc[k,im],
+                               f'SP{im}:{course.score[im]}'.encode('ascii')))
+            continue
+        if not passed:
+            continue
+
+        # first upward crossing in the area, from the segment where the
+        # previous mark was passed
+        k = np.flatnonzero(gate[seg:,im] & upward[seg:,im])
+        if not len(k):
+            passed = False
+            continue
+        seg += k[0]
+        rtime = round(float(tc[seg,im]), 2)
+        kind = 'SF' if course.finish[im] else 'SR'
+        events.append((seg, im, tc[seg,im],
+                       f'{kind}{im}:{rtime}'.encode('ascii')))
+
+    events.sort(key=lambda e: (e[0], e[1]))
+    return [ (float(tc), e) for _, _, tc, e in events ]
+
+
+def refereeLog(course: Course, fname: str):
+    '''
+    Referee a trajectory log, .trj (see trajlog.py) or old-style .json
+
+    Returns
+    -------
+    list of (float, bytes)
+        Race time and event message, in time order.
+    '''
+    from trajlog import TrajectoryLog, readJsonLog
+
+    log = readJsonLog(fname) if fname.endswith('.json') else \
+        TrajectoryLog(fname)
+    return refereeTrack(course, log['t'],
+                        np.stack((log['x'], log['y']), axis=1))
+
+
+if __name__ == '__main__':
+
+    import contextlib
+    import io
+    from collections import Counter
+    from mapviewer import readMarks
+
+    # compare with RaceMark.update, on random walks through the course
+    marks = readMarks('server.conf')
+    course = Course(marks)
+    rng = np.random.default_rng(2)
+    ncraft, nsteps = 200, 2000
+    walk = np.cumsum(rng.normal(0.0, 20.0, (nsteps, ncraft, 2)), axis=0)
+    walk += np.array((-200.0, -650.0))
+
+    referee = Referee(course, swept=False)
+    mstates = []
+    for i in range(ncraft):
+        referee.add(i, f"craft{i}")
+        mstates.append(MarkState(f"craft{i}", i))
+
+    def kind(e):
+        return e[:2] + e[2:].split(b':')[0]
+
+    ref, vec = [], []
+    tref = tvec = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for pos in walk.astype(np.float32):
+            t0 = time.perf_counter()
+            for i in range(ncraft):
+                p = pos[i].astype(float)
+                for im, m in enumerate(marks):
+                    e = m.update(mstates[i], p, im)
+                    if e:
+                        ref.append((i, kind(e)))
+            t1 = time.perf_counter()
+            vec.extend((i, kind(e))
+                       for i, e in referee.update(range(ncraft), pos))
+            t2 = time.perf_counter()
+            tref += t1 - t0
+            tvec += t2 - t1
+    print(f"{len(ref)} events RaceMark.update, {len(vec)} Referee, "
+          f"same {ref == vec}")
+    print(f"event types {dict(Counter(e[:2] for _, e in vec))}")
+    print(f"{ncraft} craft: RaceMark.update {tref/nsteps*1e3:.2f} ms/tick, "
+          f"Referee {tvec/nsteps*1e3:.2f} ms/tick")
+
+    # swept segments, sequential and batch over recorded tracks
+    fine = np.cumsum(rng.normal(0.0, 3.0, (4000, ncraft, 2)), axis=0)
+    fine += np.array((-200.0, -650.0))
+    tfine = np.arange(len(fine))*0.05
+    with contextlib.redirect_stdout(io.StringIO()):
+        rf = Referee(course)
+        for i in range(ncraft):
+            rf.add(i, f"craft{i}", tstart=0.0)
+        seq = []
+        for k in range(len(fine)):
+            seq.extend(rf.update(range(ncraft), fine[k],
+                                 np.full(ncraft, tfine[k])))
+        t0 = time.perf_counter()
+        batch = [ (i, e) for i in range(ncraft)
+                  for _, e in refereeTrack(course, tfine, fine[:,i]) ]
+        t1 = time.perf_counter()
+    print(f"batch over {ncraft} tracks of {len(fine)} samples in "
+          f"{t1-t0:.2f}s, same events and times as sequential "
+          f"{sorted(batch) == sorted(seq)}")
+
+    # straight passes through the start gate at 25 m/s, sampled at 60 Hz
+    # and at 2 Hz; the gate is x = -200, -700 < y < -600, passed southward
+    npass, V = 1000, 25.0
+    ycross = rng.uniform(-720.0, -580.0, npass)
+    hdg = np.radians(180.0 + rng.uniform(-60.0, 60.0, npass))
+    dirs = np.stack((np.cos(hdg), np.sin(hdg)), axis=1)
+    tcross = rng.uniform(4.0, 5.0, npass)
+    inside = np.abs(ycross + 650.0) < 50.0
+    for rate in (60.0, 2.0):
+        tk = np.arange(0.0, 10.0, 1/rate)
+        for swept in (False, True):
+            rf = Referee(course, swept=swept)
+            for i in range(npass):
+                rf.add(i, f"pass{i}", tstart=0.0)
+            found = np.zeros(npass, dtype=bool)
+            terr = []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for t in tk:
+                    pos = np.array((-200.0, 0.0)) + np.stack(
+                        (np.zeros(npass), ycross), axis=1) + \
+                        dirs*(V*(t - tcross))[:,None]
+                    for i, e in rf.update(range(npass), pos,
+                                          np.full(npass, t)):
+                        if e.startswith(b'SR0:'):
+                            found[i] = True
+                            terr.append(float(e[4:]) - tcross[i])
+            # (sampled events carry the wall clock elapsed time)
+            print(f"{rate:4.0f} Hz {'swept' if swept else 'sampled':7s}: "
+                  f"{np.sum(found & inside)}/{np.sum(inside)} gate passes "
+                  f"found, {np.sum(found & ~inside)} false" +
+                  (f", start time error max {np.max(np.abs(terr)):.3f}s"
+                   if swept else ""))
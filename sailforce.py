@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+'''
+Batched calculation of the sail forces for a fleet of ice sailers
+
+The per-craft IceSailer.force does a number of ODE calls, two scalar
+spline evaluations and a small matrix product for each craft. Here the
+state of all craft is gathered into structured arrays, and the relative
+wind, angle of attack, lift & drag, sail relaxation and world-frame force
+are calculated in one pass with NumPy. The calculation is the same as
+in IceSailer.force.
+'''
+
+# state needed from each craft, in world coordinates
+craft_dtype = np.dtype([
+    ('pos', np.float64, (3,)),     # position of the cg
+    ('vel', np.float64, (3,)),     # linear velocity
+    ('R', np.float64, (3, 3)),     # rotation matrix, body -> world
+    ('ds', np.float64),            # mainsheet limit on the sail angle
+    ('_ds', np.float64),           # current sail angle
+    ('S', np.float64),             # sail surface
+    ('arm', np.float64),           # force attachment aft of mast
+    ('xmast', np.float64),         # mast position
+    ('zmast', np.float64)])        # height of the sail force
+
+# result of the force calculation
+force_dtype = np.dtype([
+    ('F', np.float64, (3,)),       # force, world coordinates
+    ('relpos', np.float64, (3,)),  # point of application, body coordinates
+    ('_ds', np.float64),           # updated sail angle
+    ('gamma', np.float64),         # relative wind angle
+    ('alpha', np.float64),         # angle of attack
+    ('V', np.float64),             # craft speed [kts]
+    ('Vw', np.float64),            # relative wind speed [kts]
+    ('active', np.bool_)])         # force is applied
+
+# conversion from m/s to kts
+_mps2kts = 3600.0/1852.0
+
+
+def sailForces(state, wspd, cl_table, cd_table):
+    '''
+    Calculate the sail forces for a number of craft
+
+    Parameters
+    ----------
+    state : array of craft_dtype
+        State of the craft.
+    wspd : array of float, (N, 3) or (3,)
+        Wind speed at the location of each craft.
+    cl_table : PolarTable
+        Lift coefficient as function of angle of attack [deg].
+    cd_table : PolarTable
+        Drag coefficient as function of angle of attack [deg].
+
+    Returns
+    -------
+    array of force_dtype
+        Forces, points of application and updated sail data. Entries
+        with a relative wind speed of (almost) zero have active False,
+        and only V, Vw are valid.
+    '''
+    res = np.zeros(state.shape, dtype=force_dtype)
+
+    # relative wind speed, horizontal, world coordinates
+    rspd = np.broadcast_to(wspd, state['vel'].shape) - state['vel']
+    rspd[:,2] = 0.0
+    V = np.sqrt(np.sum(rspd*rspd, axis=1))
+    res['Vw'] = _mps2kts*V
+    res['V'] = _mps2kts*np.sqrt(np.sum(state['vel']*state['vel'], axis=1))
+    res['_ds'] = state['_ds']
+    active = res['active'] = V >= 1.0E-8
+    if not np.any(active):
+        return res
+
+    st = state[active]
+    rspd = rspd[active]
+    V = V[active]
+
+    # relative wind in body coordinates, R^T rspd
+    rspd_b = np.einsum('nji,nj->ni', st['R'], rspd)
+
+    # relative wind angle, and angle of attack
+    gamma = np.arctan2(-rspd_b[:,1], -rspd_b[:,0])
+    alpha = gamma - st['_ds']
+    alpha = np.where(alpha > np.pi, alpha - np.pi, alpha)
+    alpha = np.where(-alpha < -np.pi, alpha + np.pi, alpha)
+
+    # lift and drag coefficients, one table lookup for all craft
+    adeg = np.abs(alpha)/np.pi*180
+    cl = cl_table(adeg)
+    cd = cd_table(adeg)
+
+    # dynamic pressure, lift and drag
+    qS = 0.5 * 1.225 * V*V * st['S']
+    D = qS * (cd + 0.05)
+    L = qS * cl
+
+    # sail follows the wind force, limited by the mainsheet
+    ds = st['_ds'] + np.minimum(np.abs(L)*0.00005, 0.01)*np.sign(alpha)
+    ds = np.clip(ds, -st['ds'], st['ds'])
+    L = np.where(alpha < 0, -L, L)
+
+    # (D, L) from wind axes to world coordinates
+    F = np.zeros_like(rspd)
+    F[:,0] = (rspd[:,0]*D - rspd[:,1]*L)/V
+    F[:,1] = (rspd[:,1]*D + rspd[:,0]*L)/V
+
+    # point of application, on the sail behind the mast
+    relpos = np.empty_like(rspd)
+    relpos[:,0] = st['xmast'] - st['arm']*np.cos(ds)
+    relpos[:,1] = -st['arm']*np.sin(ds)
+    relpos[:,2] = st['zmast']
+
+    res['F'][active] = F
+    res['relpos'][active] = relpos
+    res['_ds'][active] = ds
+    res['gamma'][active] = gamma
+    res['alpha'][active] = alpha
+    return res
+
+
+class FleetForces:
+    '''
+    Wind forces for a fleet of IceSailer craft, calculated in bulk
+    '''
+
+    def __init__(self, craft: list = ()) -> None:
+        '''
+        Create a batched force calculation
+
+        Parameters
+        ----------
+        craft : list of IceSailer
+            Craft for which the sail force is calculated. All craft must
+            use the same cl/cd curves, those of the first craft are used.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.craft = []
+        self.state = np.zeros((0,), dtype=craft_dtype)
+        for c in craft:
+            self.add(c)
+
+    def add(self, craft) -> None:
+        '''
+        Add a craft to the fleet
+        '''
+        # the sail dimensions do not change, and are set once
+        row = np.zeros((1,), dtype=craft_dtype)
+        row['S'], row['arm'] = craft.S, craft.arm
+        row['xmast'], row['zmast'] = craft.xmast, craft.zmast
+        self.craft.append(craft)
+        self.state = np.concatenate((self.state, row))
+
+    def remove(self, craft) -> None:
+        '''
+        Remove a craft from the fleet
+        '''
+        i = self.craft.index(craft)
+        del self.craft[i]
+        self.state = np.delete(self.state, i)
+
+    def gather(self) -> None:
+        '''
+        Copy the ODE and sail state of all craft into the state array
+        '''
+        st = self.state
+        for i, c in enumerate(self.craft):
+            st['pos'][i] = c.body.getPosition()
+            st['vel'][i] = c.body.getLinearVel()
+            st['R'][i].flat = c.body.getRotation()
+            st['ds'][i] = c.ds
+            st['_ds'][i] = c._ds
+
+    def force(self, wind):
+        '''
+        Calculate and apply the wind force on all craft
+
+        Parameters
+        ----------
+        wind : Wind
+            Wind model, should provide speeds(locations) for an array
+            of locations.
+
+        Returns
+        -------
+        array of force_dtype
+            Calculated forces.
+        '''
+        if not self.craft:
+            return np.zeros((0,), dtype=force_dtype)
+
+        self.gather()
+        c0 = self.craft[0]
+        res = sailForces(self.state, wind.speeds(self.state['pos']),
+                         c0.cl_table, c0.cd_table)
+
+        # write the results back, and apply forces to the bodies
+        for c, r in zip(self.craft, res):
+            c.V, c.Vw = r['V'], r['Vw']
+            if r['active']:
+                c._ds, c.gamma, c.alpha = r['_ds'], r['gamma'], r['alpha']
+                c.body.addForceAtRelPos(r['F'], r['relpos'])
+        return res
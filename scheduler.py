@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+
+'''
+Multi-rate scheduling of the work done per frame
+
+The client has a single Panda3D task per frame, but not all work in it
+needs to run every frame: the physics keeps its own 120 Hz clock (see
+Simulation.advance), the network is sent at 20 Hz, the HUD redrawn at
+15 Hz, and only the camera and the drawn poses follow every frame.
+
+A Scheduler runs registered functions at their target rates, in order
+of priority, and keeps per function the number of runs, the time used
+and the runs deferred. Priority 0 work always runs when due. Other work
+is deferred to a next frame when the time already used in this frame
+plus its expected duration exceeds the frame budget, but not more than
+a given number of times in a row, so it is slowed down, not starved.
+'''
+
+
+class ScheduledTask:
+    '''
+    A function run by the Scheduler, with its rate and accounting
+    '''
+
+    def __init__(self, name: str, function, rate: float = None,
+                 priority: int = 1) -> None:
+        self.name = name
+        self.function = function
+        self.period = 1.0/rate if rate else 0.0
+        self.priority = priority
+        self.due = None
+        self.last = None
+        self.deferred = 0
+
+        # accounting
+        self.runs = 0
+        self.skipped = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.expected = 0.0
+
+
+class Scheduler:
+    '''
+    Run functions at their own rates, within a budget per frame
+    '''
+
+    def __init__(self, budget: float = 0.008, maxdefer: int = 4) -> None:
+        '''
+        Create an empty scheduler
+
+        Parameters
+        ----------
+        budget : float [s]
+            Time per frame available for the scheduled work. The
+            default is 0.008.
+        maxdefer : int
+            Maximum number of consecutive frames that low-priority work
+            is deferred. The default is 4.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.budget = budget
+        self.maxdefer = maxdefer
+        self.tasks = []
+        self.frames = 0
+        self.overbudget = 0
+
+    def add(self, name: str, function, rate: float = None,
+            priority: int = 1) -> ScheduledTask:
+        '''
+        Add a function to the schedule
+
+        Parameters
+        ----------
+        name : str
+            Name, for the report.
+        function : function(float)
+            Called with the time [s] since its previous run.
+        rate : float [Hz], optional
+            Target rate. The default is None, every frame.
+        priority : int, optional
+            Order of running, low first; 0 is never deferred. The
+            default is 1.
+
+        Returns
+        -------
+        ScheduledTask
+            The new task.
+        '''
+        task = ScheduledTask(name, function, rate, priority)
+        self.tasks.append(task)
+        self.tasks.sort(key=lambda t: t.priority)
+        return task
+
+    def remove(self, name: str) -> None:
+        self.tasks = [ t for t in self.tasks if t.name != name ]
+
+    def run(self, now: float) -> None:
+        '''
+        Run the work that is due
+
+        Parameters
+        ----------
+        now : float [s]
+            Current time, e.g. Panda3D task.time.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.frames += 1
+        used = 0.0
+        for task in self.tasks:
+            if task.due is None:
+                task.due = task.last = now
+            if now < task.due:
+                continue
+            if task.priority and task.deferred < self.maxdefer and \
+               used + task.expected > self.budget:
+                task.deferred += 1
+                task.skipped += 1
+                continue
+
+            t0 = time.perf_counter()
+            task.function(now - task.last)
+            spent = time.perf_counter() - t0
+
+            used += spent
+            task.runs += 1
+            task.total += spent
+            task.worst = max(task.worst, spent)
+            task.expected = spent if task.runs == 1 else \
+                0.9*task.expected + 0.1*spent
+            task.deferred = 0
+            task.last = now
+
+            # keep the phase, but do not catch up on missed runs
+            task.due = max(task.due + task.period, now)
+        if used > self.budget:
+            self.overbudget += 1
+
+    def report(self) -> str:
+        '''
+        Text with the rate and time use of each task
+        '''
+        lines = [ f"{self.frames} frames, {self.overbudget} over budget" ]
+        for t in self.tasks:
+            mean = t.total/t.runs if t.runs else 0.0
+            lines.append(
+                f"{t.name:10s} {t.runs:7d} runs, {t.skipped:5d} deferred,"
+                f" mean {mean*1e3:6.2f} ms, worst {t.worst*1e3:6.2f} ms")
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    # simulated frames at 60 Hz, with a slow HUD and network
+    def work(duration):
+        def f(dt):
+            t1 = time.perf_counter() + duration
+            while time.perf_counter() < t1:
+                pass
+        return f
+
+    sched = Scheduler(budget=0.010)
+    sched.add('physics', work(0.004), priority=0)
+    sched.add('camera', work(0.0002), priority=0)
+    sched.add('network', work(0.002), 20.0, priority=1)
+    sched.add('hud', work(0.005), 15.0, priority=2)
+    for frame in range(600):
+        sched.run(frame/60.0)
+    print(sched.report())
@@ -9,13 +9,22 @@ import numpy as np
 import asyncio
 import websockets
 import base64
+import binascii
 from configparser import ConfigParser
-from sailmark import RaceMark, MarkState
-from windmodel import WindModel
-import matplotlib.pyplot as plt
-import json
+from sailmark import RaceMark
+from referee import Course, Referee
+from windmodel import WindSchedule
+from windfield import WindField
+import time
 from datetime import datetime
 from startboxes import StartBoxes
+from wireformat import isBinary, decodeHeader, decode, payload, message, \
+    asciiMessage
+from statecodec import QUANTIZED, StateDecoder, encodeSnapshot, \
+    key_dtype, delta_dtype
+from trajlog import TrajectoryRecorder, flushAll
+from mapviewer import MapPublisher, viewMap
+import multiprocessing
 
 """
 Server configuration file, server.conf:
@@ -23,6 +32,24 @@ Server configuration file, server.conf:
 - Wind section, labeled [wind]
   x = Wind speed in x direction (towards North), [m/s]
   y = Wind speed in y direction (towards Ease), [m/s]
+  var = Standard deviation of the wind variation [m/s]
+  tau = Time constant of the wind variation [s]
+  seed = Seed for the wind history, optional; with a seed every race
+         gets the same wind, see windmodel.WindSchedule
+
+- Optional wind field over the course [windfield]; without this section
+  the wind is uniform
+  xmin, xmax, ymin, ymax = extent of the wind grid [m]
+  cell = grid spacing [m], default 100
+  gusts = number of gusts and lulls on the course, default 0
+  gustspeed = standard deviation of the gust strength [m/s], default 2
+  gustradius = typical gust radius [m], default 150
+  seed = seed for the gust generator, optional
+  terrain = egg file with the terrain, for the shore shadow, optional
+
+  The field follows the [wind] model as mean wind, and is sent to
+  binary clients only (see windfield.py); ASCII clients keep the
+  uniform wind.
 
 - Start positions for the participating vehicles [start]
   x = X location [m]
@@ -35,9 +62,28 @@ Server configuration file, server.conf:
 - Network properties [network]
   ip = IP address for network connection
   port = port number for network connection
+  tickrate = rate at which craft states are sent to the clients [Hz]
+  idle = time after which a craft without updates is no longer sent [s]
+
+  Clients may use ASCII, binary or compact (quantized) messages, see
+  wireformat.py and statecodec.py. Binary clients get a snapshot of all
+  craft each tick, ASCII clients the U message of each other craft.
 
   Note that network connections use the websockets protocol
 
+- Optional course extent [course], used to size the collision space
+  (see odegrid.courseExtent); default around all marks and objects
+  xmin, xmax, ymin, ymax = course extent [m]
+
+- Course map [map]
+  viewer = yes/no, start a map viewer process, default yes
+  publish = yes/no, publish craft positions for a viewer started
+            separately (python mapviewer.py), default as viewer
+  name = name of the shared memory block, default iceboat-map
+
+  With viewer and publish both off, the server runs headless, and
+  matplotlib is never imported.
+
 - Graphical objects placed in the world [object....]
   name = file name for the object, base (no .egg or .blend extension)
   x = X location [m]
@@ -68,12 +114,10 @@ def pprint(*a):
 
 
 class LogObject:
-    def __init__(self, name):
+    def __init__(self, name, fname, index):
         self.name = name
-        self.x = []
-        self.y = []
-        self.t = []
-        self.line = None
+        self.recorder = TrajectoryRecorder(
+            fname, meta=dict(name=name, id=index))
 
 class Server:
     """Remember and distribute object data"""
@@ -99,12 +143,27 @@ class Server:
         try:
             print('in _communicate')
             data = await websocket.recv()
-            if data[:1] != b'B':
-                raise ConnectionError(
-                    f"Incorrect start protocol {data}")
-                
-            name = data[1:].decode('ascii')
-            print(f'new player {name}')
+
+            # the birth message selects binary or ASCII format
+            binary = isBinary(data)
+            decoder = None
+            if binary:
+                mtype, _, flags = decodeHeader(data)
+                if mtype != b'B':
+                    raise ConnectionError(
+                        f"Incorrect start protocol {data}")
+                name = payload(data).decode('ascii')
+                self.binclients.add(websocket)
+                if flags & QUANTIZED:
+                    decoder = StateDecoder()
+                    self.qclients.add(websocket)
+            else:
+                if data[:1] != b'B':
+                    raise ConnectionError(
+                        f"Incorrect start protocol {data}")
+                name = data[1:].decode('ascii')
+            print(f'new player {name}, binary {binary}, '
+                  f'quantized {decoder is not None}')
                         
             # step 1, initial connection / birth
             index = self.lifecounter
@@ -124,21 +183,24 @@ class Server:
             #ndata[3:7] = self.quat0            
 
             # produce the welcome message with the chosen start position
-            data = f'W{index}:'.encode('ascii') + \
-                base64.b64encode(ndata)
+            data = message(binary, b'W', index, 0, ndata)
             await websocket.send(data)
             
             # send the environment configuration
             for d in self.config:
                 #print(f"sending {d}")
                 await websocket.send(d)
+            if binary and self.windfield is not None:
+                await websocket.send(
+                    self.windfield.fullMessage(self.seconds))
             
             # copy birth to others, and inform this one of other players
             birth = f'B{index}:{name}'.encode('ascii')
             if all_connected:
                 print(f"sending {birth} to {len(all_connected)} players")
-                await asyncio.wait(
-                    [sock.send(birth) for sock in all_connected])
+                await asyncio.gather(
+                    *[sock.send(birth) for sock in all_connected],
+                    return_exceptions=True)
 
             # inform this one of other players
             for b2 in all_connected.values():
@@ -148,15 +210,19 @@ class Server:
             # store in dict with connected items                
             all_connected[websocket] = birth
             
-            # create a mark status for this vehicle
-            markstate = MarkState(name, index)
+            # create a mark status for this vehicle; refereed at the tick
+            markstate = self.referee.add(index, name)
+            self.sockets[index] = websocket
             
             for im, m in enumerate(self.marks):
                 # send information on the marks
                 await websocket.send(m.transmit(im))
 
-            # for logging and plotting
-            self.clog[index] = LogObject(name)
+            # for logging
+            filename = datetime.now().strftime(
+                f"saillog-%m%d-%H%M{name}-{index}.trj")
+            print(f"recording data for {name} to {filename}")
+            self.clog[index] = LogObject(name, filename, index)
 
             # remember wind time sent
             seconds = 0
@@ -165,94 +231,238 @@ class Server:
             while True:
                 
                 data = await websocket.recv()
-                
-                if data[:1] == b'D':
+
+                # unknown messages close the connection, malformed updates
+                # are dropped here, before they reach the tick
+                try:
+                    mtype, ndata = self._decodeUpdate(data, binary, decoder)
+                except ValueError as e:
+                    print(f"dropped update from {index}: {e}")
+                    continue
+
+                if mtype == b'D':
                     print(f"death of connected {index}")
                         
                     break
-                    
-                if data[:1] != b'U':
-                    ConnectionError(
-                        f"Incorrect run protocol {data}")
+
+                if ndata is None:
+                    # delta before the first keyframe
+                    continue
                 
                 pprint(f"data from {index}")
-                # update for own view
-                self.clist[index] = data
-
-                # send/reflect to all others
-                if len(all_connected) > 1:
-                    await asyncio.wait(
-                        [user.send(data) for user in all_connected 
-                         if user != websocket])
-                pprint("copied to", len(all_connected) - 1, "others")
-                
-                # decode position
-                ndata = np.frombuffer(
-                    base64.decodebytes(
-                        data.split(self._splitchar)[1]), 
-                        dtype=np.float32)
+
+                # position, for the start box
                 pos = ndata[:2].astype(float)
+
+                # latest state, distributed to the others at the next tick
+                self.clist[index] = (time.monotonic(), ndata.copy())
+                self.clog[index].recorder.append(markstate.elapsed(), *ndata)
+                
                 #print(f"incoming position {pos}")
                 
                 # check the start box status
                 self.startboxes.update(index, pos)
-                
-                for im, m in enumerate(self.marks):
-                    event = m.update(markstate, pos, im)
-                    if event:
-                        await websocket.send(event)
                         
                 if seconds != self.seconds:
                     seconds = self.seconds
-                    await websocket.send(self.wind.message)
-                    self.clog[index].x.append(pos[0])
-                    self.clog[index].y.append(pos[1])
-                    self.clog[index].t.append(markstate.elapsed())
+                    await websocket.send(
+                        message(binary, b'E', 0, seconds,
+                                self.wind.vvar))
         
         except websockets.ConnectionClosedError as e:
             print(f"Close error {e}")             
+        except ConnectionError as e:
+            print(f"Protocol error {e}")
         finally:
             print(f"removing {index}")
             del all_connected[websocket]
-            data = f'D{index}'.encode('ascii')
+            self.clist.pop(index, None)
+            self.referee.remove(index)
+            self.sockets.pop(index, None)
+            self.binclients.discard(websocket)
+            self.qclients.discard(websocket)
             if all_connected:
-                try:
-                    await asyncio.wait(
-                        [user.send(data) for user in all_connected])
-                except Exception as e:
-                    print(f"Deletion sent failed {e}")  
+                res = await asyncio.gather(
+                    *[user.send(message(user in self.binclients, b'D', index))
+                      for user in all_connected], return_exceptions=True)
+                for e in res:
+                    if isinstance(e, Exception):
+                        print(f"Deletion sent failed {e}")
             else:
                 self.lifecounter = 0
                 
-            filename = datetime.now().strftime(
-                f"saillog-%m%d-%H%M{name}-{index}.json")
-            print(f"saving data for {name} to {filename}")
-            with open(filename, 'w') as f:
-                json.dump(dict(n=name, x=self.clog[index].x, 
-                               y=self.clog[index].y,
-                               t=self.clog[index].t), f)
+            # remaining data and index are written in the background
+            if index in self.clog:
+                self.clog[index].recorder.close()
             
-    async def _update_wind(self):
+    def _decodeUpdate(self, data, binary: bool, decoder: StateDecoder):
+        """
+        Decode a message received in the update loop
+
+        Parameters
+        ----------
+        data : bytes
+            Message from the client.
+        binary : bool
+            Client uses the binary format.
+        decoder : StateDecoder
+            Decoder for compact updates, None if the client did not ask
+            for compact coding.
+
+        Raises
+        ------
+        ConnectionError
+            Unknown message type, or compact update from a client that
+            did not ask for compact coding.
+        ValueError
+            Update with the wrong size, or not finite values.
+
+        Returns
+        -------
+        tuple of (bytes, array of float32)
+            Message type, U or D, and for an update the 15 state values;
+            None for a death, or for a delta before the first keyframe.
+
+        """
+        if not isinstance(data, bytes) or binary != isBinary(data):
+            raise ConnectionError(f"Incorrect run protocol {data[:16]}")
+        if binary:
+            mtype = decodeHeader(data)[0]
+            if mtype in (b'K', b'Q'):
+                if decoder is None:
+                    raise ConnectionError(
+                        f"Compact update {mtype} without quantized birth")
+                size = (key_dtype if mtype == b'K' else delta_dtype).itemsize
+                if len(payload(data)) != size:
+                    raise ValueError(f"{mtype} payload of "
+                                     f"{len(payload(data))} bytes")
+                ndata = decoder.decode(mtype, payload(data))
+                if ndata is None:
+                    return b'U', None
+            elif mtype == b'U':
+                ndata = decode(data)[3]
+            elif mtype != b'D':
+                raise ConnectionError(f"Incorrect run protocol {mtype}")
+        else:
+            mtype = data[:1]
+            if mtype == b'U':
+                try:
+                    ndata = np.frombuffer(
+                        base64.decodebytes(data.split(self._splitchar)[1]),
+                        dtype=np.float32)
+                except (IndexError, binascii.Error) as e:
+                    raise ValueError(f"cannot decode {data[:16]}") from e
+            elif mtype != b'D':
+                raise ConnectionError(f"Incorrect run protocol {data[:16]}")
+        if mtype == b'D':
+            return mtype, None
+        if ndata.shape != (15,):
+            raise ValueError(f"update with {ndata.size} values")
+        if not np.all(np.isfinite(ndata)):
+            raise ValueError("update with non-finite values")
+        return mtype, ndata
+
+    async def _tick(self):
+        '''
+        Send the latest state of all craft to all clients, once per tick
+
+        For binary clients, one snapshot message per client per tick
+        replaces the relay of every update to every other client. The
+        snapshot holds, for each craft updated within the idle time, the
+        craft id followed by the 15 floats of an update message; clients
+        skip their own craft. ASCII clients get, per tick, the latest U
+        message of each of the other craft, as in the original protocol.
+        The race referee also runs once per tick, on the latest states.
+        '''
+        tick = 0
         while True:
-            
-            # also do any plotting
-            for s in self.clog.values():
-                if s.line is None:
-                    s.line, = self.ax.plot(s.y, s.x, label=s.name)
+            await asyncio.sleep(self.tickperiod)
+            tick += 1
+
+            # collect the recent craft states, and forget idle craft
+            now = time.monotonic()
+            for index in [ i for i, (t, _) in self.clist.items()
+                           if now - t > self.idle ]:
+                print(f"craft {index} idle, dropped from snapshot")
+                del self.clist[index]
+
+            # referee all craft, send the mark events
+            if self.clist:
+                events = self.referee.update(
+                    list(self.clist.keys()),
+                    [ ndata[:2] for t, ndata in self.clist.values() ],
+                    [ t for t, ndata in self.clist.values() ])
+                if events:
+                    await asyncio.gather(
+                        *[self.sockets[index].send(event)
+                          for index, event in events],
+                        return_exceptions=True)
+
+            # positions for the map viewer
+            if self.map is not None:
+                self.map.publish(
+                    (index, self.clog[index].name, ndata[0], ndata[1])
+                    for index, (t, ndata) in self.clist.items()
+                    if index in self.clog)
+            if not self.clist or not all_connected:
+                continue
+            snapshot = np.zeros((len(self.clist), 16), dtype=np.float32)
+            for row, (index, (t, ndata)) in zip(snapshot, 
+                                                self.clist.items()):
+                row[0] = index
+                row[1:] = ndata
+
+            # binary clients get one snapshot per tick, compact or float;
+            # ASCII clients keep getting the update of each other craft
+            coded = dict(X=message(True, b'X', len(snapshot), tick, snapshot))
+            if self.qclients:
+                coded['Z'] = encodeSnapshot(
+                    tick, snapshot[:,0].astype(np.uint16), snapshot[:,1:])
+            updates = [ (index, asciiMessage(b'U', index, ndata))
+                        for index, (t, ndata) in self.clist.items() ]
+            owner = { sock: index for index, sock in self.sockets.items() }
+            sends = []
+            for user in all_connected:
+                if user in self.qclients:
+                    sends.append(user.send(coded['Z']))
+                elif user in self.binclients:
+                    sends.append(user.send(coded['X']))
                 else:
-                    s.line.set_data(s.y, s.x)
-            self.fig.canvas.draw()
-            plt.pause(0.01)
+                    sends.append(self._relay(
+                        user, [ data for index, data in updates
+                                if index != owner.get(user) ]))
+            await asyncio.gather(*sends, return_exceptions=True)
+
+    @staticmethod
+    async def _relay(user, messages: list):
+        """
+        Send the U messages of the other craft to an ASCII client
+        """
+        for data in messages:
+            await user.send(data)
+
+    async def _update_wind(self):
+        while True:
             
             # update the wind data
             self.seconds += 1
-            self.wind.update()
-            self.wind.update()
+            self.wind.update(time.monotonic() - self.tstart)
+
+            # move the gusts, send the grid changes
+            if self.windfield is not None:
+                self.windfield.setMean(self.wind.vvar)
+                self.windfield.advance(2.0)
+                update = self.windfield.deltaMessage(self.seconds)
+                await asyncio.gather(
+                    *[user.send(update) for user in self.binclients],
+                    return_exceptions=True)
             await asyncio.sleep(2)
             
     def __init__(self, hostip: str, port: int, 
-                 config: list, marklist: list, wind: WindModel,
-                 startboxes: StartBoxes):
+                 config: list, marklist: list, wind: WindSchedule,
+                 startboxes: StartBoxes, tickrate: float = 20.0,
+                 idle: float = 5.0, mapname: str = None,
+                 viewer: bool = False, windfield: WindField = None):
         
         # initial and incremental position for participants
         self.startboxes = startboxes
@@ -260,15 +470,26 @@ class Server:
         # game configuration, race marks and wind
         self.config = config
         self.marks = marklist
+        self.referee = Referee(Course(marklist))
         self.wind = wind
+        self.windfield = windfield
 
-        # client list and id counter
+        # latest craft states, rate and idle time for sending them
+        self.tickperiod = 1.0/tickrate
+        self.idle = idle
+
+        # client list, clients using binary or quantized messages, and
+        # id counter
         self.clist = {}
+        self.sockets = {}
+        self.binclients = set()
+        self.qclients = set()
         self.clog = {}
         self.lifecounter = 0
         
         # wind and time
         self.seconds = 0
+        self.tstart = time.monotonic()
         
         # start server
         self.start_server = websockets.serve(
@@ -276,19 +497,27 @@ class Server:
         #asyncio.get_event_loop().run_until_complete(
         #    self.start_server)
         
-        # plt.ion()
-        #plt.plot()
-        #plt.pause(0.001)
-        self.fig = plt.figure(figsize=(5,7))
-        self.ax = self.fig.add_subplot(111)
-        for m in marklist:
-            m.plotMe(self.ax)
-        self.ax.axis('equal')
-        self.fig.show()
-        plt.pause(0.1)
-        
-        asyncio.gather(self.start_server, self._update_wind())
-        asyncio.get_event_loop().run_forever()
+        # craft positions for the map, drawn in a separate process
+        self.map = None
+        if mapname:
+            self.map = MapPublisher(mapname)
+            if viewer:
+                multiprocessing.Process(
+                    target=viewMap, args=(mapname, marklist),
+                    name='mapviewer', daemon=True).start()
+
+        try:
+            asyncio.gather(self.start_server, self._update_wind(),
+                           self._tick())
+            asyncio.get_event_loop().run_forever()
+        finally:
+            if self.map is not None:
+                self.map.close()
+
+            # finish the trajectory files of the craft still sailing
+            for log in self.clog.values():
+                log.recorder.close()
+            flushAll()
 
 if __name__ == '__main__':
     # create a server
@@ -300,10 +529,41 @@ if __name__ == '__main__':
     wy = config.getfloat('wind', 'y', fallback=0.0)
     varwind = config.getfloat('wind', 'var', fallback=0.0)
     tauwind = config.getfloat('wind', 'tau', fallback=100.0)
+    seedwind = config.getint('wind', 'seed', fallback=None)
+
+    # optional spatially varying wind
+    windfield = None
+    if config.has_section('windfield'):
+        windfield = WindField(
+            (config.getfloat('windfield', 'xmin', fallback=-3000.0),
+             config.getfloat('windfield', 'xmax', fallback=3000.0),
+             config.getfloat('windfield', 'ymin', fallback=-3000.0),
+             config.getfloat('windfield', 'ymax', fallback=3000.0)),
+            config.getfloat('windfield', 'cell', fallback=100.0),
+            (wx, wy),
+            config.getint('windfield', 'gusts', fallback=0),
+            config.getfloat('windfield', 'gustspeed', fallback=2.0),
+            config.getfloat('windfield', 'gustradius', fallback=150.0),
+            seed=config.getint('windfield', 'seed', fallback=None))
+        terrain = config.get('windfield', 'terrain', fallback=None)
+        if terrain:
+            try:
+                from odegrid import terrainMesh
+                windfield.setTerrain(terrainMesh(terrain)[0])
+            except ImportError as e:
+                print(f"no terrain for the wind field shadow, {e}")
     
     # ip / network connection
     ip = config.get('network', 'ip', fallback='127.0.0.1')
     port = config.getint('network', 'port', fallback=8300)
+    tickrate = config.getfloat('network', 'tickrate', fallback=20.0)
+    idle = config.getfloat('network', 'idle', fallback=5.0)
+
+    # course map viewer, or headless
+    viewer = config.getboolean('map', 'viewer', fallback=True)
+    publish = config.getboolean('map', 'publish', fallback=viewer)
+    mapname = config.get('map', 'name', fallback='iceboat-map') \
+        if publish or viewer else None
     
     # starting spots for participants
     x0 = config.getfloat('start', 'x', fallback=0.0)
@@ -316,7 +576,7 @@ if __name__ == '__main__':
     startboxes = StartBoxes(x0, y0, z0, psi0, dx0, dy0, nstart)    
     
     # state of the simulation wind, objects and race marks  
-    wind = WindModel(wx, wy, varwind, tauwind)
+    wind = WindSchedule(wx, wy, varwind, tauwind, seed=seedwind)
     configlist = [ ]
     marklist = [ ]
     
@@ -374,4 +634,4 @@ if __name__ == '__main__':
     print(f"Number of race marks {len(marklist)}")
             
     srv = Server(ip, port, configlist, marklist, wind, 
-                 startboxes)
+                 startboxes, tickrate, idle, mapname, viewer, windfield)
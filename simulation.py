@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import ode
+from icesailer import g0, Wind, IceSailer, coll_callback, obstacleGeom, \
+    setCategory, CAT_GROUND
+from sailforce import FleetForces
+from windmodel import WindSchedule
+from deadreckoning import nlerp
+import numpy as np
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+'''
+Headless, fixed-step simulation of a number of ice sailers
+
+The Simulation object owns the ODE world, collision space, contact
+group and wind, and the list of craft that are simulated locally.
+It steps at IceSailer.dt_max, as fast as the CPU allows, without any
+window or Panda3D task manager. The visual client (iceboat.py) uses
+the same object, and advances it from its Panda3D task with the elapsed
+frame time: the time is accumulated, and whole steps are taken while a
+step's worth is available, so the physics keeps real time at any frame
+rate, with the same steps as a headless run. Poses for drawing are
+interpolated between the last two physics states.
+
+Optionally, a PhysicsThread advances the simulation on its own thread.
+It then owns the ODE world: other threads only read the newest
+Snapshot, an immutable set of craft poses, and hold PhysicsThread.lock
+for anything that changes the world (new craft, obstacles, deletions).
+'''
+
+# pose and state of one craft, in a Snapshot
+CraftPose = namedtuple('CraftPose', 'pos quat vel omg dr ds V Vw gamma')
+
+# craft poses after a physics step; poses is a read-only mapping from
+# craft to CraftPose
+Snapshot = namedtuple('Snapshot', 'time wall poses')
+
+
+class Simulation:
+    '''
+    ODE world with ice sailers, stepped at a fixed time step
+    '''
+
+    def __init__(self, wind: Wind = None, terrain: str = None,
+                 erp: float = 0.8, cfm: float = 1E-5,
+                 schedule: WindSchedule = None, extent=None,
+                 tile: float = 250.0, skates: str = 'ode') -> None:
+        '''
+        Create the simulation world
+
+        Parameters
+        ----------
+        wind : Wind, optional
+            Wind model. The default is a constant Wind().
+        terrain : str, optional
+            Egg file with the terrain. The terrain is added as obstacle,
+            in tiles; loading it needs Panda3D's egg library. The
+            default is None, flat ice only.
+        erp : float, optional
+            ODE error reduction parameter. The default is 0.8.
+        cfm : float, optional
+            ODE constraint force mixing. The default is 1E-5.
+        schedule : WindSchedule, optional
+            Wind history; the wind is set from the schedule at the
+            simulation time, at every step. The same seed gives the same
+            wind as on the server, at any simulation speed.
+        extent : 4 floats [m], optional
+            Course extent, xmin, xmax, ymin, ymax, e.g. from
+            odegrid.courseExtent. With an extent or terrain, collisions
+            use a quadtree space over the course (the terrain extent
+            when no course extent is given), otherwise a simple space.
+        tile : float [m], optional
+            Terrain tile size, and smallest quadtree block.
+        skates : str, optional
+            Runner contact model, 'ode' for ODE contacts of the skate
+            spheres, or 'analytic' for the runner forces of
+            skatemodel.FleetSkates on open ice, with ODE contacts near
+            terrain and obstacles. The default is 'ode'.
+
+        Returns
+        -------
+        None.
+
+        '''
+        # ode world
+        self.world = ode.World()
+        self.world.setERP(erp)
+        self.world.setCFM(cfm)
+        self.world.setGravity((0, 0, g0))
+        self.wind = wind if wind is not None else Wind()
+        self.schedule = schedule
+
+        # collision space, sized to the course when known
+        verts = None
+        if terrain:
+            from odegrid import terrainMesh
+            verts, faces = terrainMesh(terrain)
+            if extent is None:
+                extent = (verts[:,0].min(), verts[:,0].max(),
+                          verts[:,1].min(), verts[:,1].max())
+        if extent is not None:
+            from odegrid import courseSpace
+            self.space = courseSpace(extent, tile)
+        else:
+            self.space = ode.Space()
+
+        # flat ground plane
+        self.ground = ode.GeomPlane(self.space, (0, 0, -1), 0)
+        self.ground.nam = "ground"
+        setCategory(self.ground, CAT_GROUND)
+
+        # terrain as obstacle, in tiles
+        self.terrain = []
+        if verts is not None:
+            from odegrid import terrainTiles
+            self.terrain = terrainTiles(verts, faces, self.space, tile)
+
+        # contacts for skating and collision
+        self.contactgroup = ode.JointGroup()
+
+        # locally simulated craft, with their sail forces, and obstacles
+        self.craft = []
+        self.fleet = FleetForces()
+        self.obstacles = []
+
+        # optional analytic runner forces
+        self.skates = None
+        if skates == 'analytic':
+            from skatemodel import FleetSkates
+            self.skates = FleetSkates(self.world, self.space, erp, cfm)
+        elif skates != 'ode':
+            raise ValueError(f"unknown skate model {skates}")
+
+        # simulation time
+        self.dt = IceSailer.dt_max
+        self.nsteps = 0
+        self.time = 0.0
+
+        # real-time stepping; unsimulated time, time given up when
+        # running behind, and poses before the last step
+        self.accumulator = 0.0
+        self.lost = 0.0
+        self.previous = dict()
+
+    def newCraft(self, x=(0, 0, 0), psi=0) -> IceSailer:
+        '''
+        Create a new craft, and add it to the simulation
+
+        Parameters
+        ----------
+        x : 3-tuple of float
+            Initial position of the craft cg.
+        psi : float, or 3-tuple of float
+            Initial heading, or (phi, theta, psi).
+
+        Returns
+        -------
+        IceSailer
+            The new craft.
+        '''
+        craft = IceSailer(self.world, self.space, x, psi)
+        self.addCraft(craft)
+        return craft
+
+    def addCraft(self, craft: IceSailer) -> None:
+        '''
+        Add a craft created in this world to the simulated craft
+        '''
+        self.craft.append(craft)
+        self.fleet.add(craft)
+        if self.skates is not None:
+            self.skates.add(craft)
+
+    def removeCraft(self, craft: IceSailer) -> None:
+        '''
+        Stop simulating a craft, and release it
+        '''
+        self.craft.remove(craft)
+        self.fleet.remove(craft)
+        if self.skates is not None:
+            self.skates.remove(craft)
+        craft.close()
+
+    def newObstacle(self, name, otype, coords):
+        '''
+        Place a new fixed obstacle, see obstacleGeom
+        '''
+        self.obstacles.append(obstacleGeom(self.space, name, otype, coords))
+
+    def step(self) -> None:
+        '''
+        Advance the simulation with one time step
+        '''
+        # wind forces on all craft
+        if self.schedule is not None:
+            self.wind._speed[:2] = self.schedule.at(self.time)
+        self.fleet.force(self.wind)
+
+        # runner forces on open ice, replacing the ground contacts
+        if self.skates is not None:
+            self.skates.apply(self.dt)
+
+        # calculate collisions
+        self.space.collide((self.world, self.contactgroup), coll_callback)
+
+        # update the world
+        self.world.step(self.dt)
+
+        # clear contacts for next round
+        self.contactgroup.empty()
+        self.nsteps += 1
+        self.time = self.nsteps*self.dt
+
+    def advance(self, elapsed: float, maxsteps: int = 8) -> int:
+        '''
+        Advance the simulation in real time, with whole time steps
+
+        Parameters
+        ----------
+        elapsed : float [s]
+            Real time since the previous call, e.g. the frame time.
+        maxsteps : int
+            Maximum number of steps per call. When more time is
+            pending, the excess is dropped and the simulation runs
+            slower than real time, instead of taking ever more steps
+            per frame. The default is 8.
+
+        Returns
+        -------
+        int
+            Number of steps taken.
+        '''
+        self.accumulator += elapsed
+        if self.accumulator > maxsteps*self.dt:
+            self.lost += self.accumulator - maxsteps*self.dt
+            self.accumulator = maxsteps*self.dt
+        nsteps = int(self.accumulator/self.dt + 1E-9)
+        for it in range(nsteps):
+            if it == nsteps - 1:
+                self.previous = {
+                    c: (c.body.getPosition(), c.body.getQuaternion())
+                    for c in self.craft }
+            self.step()
+        self.accumulator = max(self.accumulator - nsteps*self.dt, 0.0)
+        return nsteps
+
+    def pose(self, craft):
+        '''
+        Pose of a craft for drawing, interpolated between the last two
+        physics states with the time left in the accumulator
+
+        Parameters
+        ----------
+        craft : IceSailer
+            A simulated craft.
+
+        Returns
+        -------
+        pos : array of 3 floats
+            Position.
+        quat : array of 4 floats
+            Attitude quaternion.
+        '''
+        pos = np.array(craft.body.getPosition())
+        quat = np.array(craft.body.getQuaternion())
+        prev = self.previous.get(craft)
+        if prev is None:
+            return pos, quat
+        f = min(self.accumulator/self.dt, 1.0)
+        return (1.0 - f)*np.array(prev[0]) + f*pos, \
+            nlerp(np.array(prev[1]), quat, f)
+
+    def run(self, duration: float, callback=None, every: int = 1) -> None:
+        '''
+        Run the simulation for a given time, as fast as possible
+
+        Parameters
+        ----------
+        duration : float [s]
+            Simulated time span, rounded to a whole number of steps.
+        callback : function(Simulation), optional
+            Called after every <every> steps, e.g. for logging.
+        every : int
+            Callback interval, in steps. The default is 1.
+
+        Returns
+        -------
+        None.
+
+        '''
+        for it in range(int(round(duration/self.dt))):
+            self.step()
+            if callback is not None and it % every == every - 1:
+                callback(self)
+
+
+class PhysicsThread:
+    '''
+    Real-time stepping of a Simulation on a separate thread
+    '''
+
+    def __init__(self, sim: Simulation, prepare=None, others=None,
+                 maxsteps: int = 8) -> None:
+        '''
+        Create the physics thread; it runs after start()
+
+        Parameters
+        ----------
+        sim : Simulation
+            Simulation, owned by the thread once started.
+        prepare : function(), optional
+            Called before advancing, with the lock held, e.g. to move
+            remotely controlled craft.
+        others : function() returning iterable of IceSailer, optional
+            Craft that are not simulated, but included in the snapshot.
+        maxsteps : int
+            Maximum number of steps per advance, see Simulation.advance.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.sim = sim
+        self.prepare = prepare
+        self.others = others
+        self.maxsteps = maxsteps
+        self.lock = threading.Lock()
+        self.snapshot = self._publish(time.monotonic())
+        self._stop = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='physics', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.thread.join()
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self.lock:
+                if self.prepare is not None:
+                    self.prepare()
+                self.sim.advance(now - last, self.maxsteps)
+                snapshot = self._publish(now)
+            self.snapshot = snapshot
+            last = now
+
+            # sleep until the next step is due
+            wait = self.sim.dt - self.sim.accumulator - \
+                (time.monotonic() - now)
+            if wait > 0.0:
+                self._stop.wait(wait)
+
+    def _publish(self, wall: float) -> Snapshot:
+        '''
+        Immutable copy of the poses of the simulated and other craft
+        '''
+        poses = dict()
+        others = list(self.others()) if self.others is not None else []
+        local = set(self.sim.craft)
+        for c in self.sim.craft + others:
+            if c in local:
+                pos, quat = self.sim.pose(c)
+                pos, quat = tuple(pos.tolist()), tuple(quat.tolist())
+            else:
+                pos, quat = c.body.getPosition(), c.body.getQuaternion()
+            poses[c] = CraftPose(
+                pos, quat, c.body.getLinearVel(), c.body.getAngularVel(),
+                c.dr, c._ds, c.V, c.Vw, c.gamma)
+        return Snapshot(self.sim.time, wall, MappingProxyType(poses))
+
+
+if __name__ == '__main__':
+
+    from numpy import radians, cos, sin
+    from icesailer import collisionstats
+
+    # a circle of craft, as in testsails.py
+    sim = Simulation(Wind((-5, 0, 0)))
+    for hdg in range(0, 360, 10):
+        c = sim.newCraft((250*cos(radians(hdg)), 250*sin(radians(hdg)), -0.8),
+                         (0.0, 0.0, radians(hdg)))
+        c.updateMainsheet(0.1)
+
+    t0 = time.perf_counter()
+    sim.run(10.0)
+    wall = time.perf_counter() - t0
+    print(f"{len(sim.craft)} craft, {sim.time:.1f}s simulated in {wall:.2f}s,"
+          f" {sim.time/wall:.1f}x real time")
+    print(f"narrow-phase tests per step {collisionstats.tested/sim.nsteps:.1f},"
+          f" contacts per category pair {dict(collisionstats.contacts)}")
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+
+'''
+Analytic runner forces for ice sailers on flat ice
+
+Normally each skate is an ODE sphere, and the collision callback creates
+a contact joint for it against the ground plane at every step, with
+anisotropic friction; solving these contacts is the largest part of the
+work in world.step for a craft on open ice.
+
+On the flat ice plane (z = 0) the three runner constraints can also be
+solved directly. Per runner there are two constraint directions, the
+normal (up) and across the runner. With the Jacobian J of these 6
+directions at the contact points, the forces lambda follow from
+
+    (J M^-1 J^T + cfm/dt) lambda = (c - J v)/dt - J M^-1 F
+
+where c gives the ERP correction of the penetration on the normal rows,
+the same formulation as ODE's contact joints. Runners above the ice get
+no force, normal forces cannot pull, and the side force is bounded by
+mu2 (1000) times the normal force; these limits are enforced with a few
+active-set iterations. Friction along the runners (mu, 0.001) is added
+as a force, from the normal forces of a first pass. Both passes are
+batched NumPy solves for all craft. The resulting force and torque are
+added to the body before world.step.
+
+Near terrain tiles or obstacles, the craft falls back to the ODE sphere
+contacts; in the analytic mode, the collide mask of the skates excludes
+the ground plane, so the broad phase drops those pairs. Only FleetSkates
+needs ODE (through icesailer); runnerForces works on NumPy data alone.
+'''
+
+# state needed from each craft, world coordinates
+skate_dtype = np.dtype([
+    ('pos', np.float64, (3,)),     # position of the cg
+    ('vel', np.float64, (3,)),     # linear velocity
+    ('omg', np.float64, (3,)),     # angular velocity
+    ('R', np.float64, (3, 3)),     # rotation matrix, body -> world
+    ('F', np.float64, (3,)),       # accumulated force, incl. gravity
+    ('T', np.float64, (3,)),       # accumulated torque
+    ('minv', np.float64),          # inverse mass
+    ('Iinv', np.float64, (3, 3)),  # inverse inertia, body axes
+    ('skates', np.float64, (3, 3)),    # skate centres, body axes
+    ('radius', np.float64, (3,)),  # skate radius
+    ('dr', np.float64)])           # steering angle, front skate
+
+# friction coefficients along and across the runners, as in coll_callback
+_mu = 0.001
+_mu2 = 1000.0
+
+
+def runnerForces(state, dt: float, erp: float = 0.8, cfm: float = 1E-5,
+                 iterations: int = 4):
+    '''
+    Solve the runner forces for a number of craft
+
+    Parameters
+    ----------
+    state : array of skate_dtype
+        State of the craft.
+    dt : float [s]
+        Time step of the coming world.step.
+    erp : float
+        Error reduction parameter, fraction of the penetration removed
+        per step.
+    cfm : float
+        Constraint force mixing.
+    iterations : int
+        Maximum number of active-set iterations.
+
+    Returns
+    -------
+    F : array (n, 3)
+        Total runner force, world coordinates.
+    T : array (n, 3)
+        Total runner torque about the cg, world coordinates.
+    N : array (n, 3)
+        Normal force per runner (front, left, right).
+    '''
+    n = len(state)
+    R = state['R']
+
+    # skate centres and contact points relative to the cg, world axes
+    rc = np.einsum('nij,nkj->nki', R, state['skates'])
+    rc[:,:,2] += state['radius']
+    depth = state['pos'][:,None,2] + rc[:,:,2]
+
+    # runner directions; horizontal nose direction, front one steered
+    nose = R[:,:,0].copy()
+    nose[:,2] = 0.0
+    nose /= np.maximum(np.linalg.norm(nose, axis=1), 1e-9)[:,None]
+    along = np.repeat(nose[:,None,:], 3, axis=1)
+    cosa, sina = np.cos(state['dr']), np.sin(state['dr'])
+    along[:,0,0] = cosa*nose[:,0] - sina*nose[:,1]
+    along[:,0,1] = sina*nose[:,0] + cosa*nose[:,1]
+    across = np.zeros_like(along)
+    across[:,:,0] = -along[:,:,1]
+    across[:,:,1] = along[:,:,0]
+    up = np.zeros_like(along)
+    up[:,:,2] = -1.0
+
+    # inverse inertia in world axes
+    Iinv = np.einsum('nij,njk,nlk->nil', R, state['Iinv'], R)
+    minv = state['minv']
+
+    def jacobian(d, arm):
+        # linear and angular parts, and the effective mass matrix
+        Ja = np.cross(arm, d)
+        A = np.einsum('nik,njk->nij', d, d)*minv[:,None,None] + \
+            np.einsum('nik,nkl,njl->nij', Ja, Iinv, Ja)
+        return Ja, A
+
+    def response(d, Ja, F, T):
+        # constraint accelerations for a force and torque on the cg
+        return np.einsum('nik,nk->ni', d, F*minv[:,None]) + \
+            np.einsum('nik,nk->ni', Ja, np.einsum('nij,nj->ni', Iinv, T))
+
+    # constraints, per runner normal and across: (n, 6, 3)
+    d = np.stack((up, across), axis=2).reshape((n, 6, 3))
+    arm = np.repeat(rc, 2, axis=1)
+    Ja, A = jacobian(d, arm)
+    A += np.eye(6)*(cfm/dt)
+    u = np.einsum('nik,nk->ni', d, state['vel']) + \
+        np.einsum('nik,nk->ni', Ja, state['omg'])
+    target = np.zeros((n, 6))
+    target[:,0::2] = erp*np.maximum(depth, 0.0)/dt
+
+    # friction along the runners is not a constraint, but a force of at
+    # most mu times the normal force, that would stop the runner within
+    # the step
+    Jaa, Aa = jacobian(along, rc)
+    ua = np.einsum('nik,nk->ni', along, state['vel']) + \
+        np.einsum('nik,nk->ni', Jaa, state['omg'])
+    stop = -ua/(dt*np.diagonal(Aa, axis1=1, axis2=2))
+
+    eye = np.eye(6, dtype=bool)
+    Fext, Text = state['F'], state['T']
+    normal = np.zeros((n, 3))
+    for sweep in range(2):
+        # along-runner friction, from the normal forces of the first pass
+        fa = np.clip(stop, -_mu*normal, _mu*normal)
+        F = Fext + np.einsum('ni,nik->nk', fa, along)
+        T = Text + np.einsum('ni,nik->nk', fa, np.cross(rc, along))
+        b = (target - u)/dt - response(d, Ja, F, T)
+
+        # active set; runners off the ice have no force, the side force
+        # of sliding runners is mu2 times their normal force
+        fixed = np.repeat(depth < 0.0, 2, axis=1)
+        sliding = np.zeros((n, 3))
+        for it in range(iterations):
+            Af = np.where(fixed[:,:,None], eye[None,:,:], A)
+            Af[:,1::2,0::2] -= _mu2*sliding[:,:,None]*np.eye(3)
+            bf = np.where(fixed, 0.0, b)
+            lam = np.linalg.solve(Af, bf[:,:,None])[:,:,0]
+
+            # runners that pull lift off, the one pulling hardest first;
+            # side force beyond mu2 times the normal force slides
+            pull = np.where(fixed[:,0::2], 0.0, lam[:,0::2])
+            lift = np.zeros((n, 3), dtype=bool)
+            worst = np.argmin(pull, axis=1)
+            lift[np.arange(n), worst] = pull[np.arange(n), worst] < 0.0
+            limit = _mu2*np.maximum(lam[:,0::2], 0.0)
+            slide = ~fixed[:,1::2] & (np.abs(lam[:,1::2]) > limit)
+            if not np.any(lift) and not np.any(slide):
+                break
+            sliding = np.where(slide, np.sign(lam[:,1::2]), sliding)
+            sliding[lift] = 0.0
+            fixed[:,1::2] |= slide
+            fixed |= np.repeat(lift, 2, axis=1)
+        normal = lam[:,0::2]
+
+    F = np.einsum('ni,nik->nk', lam, d) + np.einsum('ni,nik->nk', fa, along)
+    T = np.einsum('ni,nik->nk', lam, Ja) + \
+        np.einsum('ni,nik->nk', fa, np.cross(rc, along))
+    return F, T, normal
+
+
+class FleetSkates:
+    '''
+    Analytic runner forces for the craft of a simulation on open ice
+    '''
+
+    def __init__(self, world, space, erp: float = 0.8, cfm: float = 1E-5,
+                 margin: float = 10.0) -> None:
+        '''
+        Create a runner force calculation
+
+        Parameters
+        ----------
+        world : ode.World
+            Dynamics world, for the gravity.
+        space : ode.Space
+            Top-level collision space; its terrain and obstacle geoms
+            decide where the ODE contacts are used.
+        erp : float
+            Error reduction parameter, normally that of the world.
+        cfm : float
+            Constraint force mixing, normally that of the world.
+        margin : float [m]
+            Distance from the craft cg to the bounding box of terrain or
+            obstacles below which the ODE contacts are used.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.world = world
+        self.space = space
+        self.erp = erp
+        self.cfm = cfm
+        self.margin = margin
+        self.craft = []
+        self.analytic = np.zeros((0,), dtype=bool)
+        self.state = np.zeros((0,), dtype=skate_dtype)
+        self.N = np.zeros((0, 3))
+        self._nspace = -1
+        self._static = np.zeros((0, 6))
+
+    def add(self, craft) -> None:
+        '''
+        Add a craft; it starts with the ODE contacts
+        '''
+        self.craft.append(craft)
+        self.analytic = np.append(self.analytic, False)
+        self._resize()
+
+    def remove(self, craft) -> None:
+        '''
+        Remove a craft, and restore its ODE contacts
+        '''
+        i = self.craft.index(craft)
+        self._setMode(craft, False)
+        del self.craft[i]
+        self.analytic = np.delete(self.analytic, i)
+        self._resize()
+
+    def _resize(self) -> None:
+        '''
+        New state array, with the constant data of each craft
+        '''
+        self.state = st = np.zeros((len(self.craft),), dtype=skate_dtype)
+        self.N = np.zeros((len(self.craft), 3))
+        for i, c in enumerate(self.craft):
+            m = c.body.getMass()
+            st['minv'][i] = 1.0/m.mass
+            st['Iinv'][i] = np.linalg.inv(np.array(m.I))
+            st['skates'][i] = [ s for s, name in c.xscates ]
+            st['radius'][i] = [ s.getRadius() for s in c.skate ]
+
+    def _skates(self, craft):
+        # the skate transforms come first in the craft's geoms
+        return craft.trans[:len(craft.xscates)]
+
+    def _setMode(self, craft, analytic: bool) -> None:
+        from icesailer import COLLIDES, CAT_SKATE, CAT_GROUND
+        mask = COLLIDES[CAT_SKATE]
+        if analytic:
+            mask &= ~CAT_GROUND
+        for t in self._skates(craft):
+            t.setCollideBits(mask)
+
+    def _staticBoxes(self):
+        '''
+        Bounding boxes of terrain and obstacles, updated when geoms are
+        added to or removed from the top-level space; terrain entirely
+        below the ice cannot touch the runners, and is skipped
+        '''
+        from icesailer import CAT_TERRAIN, CAT_OBSTACLE, geomCategory
+        ngeoms = self.space.getNumGeoms()
+        if ngeoms != self._nspace:
+            self._nspace = ngeoms
+            boxes = []
+            for i in range(ngeoms):
+                g = self.space.getGeom(i)
+                cat = geomCategory(g)
+                if cat == CAT_OBSTACLE or \
+                   (cat == CAT_TERRAIN and g.getAABB()[4] < 0.0):
+                    boxes.append(g.getAABB())
+            self._static = np.array(boxes).reshape((-1, 6))
+        return self._static
+
+    def gather(self) -> None:
+        '''
+        Copy the ODE state of all craft into the state array
+        '''
+        st = self.state
+        gravity = self.world.getGravity()
+        for i, c in enumerate(self.craft):
+            st['pos'][i] = c.body.getPosition()
+            st['vel'][i] = c.body.getLinearVel()
+            st['omg'][i] = c.body.getAngularVel()
+            st['R'][i].flat = c.body.getRotation()
+            st['F'][i] = c.body.getForce()
+            st['T'][i] = c.body.getTorque()
+            st['dr'][i] = c.dr
+        st['F'] += np.array(gravity)/st['minv'][:,None]
+
+    def apply(self, dt: float):
+        '''
+        Decide the contact mode of each craft, and apply the analytic
+        runner forces; call after the other forces, before world.step
+
+        Parameters
+        ----------
+        dt : float [s]
+            Time step.
+
+        Returns
+        -------
+        array of bool
+            For each craft, True when the analytic forces were applied.
+        '''
+        if not self.craft:
+            return self.analytic
+        self.gather()
+        st = self.state
+
+        # craft away from terrain and obstacle boxes use the analytic model
+        boxes = self._staticBoxes()
+        x, y = st['pos'][:,0:1], st['pos'][:,1:2]
+        m = self.margin
+        near = np.any((x > boxes[None,:,0] - m) & (x < boxes[None,:,1] + m) &
+                      (y > boxes[None,:,2] - m) & (y < boxes[None,:,3] + m),
+                      axis=1)
+        for i in np.flatnonzero(self.analytic == near):
+            self._setMode(self.craft[i], not near[i])
+        self.analytic = ~near
+
+        self.N[:] = 0.0
+        idx = np.flatnonzero(self.analytic)
+        if not len(idx):
+            return self.analytic
+        F, T, N = runnerForces(st[idx], dt, self.erp, self.cfm)
+        self.N[idx] = N
+        for i, f, t in zip(idx, F, T):
+            body = self.craft[i].body
+            body.addForce(f)
+            body.addTorque(t)
+        return self.analytic
+
+
+if __name__ == '__main__':
+
+    import time
+    from icesailer import Wind
+    from simulation import Simulation
+
+    # the same craft with ODE runner contacts and analytic runner forces
+    res = []
+    for model in ('ode', 'analytic'):
+        sim = Simulation(Wind((-5, 0, 0)), skates=model)
+        for i in range(20):
+            c = sim.newCraft((0.0, 50.0*i, -0.8), (0.0, 0.0, np.radians(80)))
+            c.updateMainsheet(0.1)
+        track = []
+        t0 = time.perf_counter()
+        for it in range(int(round(30.0/sim.dt))):
+            sim.step()
+            if it % 60 == 59:
+                track.append(sim.craft[0].body.getPosition())
+        wall = time.perf_counter() - t0
+        res.append(np.array(track))
+        v = np.linalg.norm(sim.craft[0].body.getLinearVel())
+        print(f"{model:8s}: {sim.time:.1f}s simulated in {wall:.2f}s, "
+              f"speed after 30 s {v:.2f} m/s")
+    dev = np.linalg.norm(res[1][:,:2] - res[0][:,:2], axis=1)
+    print(f"track difference, maximum {dev.max():.2f} m, "
+          f"at the end {dev[-1]:.2f} m")
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from wireformat import encode
+
+"""
+Compact coding of craft state updates
+
+The 15 floats of an update (position, quaternion, linear and angular
+velocity, dr, ds; 60 bytes) are quantized:
+
+- position in mm, relative to the course origin; 32 bit in a keyframe,
+  16 bit offsets from the last keyframe position in a delta
+- quaternion with "smallest three" compression; index of the largest
+  component in 2 bits, the other three in 10 bits each
+- linear velocity in cm/s, angular velocity in mrad/s, dr and ds in
+  0.1 mrad, all 16 bit
+
+A keyframe (message "K") takes 32 bytes, a delta (message "Q") 26
+bytes. A sender sends a keyframe at a fixed interval, or when the
+position offset no longer fits a delta; in between it sends deltas,
+and nothing at all when the state did not change more than a
+dead band since the last message sent.
+
+The maximum quantization errors are given in ERRORBOUND; measureError
+checks these on random states.
+
+A client asks for compact coding by setting the QUANTIZED flag in the
+sequence number field of its binary birth message. The server keeps a
+StateDecoder per client, and sends snapshots ("Z") to these clients
+with for each craft the id (16 bit) and a keyframe record. Positions
+are relative to the course origin, the origin of the world coordinates.
+"""
+
+# flag in the birth message, client sends and accepts compact messages
+QUANTIZED = 0x1
+
+# scaling of the quantized values
+_posscale = 1000.0          # mm
+_velscale = 100.0           # cm/s
+_omgscale = 1000.0          # mrad/s
+_ctlscale = 10000.0         # 0.1 mrad
+_qrange = np.sqrt(0.5)      # range of the smallest three
+_qbits = 1023
+
+# record formats
+key_dtype = np.dtype([
+    ('pos', '<i4', (3,)), ('quat', '<u4'),
+    ('vel', '<i2', (3,)), ('omg', '<i2', (3,)), ('ctl', '<i2', (2,))])
+delta_dtype = np.dtype([
+    ('pos', '<i2', (3,)), ('quat', '<u4'),
+    ('vel', '<i2', (3,)), ('omg', '<i2', (3,)), ('ctl', '<i2', (2,))])
+snap_dtype = np.dtype([('id', '<u2'), ('key', key_dtype)])
+
+# maximum absolute error, per state element group; position includes the
+# float32 resolution up to 4 km from the origin, the largest quaternion
+# component adds the errors of the other three, divided by its value
+# (at least 0.5)
+ERRORBOUND = dict(
+    pos=0.5/_posscale + 2.0**-12,
+    quat=3.0*_qrange*(_qrange/_qbits)/0.5,
+    vel=0.5/_velscale,
+    omg=0.5/_omgscale,
+    ctl=0.5/_ctlscale)
+
+
+def _quantize(v, scale, dtype):
+    info = np.iinfo(dtype)
+    return np.clip(np.round(v*scale), info.min, info.max).astype(dtype)
+
+
+def packQuaternion(q):
+    '''
+    Smallest-three compression of (n, 4) quaternions into uint32
+    '''
+    q = np.atleast_2d(np.asarray(q, dtype=float))
+    q = q / np.linalg.norm(q, axis=1)[:,None]
+    imax = np.argmax(np.abs(q), axis=1)
+    n = np.arange(len(q))
+    q = q * np.where(q[n, imax] < 0, -1.0, 1.0)[:,None]
+    others = np.array([[j for j in range(4) if j != i] for i in range(4)])
+    small = q[n[:,None], others[imax]]
+    u = np.clip(np.round((small + _qrange)/(2*_qrange)*_qbits),
+                0, _qbits).astype(np.uint32)
+    return ((imax.astype(np.uint32) << 30) | (u[:,0] << 20) |
+            (u[:,1] << 10) | u[:,2])
+
+
+def unpackQuaternion(p):
+    '''
+    Expand smallest-three coded quaternions, returns (n, 4) array
+    '''
+    p = np.atleast_1d(np.asarray(p, dtype=np.uint32))
+    imax = (p >> 30).astype(int)
+    small = np.stack(((p >> 20) & 0x3ff, (p >> 10) & 0x3ff, p & 0x3ff),
+                     axis=1)*(2*_qrange/_qbits) - _qrange
+    q = np.empty((len(p), 4))
+    n = np.arange(len(p))
+    others = np.array([[j for j in range(4) if j != i] for i in range(4)])
+    q[n[:,None], others[imax]] = small
+    q[n, imax] = np.sqrt(np.maximum(0.0, 1.0 - np.sum(small*small, axis=1)))
+    return q / np.linalg.norm(q, axis=1)[:,None]
+
+
+def quantize(states, origin=(0.0, 0.0, 0.0)):
+    '''
+    Quantize (n, 15) states into keyframe records
+    '''
+    states = np.atleast_2d(states)
+    rec = np.zeros((len(states),), dtype=key_dtype)
+    rec['pos'] = _quantize(states[:,:3] - origin, _posscale, np.int32)
+    rec['quat'] = packQuaternion(states[:,3:7])
+    rec['vel'] = _quantize(states[:,7:10], _velscale, np.int16)
+    rec['omg'] = _quantize(states[:,10:13], _omgscale, np.int16)
+    rec['ctl'] = _quantize(states[:,13:15], _ctlscale, np.int16)
+    return rec
+
+
+def dequantize(rec, origin=(0.0, 0.0, 0.0), keypos=None):
+    '''
+    Convert keyframe or delta records back to (n, 15) float32 states
+
+    Parameters
+    ----------
+    rec : array of key_dtype or delta_dtype
+        Coded records.
+    origin : 3 floats
+        Course origin.
+    keypos : array of int32, optional
+        Quantized position of the last keyframe; needed for deltas.
+    '''
+    rec = np.atleast_1d(rec)
+    pos = rec['pos'].astype(np.int64)
+    if keypos is not None:
+        pos = pos + keypos
+    states = np.empty((len(rec), 15), dtype=np.float32)
+    states[:,:3] = pos/_posscale + np.asarray(origin)
+    states[:,3:7] = unpackQuaternion(rec['quat'])
+    states[:,7:10] = rec['vel']/_velscale
+    states[:,10:13] = rec['omg']/_omgscale
+    states[:,13:15] = rec['ctl']/_ctlscale
+    return states
+
+
+class StateEncoder:
+    '''
+    Keyframe/delta coding of the updates of one craft
+    '''
+
+    def __init__(self, origin=(0.0, 0.0, 0.0), keyinterval: int = 30,
+                 deadband=(0.002, 0.001, 0.01, 0.01, 0.001)) -> None:
+        '''
+        Create an encoder
+
+        Parameters
+        ----------
+        origin : 3 floats
+            Course origin [m].
+        keyinterval : int
+            Number of updates after which a keyframe is sent.
+        deadband : 5 floats
+            Changes in position [m], quaternion, velocity [m/s], angular
+            velocity [rad/s] and controls [rad] below which no update is
+            sent.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.origin = np.asarray(origin, dtype=float)
+        self.keyinterval = keyinterval
+        self.deadband = np.repeat(deadband, (3, 4, 3, 3, 2))
+        self.count = keyinterval
+        self.keypos = None
+        self.lastsent = None
+
+    def encode(self, idx: int, seq: int, state, force: bool = False):
+        '''
+        Code a state update
+
+        Parameters
+        ----------
+        idx : int
+            Craft id.
+        seq : int
+            Sequence number.
+        state : array of float
+            Position, quaternion, velocity, rotation, dr, ds.
+        force : bool
+            Send a keyframe, e.g. when the previous one was not sent.
+
+        Returns
+        -------
+        bytes or None
+            Keyframe or delta message; None if the change is within the
+            dead band, and no keyframe is due.
+        '''
+        state = np.asarray(state, dtype=float)
+        self.count = self.keyinterval if force else self.count + 1
+        if self.count < self.keyinterval and \
+           np.all(np.abs(state - self.lastsent) < self.deadband):
+            return None
+
+        rec = quantize(state, self.origin)
+        if self.count < self.keyinterval:
+            dpos = rec['pos'][0].astype(np.int64) - self.keypos
+            if np.all(np.abs(dpos) <= np.iinfo(np.int16).max):
+                delta = np.zeros((1,), dtype=delta_dtype)
+                for f in ('quat', 'vel', 'omg', 'ctl'):
+                    delta[f] = rec[f]
+                delta['pos'] = dpos
+                self.lastsent = state
+                return encode(b'Q', idx, seq, delta.tobytes())
+
+        # keyframe
+        self.count = 0
+        self.keypos = rec['pos'][0].astype(np.int64)
+        self.lastsent = state
+        return encode(b'K', idx, seq, rec.tobytes())
+
+
+class StateDecoder:
+    '''
+    Decoding of keyframe/delta updates of one craft
+    '''
+
+    def __init__(self, origin=(0.0, 0.0, 0.0)) -> None:
+        self.origin = np.asarray(origin, dtype=float)
+        self.keypos = None
+
+    def decode(self, mtype: bytes, data: bytes):
+        '''
+        Decode the payload of a K or Q message
+
+        Returns
+        -------
+        array of float32, or None
+            The 15 state values; None for a delta before any keyframe.
+        '''
+        if mtype == b'K':
+            rec = np.frombuffer(data, dtype=key_dtype)
+            self.keypos = rec['pos'][0].astype(np.int64)
+            return dequantize(rec, self.origin)[0]
+        if self.keypos is None:
+            return None
+        rec = np.frombuffer(data, dtype=delta_dtype)
+        return dequantize(rec, self.origin, self.keypos)[0]
+
+
+def encodeSnapshot(tick: int, ids, states, origin=(0.0, 0.0, 0.0)) -> bytes:
+    '''
+    Code a snapshot of (n, 15) craft states, as keyframe records
+    '''
+    rec = np.zeros((len(ids),), dtype=snap_dtype)
+    rec['id'] = ids
+    rec['key'] = quantize(states, origin)
+    return encode(b'Z', len(rec), tick, rec.tobytes())
+
+
+def decodeSnapshot(data: bytes, origin=(0.0, 0.0, 0.0)):
+    '''
+    Decode the payload of a Z message, returns ids and (n, 15) states
+    '''
+    rec = np.frombuffer(data, dtype=snap_dtype)
+    return rec['id'], dequantize(rec['key'], origin)
+
+
+def measureError(n: int = 100000, seed: int = 1) -> dict:
+    '''
+    Measure the coding error on random states
+
+    Returns
+    -------
+    dict
+        Maximum absolute error per group, for keyframes and deltas.
+    '''
+    rng = np.random.default_rng(seed)
+    states = np.zeros((n, 15))
+    states[:,:3] = rng.uniform(-3000, 3000, (n, 3))
+    q = rng.normal(size=(n, 4))
+    states[:,3:7] = q / np.linalg.norm(q, axis=1)[:,None]
+    states[:,7:10] = rng.uniform(-50, 50, (n, 3))
+    states[:,10:13] = rng.uniform(-10, 10, (n, 3))
+    states[:,13:15] = rng.uniform(-1, 1, (n, 2))
+
+    key = quantize(states)
+    keypos = key['pos'].astype(np.int64)
+    moved = states.copy()
+    moved[:,:3] += rng.uniform(-30, 30, (n, 3))
+    delta = np.zeros((n,), dtype=delta_dtype)
+    delta['pos'] = quantize(moved)['pos'] - keypos
+    for f in ('quat', 'vel', 'omg', 'ctl'):
+        delta[f] = key[f]
+
+    res = dict()
+    for kind, ref, dec in (
+            ('key', states, dequantize(key)),
+            ('delta', moved, dequantize(delta, keypos=keypos))):
+        # q and -q are the same attitude
+        qsign = np.sign(np.sum(dec[:,3:7]*ref[:,3:7], axis=1))
+        err = np.abs(dec - ref)
+        err[:,3:7] = np.abs(dec[:,3:7]*qsign[:,None] - ref[:,3:7])
+        for g, sl in (('pos', slice(0, 3)), ('quat', slice(3, 7)),
+                      ('vel', slice(7, 10)), ('omg', slice(10, 13)),
+                      ('ctl', slice(13, 15))):
+            res[f'{kind} {g}'] = np.max(err[:,sl])
+    return res
+
+
+if __name__ == '__main__':
+
+    print(f"keyframe {key_dtype.itemsize} bytes, "
+          f"delta {delta_dtype.itemsize} bytes, float update 60 bytes")
+    for k, v in measureError().items():
+        print(f"{k:10s} max error {v:.2e}, bound "
+              f"{ERRORBOUND[k.split()[1]]:.2e}")
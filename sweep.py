@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Parameter sweep for polar diagrams of the ice sailer
+
+A grid of (wind speed x mainsheet x heading) points is simulated with
+headless Simulation objects. Each task covers one wind speed and
+mainsheet setting, with one craft per heading, and runs in its own
+worker process with its own ODE world. The results are collected in
+one compact dataset, with the VMG surfaces, and saved as .npz.
+
+The wind blows from the north (towards -x); a heading of 0 deg is
+thus straight into the wind.
+'''
+
+# spacing between the craft in one world, far enough to never meet
+_spacing = 5000.0
+
+
+def quaternionHeading(q):
+    '''
+    Heading (yaw angle) from ODE quaternions
+
+    Parameters
+    ----------
+    q : array of float (..., 4)
+        Quaternions, (qW, qx, qy, qz).
+
+    Returns
+    -------
+    array of float [rad]
+        Heading, from -pi to pi.
+    '''
+    qW, qx, qy, qz = np.moveaxis(np.asarray(q, dtype=float), -1, 0)
+    return np.arctan2(2.0*(qx*qy + qW*qz),
+                      qW*qW + qx*qx - qy*qy - qz*qz)
+
+
+def sweepPoint(wspeed: float, ds: float, headings,
+               span: float = 60.0, average: float = 10.0):
+    '''
+    Simulate one wind speed and mainsheet setting, for all headings
+
+    Parameters
+    ----------
+    wspeed : float [m/s]
+        True wind speed, wind from the north.
+    ds : float
+        Mainsheet setting, see IceSailer.updateMainsheet.
+    headings : sequence of float [deg]
+        Initial headings of the craft. The rudder is kept straight.
+    span : float [s]
+        Simulated time. The default is 60.0.
+    average : float [s]
+        Final part of the run over which speeds are averaged. The
+        default is 10.0.
+
+    Returns
+    -------
+    dict of arrays
+        V: mean speed [m/s], Vmg: mean velocity made good upwind [m/s],
+        psi: final heading [rad], sail: final sail angle [rad], all with
+        one value per heading.
+    '''
+    from icesailer import Wind
+    from simulation import Simulation
+
+    wind = np.array((-wspeed, 0.0, 0.0))
+    sim = Simulation(Wind(wind))
+    for i, hdg in enumerate(headings):
+        c = sim.newCraft((0.0, _spacing*i, -0.8),
+                         (0.0, 0.0, np.radians(hdg)))
+        c.updateMainsheet(ds)
+
+    # run-in, then average over the final part of the run
+    sim.run(span - average)
+    vsum = np.zeros((len(headings), 3))
+
+    def record(sim):
+        for i, c in enumerate(sim.craft):
+            vsum[i] += c.body.getLinearVel()
+
+    nav = int(round(average/sim.dt))
+    sim.run(average, callback=record)
+    vel = vsum[:,:2] / nav
+    wdir = wind[:2] / max(wspeed, 1e-9)
+
+    psi = quaternionHeading([ c.body.getQuaternion() for c in sim.craft ])
+    return dict(V=np.sqrt(np.sum(vel*vel, axis=1)),
+                Vmg=-vel @ wdir, psi=psi,
+                sail=np.array([c._ds for c in sim.craft]))
+
+
+def polarSweep(headings, mainsheets, windspeeds,
+               span: float = 60.0, average: float = 10.0,
+               workers: int = None) -> dict:
+    '''
+    Run a polar sweep over a process pool
+
+    Parameters
+    ----------
+    headings : sequence of float [deg]
+        Initial headings, relative to the wind.
+    mainsheets : sequence of float
+        Mainsheet settings.
+    windspeeds : sequence of float [m/s]
+        True wind speeds.
+    span : float [s]
+        Simulated time per run.
+    average : float [s]
+        Final part of each run over which speeds are averaged.
+    workers : int, optional
+        Number of worker processes. The default is the number of CPUs.
+
+    Returns
+    -------
+    dict of arrays
+        Grid axes, results with shape (wind, mainsheet, heading), and
+        the VMG surfaces, maximised over the mainsheet setting.
+    '''
+    headings = np.asarray(headings, dtype=np.float32)
+    mainsheets = np.asarray(mainsheets, dtype=np.float32)
+    windspeeds = np.asarray(windspeeds, dtype=np.float32)
+    shape = (len(windspeeds), len(mainsheets), len(headings))
+    res = dict(V=np.zeros(shape, dtype=np.float32),
+               Vmg=np.zeros(shape, dtype=np.float32),
+               psi=np.zeros(shape, dtype=np.float32),
+               sail=np.zeros(shape, dtype=np.float32))
+
+    with ProcessPoolExecutor(workers) as executor:
+        tasks = {
+            executor.submit(sweepPoint, float(w), float(ds), headings,
+                            span, average): (iw, ids)
+            for iw, w in enumerate(windspeeds)
+            for ids, ds in enumerate(mainsheets) }
+        for ndone, f in enumerate(as_completed(tasks)):
+            iw, ids = tasks[f]
+            for k, v in f.result().items():
+                res[k][iw, ids] = v
+            print(f"sweep {ndone+1}/{len(tasks)}, wind "
+                  f"{windspeeds[iw]:.1f} m/s, mainsheet {mainsheets[ids]:.2f}")
+
+    # best mainsheet setting per wind speed and heading
+    best = np.argmax(res['V'], axis=1)[:,None,:]
+    res['Vbest'] = np.take_along_axis(res['V'], best, axis=1)[:,0,:]
+    res['dsbest'] = mainsheets[best[:,0,:]]
+
+    # VMG surfaces, up- and downwind, and the best headings
+    res['Vmgup'] = np.max(res['Vmg'], axis=1)
+    res['Vmgdown'] = np.min(res['Vmg'], axis=1)
+    res['hdgup'] = headings[np.argmax(res['Vmgup'], axis=1)]
+    res['hdgdown'] = headings[np.argmin(res['Vmgdown'], axis=1)]
+
+    res.update(headings=headings, mainsheets=mainsheets,
+               windspeeds=windspeeds)
+    return res
+
+
+def savePolar(fname: str, res: dict) -> None:
+    '''
+    Save a polar dataset as compressed .npz
+    '''
+    np.savez_compressed(fname, **res)
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    fname = sys.argv[1] if len(sys.argv) > 1 else 'polar.npz'
+
+    t0 = time.perf_counter()
+    res = polarSweep(headings=np.arange(0, 360, 10),
+                     mainsheets=np.linspace(0.05, 1.0, 8),
+                     windspeeds=(3.0, 5.0, 8.0))
+    savePolar(fname, res)
+    print(f"polar saved to {fname}, in {time.perf_counter()-t0:.1f}s")
+    for w, up, hup, down, hdown in zip(
+            res['windspeeds'], res['Vmgup'].max(axis=1), res['hdgup'],
+            res['Vmgdown'].min(axis=1), res['hdgdown']):
+        print(f"wind {w} m/s: upwind VMG {up:.1f} m/s at {hup} deg, "
+              f"downwind VMG {-down:.1f} m/s at {hdown} deg")
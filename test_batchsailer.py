@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Planar batch model against the ODE model, on the testsails.py circle
+
+36 craft start on a 250 m circle, each heading outward, with the sheet
+at 0.1 and the rudder straight, in a 5 m/s wind from the north. Over
+60 s, the batch model must follow each ODE craft within 15 m, and end
+within 5% plus 0.5 kts of its speed. The runner friction is also
+checked without ODE.
+'''
+
+import numpy as np
+import pytest
+import batchsailer
+from batchsailer import BatchSailers, paramsFromCraft
+
+
+def test_rear_friction_damps_yaw():
+    # turning in place, the rear runners slide in opposite directions,
+    # and their friction opposes the yaw rate
+    batch = BatchSailers(2)
+    batch.r[:] = (0.002, -0.002)
+    fu, fv, mz = batch._runnerFriction(np.ones(2), np.zeros(2))
+    slip = batch.yr*0.002/batchsailer._vslip
+    assert mz == pytest.approx(
+        np.array((-1.0, 1.0))*2*batch.yr*batchsailer._mu*batch.Nr*slip)
+    assert fu == pytest.approx(0.0, abs=1e-12)
+    assert fv == pytest.approx(0.0, abs=1e-12)
+
+
+def test_circle_against_ode():
+    pytest.importorskip('ode')
+    from icesailer import Wind
+    from simulation import Simulation
+
+    sim = Simulation(Wind((-5, 0, 0)))
+    headings = np.radians(np.arange(0, 360, 10))
+    craft = [ sim.newCraft((250*np.cos(hdg), 250*np.sin(hdg), -0.8),
+                           (0.0, 0.0, hdg)) for hdg in headings ]
+    for c in craft:
+        c.updateMainsheet(0.1)
+    batch = BatchSailers(len(craft), paramsFromCraft(craft[0]), sim.dt)
+    batch.x[:] = 250*np.cos(headings)
+    batch.y[:] = 250*np.sin(headings)
+    batch.psi[:] = headings
+    batch.updateMainsheet(0.1)
+
+    dev = np.zeros(len(craft))
+    for it in range(int(round(60.0/sim.dt))):
+        sim.step()
+        batch.step(sim.wind.speed((0, 0, 0)))
+        if it % 12 == 11:
+            xy = np.array([ c.body.getPosition()[:2] for c in craft ])
+            dev = np.maximum(dev, np.hypot(xy[:,0] - batch.x,
+                                           xy[:,1] - batch.y))
+
+    V = np.array([ c.V for c in craft ])
+    assert dev.max() < 15.0
+    assert np.all(np.abs(batch.V - V) < 0.05*V + 0.5)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Terrain extraction from egg files, bulk and vertex by vertex
+
+The bulk path goes through Panda3D geometry, in Panda3D's default axes;
+it must give the same mesh, in the axes of the egg file, as walking the
+egg data, also for the Y-Up-Left eggs written by x2egg.
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('panda3d.egg')
+pytest.importorskip('ode')
+import odegrid
+
+
+def _writeGrid(fname, cs, n=4, size=10.0):
+    '''
+    Small terrain egg with the Grid layout, heights on the up axis
+    '''
+    rng = np.random.default_rng(3)
+    lines = [f'<CoordinateSystem> {{ {cs} }}', '<Group> Root {',
+             '<Group> Grid {', '<Group> GridMesh {', '<VertexPool> Grid {']
+    index = dict()
+    for i in range(n):
+        for j in range(n):
+            h = rng.uniform(-1.0, 3.0)
+            p = (i*size, h, j*size) if cs.startswith('Y') else \
+                (i*size, j*size, h)
+            index[i,j] = len(index)
+            lines.append(f'<Vertex> {index[i,j]} {{ {p[0]} {p[1]} {p[2]} }}')
+    lines.append('}')
+    for i in range(n-1):
+        for j in range(n-1):
+            for tri in ((index[i,j], index[i+1,j], index[i+1,j+1]),
+                        (index[i,j], index[i+1,j+1], index[i,j+1])):
+                lines.append('<Polygon> { <VertexRef> { %d %d %d '
+                             '<Ref> { Grid } } }' % tri)
+    lines += ['}', '}', '}']
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _triangles(verts, faces):
+    '''
+    Set of triangles as vertex positions, each starting at its lowest
+    vertex, so that the vertex numbering does not matter but the
+    winding does
+    '''
+    res = set()
+    for tri in np.round(verts[faces], 3):
+        tri = [ tuple(p) for p in tri ]
+        k = tri.index(min(tri))
+        res.add(tuple(tri[k:] + tri[:k]))
+    return res
+
+
+@pytest.mark.parametrize('cs', ['Y-Up-Left', 'Z-Up'])
+def test_bulk_matches_walk(tmp_path, cs):
+    eggfile = str(tmp_path / 'terrain.egg')
+    _writeGrid(eggfile, cs)
+    wverts, wfaces = odegrid._eggWalk(eggfile)
+    bverts, bfaces = odegrid._bulkExtract(eggfile)
+    assert np.allclose(np.unique(wverts, axis=0), bverts, atol=1e-5)
+    assert _triangles(wverts, wfaces) == _triangles(bverts, bfaces)
+
+
+def test_terrain_heights_yup(tmp_path):
+    # the egg's up axis (y) becomes ODE's down axis (z)
+    eggfile = str(tmp_path / 'terrain.egg')
+    _writeGrid(eggfile, 'Y-Up-Left')
+    verts, faces = odegrid.terrainMesh(eggfile, cache=False)
+    assert verts[:,2].min() >= -3.0 and verts[:,2].max() <= 1.0
+    assert np.ptp(verts[:,0]) == pytest.approx(30.0)
+    assert np.ptp(verts[:,1]) == pytest.approx(30.0)
+    assert len(faces) == 18
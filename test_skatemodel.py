@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Analytic runner forces, against statics and against the ODE contacts
+
+The checks on runnerForces need NumPy only; they use the geometry and
+mass of the standard IceSailer, standing on the ice. The comparison
+with the ODE skate contacts needs pyode.
+'''
+
+import numpy as np
+import pytest
+import skatemodel
+from skatemodel import runnerForces, skate_dtype
+
+# standard ice sailer, see IceSailer.__init__
+mass = 250.0
+g0 = 9.813
+length, width, height = 5.3, 5.0, 0.8
+skates = [(2.5, 0.0, 0.5), (-2.8, -2.3, 0.5), (-2.8, 2.3, 0.5)]
+dt = 1.0/120
+
+
+def _resting(force=(0.0, 0.0, 0.0), vel=(0.0, 0.0, 0.0)):
+    '''
+    State of a craft level on the ice, with gravity and an extra force
+    '''
+    st = np.zeros((1,), dtype=skate_dtype)
+    st['pos'] = (0.0, 0.0, -0.8)
+    st['vel'] = vel
+    st['R'] = np.eye(3)
+    st['F'] = np.array(force) + (0.0, 0.0, mass*g0)
+    st['minv'] = 1.0/mass
+    st['Iinv'] = np.diag(12.0/mass/np.array(
+        (width**2 + height**2, length**2 + height**2, length**2 + width**2)))
+    st['skates'] = skates
+    st['radius'] = 0.3
+    return st
+
+
+def test_static_load_share():
+    # runners share the weight by the distance to the cg
+    F, T, N = runnerForces(_resting(), dt, cfm=1e-8)
+    assert N.sum() == pytest.approx(mass*g0, rel=1e-3)
+    assert N[0,0]/N.sum() == pytest.approx(2.8/5.3, rel=1e-4)
+    assert N[0,1] == pytest.approx(N[0,2])
+    assert F[0] == pytest.approx((0.0, 0.0, -mass*g0), abs=1e-2*mass*g0)
+    assert np.abs(T).max() < 1e-3*mass*g0
+
+
+def test_side_force_lifts_windward_runner():
+    # a side force at the cg, above the runners, unloads the left runner
+    F, T, N = runnerForces(_resting((0.0, 0.5*mass*g0, 0.0)), dt, cfm=1e-8)
+    assert 0.0 < N[0,1] < N[0,2]
+    assert F[0,1] == pytest.approx(-0.5*mass*g0, rel=1e-3)
+
+    # and lifts it when the heeling moment exceeds the righting moment
+    F, T, N = runnerForces(_resting((0.0, 1.5*mass*g0, 0.0)), dt, cfm=1e-8)
+    assert N[0,1] == 0.0
+    assert N[0,0] > 0.0 and N[0,2] > 0.0
+
+
+@pytest.mark.parametrize('force, vel', [
+    ((0.0, 0.5*mass*g0, 0.0), (0.0, 0.0, 0.0)),
+    ((0.0, 0.0, 0.0), (0.0, 2.0, 0.0))])
+def test_side_force_limit(monkeypatch, force, vel):
+    # with mu2 at 0.1, all runners slide, at 0.1 times the normal force
+    monkeypatch.setattr(skatemodel, '_mu2', 0.1)
+    F, T, N = runnerForces(_resting(force, vel), dt, cfm=1e-8)
+    assert abs(F[0,1]) == pytest.approx(0.1*N.sum(), rel=1e-6)
+    assert F[0,1] < 0.0
+
+
+def test_compare_ode():
+    '''
+    The same craft sailing 30 s with ODE contacts and analytic forces;
+    the tracks differ by less than 1% of the distance sailed plus 0.5 m,
+    and the final speeds by less than 5%
+    '''
+    pytest.importorskip('ode')
+    from icesailer import Wind
+    from simulation import Simulation
+
+    res = []
+    for model in ('ode', 'analytic'):
+        sim = Simulation(Wind((-5, 0, 0)), skates=model)
+        craft = sim.newCraft((0.0, 0.0, -0.8), (0.0, 0.0, np.radians(80)))
+        craft.updateMainsheet(0.1)
+        track = []
+        for it in range(int(round(30.0/sim.dt))):
+            sim.step()
+            if it % 60 == 59:
+                track.append(craft.body.getPosition())
+        res.append((np.array(track)[:,:2],
+                    np.linalg.norm(craft.body.getLinearVel())))
+
+    (track0, v0), (track1, v1) = res
+    sailed = np.linalg.norm(track0[-1] - track0[0])
+    assert sailed > 10.0
+    dev = np.linalg.norm(track1 - track0, axis=1)
+    assert dev.max() < 0.01*sailed + 0.5
+    assert v1 == pytest.approx(v0, rel=0.05)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Heading recovered from the craft quaternion, as stored in a polar sweep
+'''
+
+import numpy as np
+import pytest
+from sweep import quaternionHeading
+
+
+@pytest.mark.parametrize('hdg', [0.0, 30.0, 60.0, 90.0, 135.0, -45.0,
+                                 -170.0])
+def test_heading_roundtrip(hdg):
+    # quaternion for a pure yaw rotation, as in IceSailer.__init__
+    psi = np.radians(hdg)
+    q = (np.cos(0.5*psi), 0.0, 0.0, np.sin(0.5*psi))
+    assert quaternionHeading(q) == pytest.approx(psi)
+
+
+def test_heading_batch():
+    psi = np.radians(np.arange(-170.0, 180.0, 10.0))
+    q = np.stack((np.cos(0.5*psi), np.zeros_like(psi), np.zeros_like(psi),
+                  np.sin(0.5*psi)), axis=1)
+    assert quaternionHeading(q) == pytest.approx(psi)
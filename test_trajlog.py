@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Trajectory files are finished, also when the recorder is never closed
+'''
+
+import os
+import subprocess
+import sys
+import numpy as np
+from trajlog import TrajectoryRecorder, TrajectoryLog, flushAll
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_roundtrip(tmp_path):
+    fname = str(tmp_path / 'craft.trj')
+    rec = TrajectoryRecorder(fname, columns=('t', 'x'), chunk=4)
+    for i in range(10):
+        rec.append(i, 2*i)
+    rec.close()
+    flushAll()
+    log = TrajectoryLog(fname)
+    assert log.complete
+    assert np.array_equal(log.asDict()['x'], 2*np.arange(10))
+
+
+def test_finished_at_exit(tmp_path):
+    # rows still in the buffer when the process ends
+    fname = str(tmp_path / 'craft.trj')
+    subprocess.run(
+        [sys.executable, '-c',
+         'from trajlog import TrajectoryRecorder\n'
+         f'rec = TrajectoryRecorder({fname!r}, columns=("t", "x"))\n'
+         'for i in range(10):\n'
+         '    rec.append(i, 2*i)\n'], cwd=_here, check=True)
+    log = TrajectoryLog(fname)
+    assert log.complete
+    assert np.array_equal(log.asDict()['t'], np.arange(10))
@@ -6,8 +6,8 @@ Created on Tue Jan 28 15:25:07 2020
 @author: repa
 """
 
-import ode
-from iceboat import Wind, IceSailer, coll_callback
+from icesailer import Wind
+from simulation import Simulation
 g0 = 9.80665
 from numpy import radians, cos, sin, zeros, arange, degrees, arctan2, sqrt
 from matplotlib import pyplot as plt
@@ -15,27 +15,16 @@ from matplotlib import pyplot as plt
 if __name__ == '__main__':
     
     #%% set-up the simulations
-    # ode world
-    world = ode.World()
-    world.setERP(0.8)
-    world.setCFM(1E-5)
-    wind = Wind((-5, 0, 0))
-    world.setGravity((0, 0, g0))
-
-    space = ode.Space()
-    ground = ode.GeomPlane(space, (0, 0, -1), 0)
-    ground.nam = "ground"
+    # headless ode world, with ground plane and contacts
+    sim = Simulation(Wind((-5, 0, 0)))
+    sim.world.setGravity((0, 0, g0))
 
     # create 360/<dhdr> craft in a circle with <R> m radius
     dhdr = 10
     R = 250
-    craft = [ IceSailer
-             (world, space, 
+    craft = [ sim.newCraft(
               (R*cos(radians(hdg)), R*sin(radians(hdg)), -0.8), 
               (0.0, 0.0, radians(hdg))) for hdg in range(0,360,dhdr) ]
-    
-    # contacts for skating and collision
-    contactgroup = ode.JointGroup()
 
     # set initial sail & keep rudder straight
     # in a next step, should vary the mainsheet angle, to see which
@@ -44,7 +33,7 @@ if __name__ == '__main__':
         c.updateMainsheet(0.1)
         
     # iterate, 120 Hz, over 60 seconds, record data every 0.1 second
-    rate = 120
+    rate = int(round(1/sim.dt))
     rdiv = 12
     span = 60
 
@@ -62,18 +51,8 @@ if __name__ == '__main__':
     #%% - iterate over 60 seconds of simulation
     for it in range(rate*span):
         
-        # wind effect on sail
-        for c in craft:
-            c.force(wind)
-        
-        # calculate collisions
-        space.collide( (world, contactgroup), coll_callback)
-            
-        # update the world
-        world.step(1/rate)
-
-        # clear contacts for next round
-        contactgroup.empty()
+        # wind effect on sail, collisions and world update
+        sim.step()
  
         if it % rdiv == rdiv - 1:
             idx = it // rdiv
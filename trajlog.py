@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import struct
+import json
+import threading
+import queue
+import time
+import os
+import atexit
+
+'''
+Streaming binary recording of craft trajectories
+
+File layout (.trj), all little endian:
+
+- header: magic b'ICETRJ01', uint32 length of the metadata, metadata
+  as json (name, craft id, column names, start time)
+- chunks: uint32 magic 0x4b4e4843 ("CHNK"), uint32 number of rows n,
+  then per column n float32 values (columnar)
+- footer, written on close: per chunk uint64 file offset and uint32 row
+  count, then uint32 number of chunks, uint64 offset of the footer and
+  magic b'ICETRJND'
+
+Rows are collected in a fixed-size buffer; full buffers, or partial ones
+older than the flush interval, are handed to a single background thread
+that writes them. The server loop never waits for the disk, and the
+memory per recorded craft is one buffer. Recorders still open at exit
+are closed, and their files written, by closeAll. A file without footer
+(after a crash) is still readable, the reader then walks the chunks.
+'''
+
+_magic = b'ICETRJ01'
+_endmagic = b'ICETRJND'
+_chunkmagic = 0x4b4e4843
+_chunkhead = struct.Struct('<II')
+_index = np.dtype([('offset', '<u8'), ('nrows', '<u4')])
+_tail = struct.Struct('<IQ8s')
+
+# default columns, time and the 15 floats of a state update
+STATECOLUMNS = ('t', 'x', 'y', 'z', 'qw', 'qx', 'qy', 'qz',
+                'u', 'v', 'w', 'p', 'q', 'r', 'dr', 'ds')
+
+
+class _Writer:
+    '''
+    Background thread writing the chunks of all recorders
+    '''
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run, name='trajlog', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job, rec, data = self.queue.get()
+            try:
+                if job == 'chunk':
+                    rec._writeChunk(data)
+                else:
+                    rec._writeFooter()
+            except OSError as e:
+                print(f"cannot write trajectory {rec.fname}: {e}")
+            finally:
+                self.queue.task_done()
+
+
+_writer = None
+_writerlock = threading.Lock()
+
+
+def _getWriter() -> _Writer:
+    global _writer
+    with _writerlock:
+        if _writer is None:
+            _writer = _Writer()
+        return _writer
+
+
+# recorders not yet closed, finished at exit
+_open = set()
+
+
+def flushAll() -> None:
+    '''
+    Wait until all queued chunks are written
+    '''
+    if _writer is not None:
+        _writer.queue.join()
+
+
+@atexit.register
+def closeAll() -> None:
+    '''
+    Close all open recorders, and wait until their files are written
+
+    The writer thread is a daemon; without this, rows still buffered or
+    queued at exit would be lost, and the files would have no footer.
+    '''
+    for rec in list(_open):
+        rec.close()
+    flushAll()
+
+
+class TrajectoryRecorder:
+    '''
+    Append-only recorder of one craft trajectory
+    '''
+
+    def __init__(self, fname: str, columns=STATECOLUMNS, meta: dict = None,
+                 chunk: int = 1024, flushinterval: float = 10.0) -> None:
+        '''
+        Open a new trajectory file
+
+        Parameters
+        ----------
+        fname : str
+            File name; an existing file is overwritten.
+        columns : sequence of str
+            Column names. The default is time plus the 15 state values.
+        meta : dict, optional
+            Additional information, e.g. name and craft id; json.
+        chunk : int
+            Rows per chunk, this sets the memory use.
+        flushinterval : float [s]
+            Maximum time rows stay in memory, before being written as a
+            (partial) chunk.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.fname = fname
+        self.columns = tuple(columns)
+        self.flushinterval = flushinterval
+        self.buffer = np.zeros((len(self.columns), chunk), dtype='<f4')
+        self.nrows = 0
+        self.tfirst = None
+        self.index = []
+        self.closed = False
+
+        info = dict(meta or {}, columns=self.columns, created=time.time())
+        info = json.dumps(info).encode('utf-8')
+        self.file = open(fname, 'wb')
+        self.file.write(_magic + struct.pack('<I', len(info)) + info)
+        self.file.flush()
+        self.writer = _getWriter()
+        _open.add(self)
+
+    def append(self, *values) -> None:
+        '''
+        Record one row, one value per column
+        '''
+        if self.nrows == 0:
+            self.tfirst = time.monotonic()
+        self.buffer[:, self.nrows] = values
+        self.nrows += 1
+        if self.nrows == self.buffer.shape[1] or \
+           time.monotonic() - self.tfirst > self.flushinterval:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Hand the buffered rows to the writer thread
+        '''
+        if self.nrows:
+            self.writer.queue.put(
+                ('chunk', self, self.buffer[:, :self.nrows].copy()))
+            self.nrows = 0
+
+    def close(self) -> None:
+        '''
+        Write the remaining rows and the index footer, and close the file
+        '''
+        if not self.closed:
+            self.flush()
+            self.writer.queue.put(('footer', self, None))
+            self.closed = True
+            _open.discard(self)
+
+    def _writeChunk(self, data):
+        self.index.append((self.file.tell(), data.shape[1]))
+        self.file.write(_chunkhead.pack(_chunkmagic, data.shape[1]))
+        self.file.write(data.tobytes())
+        self.file.flush()
+
+    def _writeFooter(self):
+        offset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=_index).tobytes())
+        self.file.write(_tail.pack(len(self.index), offset, _endmagic))
+        self.file.close()
+
+
+class TrajectoryLog:
+    '''
+    Reader for a trajectory file, memory-mapped
+    '''
+
+    def __init__(self, fname: str) -> None:
+        '''
+        Open a trajectory file
+
+        Parameters
+        ----------
+        fname : str
+            File name, written by a TrajectoryRecorder.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.fname = fname
+        size = os.path.getsize(fname)
+        with open(fname, 'rb') as f:
+            if f.read(len(_magic)) != _magic:
+                raise ValueError(f"{fname} is not a trajectory file")
+            nmeta, = struct.unpack('<I', f.read(4))
+            self.meta = json.loads(f.read(nmeta).decode('utf-8'))
+            start = f.tell()
+            self.columns = tuple(self.meta['columns'])
+
+            # index from the footer, or by walking the chunks
+            self.complete = False
+            index = []
+            if size >= start + _tail.size:
+                f.seek(size - _tail.size)
+                nchunks, offset, end = _tail.unpack(f.read(_tail.size))
+                if end == _endmagic:
+                    f.seek(offset)
+                    index = np.frombuffer(
+                        f.read(nchunks*_index.itemsize), dtype=_index)
+                    index = [ (int(o), int(n)) for o, n in index ]
+                    self.complete = True
+            if not self.complete:
+                offset = start
+                while offset + _chunkhead.size <= size:
+                    f.seek(offset)
+                    magic, n = _chunkhead.unpack(f.read(_chunkhead.size))
+                    nbytes = n*len(self.columns)*4
+                    if magic != _chunkmagic or \
+                       offset + _chunkhead.size + nbytes > size:
+                        break
+                    index.append((offset, n))
+                    offset += _chunkhead.size + nbytes
+
+        self.chunks = [
+            np.memmap(fname, dtype='<f4', mode='r',
+                      offset=o + _chunkhead.size, shape=(len(self.columns), n))
+            for o, n in index if n ]
+
+    def __len__(self):
+        return sum(c.shape[1] for c in self.chunks)
+
+    def __getitem__(self, column: str):
+        '''
+        All values of one column; a view on the file for a single chunk
+        '''
+        i = self.columns.index(column)
+        if len(self.chunks) == 1:
+            return self.chunks[0][i]
+        if not self.chunks:
+            return np.zeros((0,), dtype='<f4')
+        return np.concatenate([c[i] for c in self.chunks])
+
+    def asDict(self) -> dict:
+        '''
+        All columns, as a dict of arrays
+        '''
+        return { c: self[c] for c in self.columns }
+
+
+def readJsonLog(fname: str) -> dict:
+    '''
+    Read an old-style json log (n, x, y, t), with arrays for x, y and t
+    '''
+    with open(fname) as f:
+        d = json.load(f)
+    return dict(n=d['n'], x=np.array(d['x'], dtype=np.float32),
+                y=np.array(d['y'], dtype=np.float32),
+                t=np.array(d['t'], dtype=np.float32))
+
+
+if __name__ == '__main__':
+
+    import tempfile
+
+    fname = os.path.join(tempfile.mkdtemp(), 'test.trj')
+    rec = TrajectoryRecorder(fname, meta=dict(name='test', id=0), chunk=100)
+    state = np.arange(15, dtype=np.float32)
+    t0 = time.perf_counter()
+    for i in range(10050):
+        rec.append(i*0.05, *state)
+    t1 = time.perf_counter()
+    rec.close()
+    flushAll()
+    log = TrajectoryLog(fname)
+    print(f"append {(t1-t0)/10050*1e6:.1f} us/row, {len(log)} rows in "
+          f"{len(log.chunks)} chunks, complete {log.complete}, "
+          f"{os.path.getsize(fname)} bytes")
+    assert np.allclose(log['t'], np.arange(10050)*0.05)
+    assert np.all(log['ds'] == 14)
+
+    # without footer, as after a crash
+    with open(fname, 'r+b') as f:
+        f.truncate(os.path.getsize(fname) - 100)
+    log = TrajectoryLog(fname)
+    print(f"truncated: {len(log)} rows, complete {log.complete}")
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import numpy as np
+import struct
+import zlib
+from wireformat import encode
+
+'''
+Spatially varying wind over the course
+
+The wind is kept on a coarse regular grid (x north, y east), as the sum
+of:
+
+- the mean wind, uniform, set from the WindModel on the server
+- gust cells (positive) and lulls (negative), round Gaussian bumps in
+  the mean wind direction, that drift with the wind over the course and
+  fade after their lifetime
+- times a shore shadow factor, computed from the terrain heights upwind
+  of each grid point; the wind recovers in about 15 terrain heights
+
+The grid is recomputed when the field is advanced (a few times per
+minute on the server); sampling is bilinear interpolation in the
+precomputed grid, vectorized for many positions (speeds), or plain
+Python for one position (speed).
+
+Clients get the grid in binary messages:
+
+- full grid, on connection
+  "F", 0, <seq>, header (x0, y0, cell as float32, nx, ny as uint16)
+  followed by the zlib-compressed grid, int16 in cm/s, (nx, ny, 2)
+- grid update, at each server advance
+  "G", 0, <seq>, zlib-compressed int8 changes in dm/s, (nx, ny, 2)
+
+The changes are taken against the grid as the clients have it, so the
+quantization errors do not accumulate.
+'''
+
+_fullhead = struct.Struct('<fffHH')
+_fullscale = 100.0          # cm/s
+_deltascale = 10.0          # dm/s
+
+
+class WindField:
+    '''
+    Gridded wind with gusts and terrain shadow
+    '''
+
+    def __init__(self, extent=(-3000.0, 3000.0, -3000.0, 3000.0),
+                 cell: float = 100.0, mean=(0.0, 0.0), ngusts: int = 0,
+                 gustspeed: float = 2.0, gustradius: float = 150.0,
+                 gustlife: float = 120.0, seed: int = None) -> None:
+        '''
+        Create a wind field
+
+        Parameters
+        ----------
+        extent : 4 floats [m]
+            xmin, xmax, ymin, ymax of the grid; outside the grid, the
+            wind at the edge is used.
+        cell : float [m]
+            Grid spacing.
+        mean : 2 floats [m/s]
+            Initial mean wind (direction the wind blows to).
+        ngusts : int
+            Number of gusts and lulls on the course.
+        gustspeed : float [m/s]
+            Standard deviation of the gust strength.
+        gustradius : float [m]
+            Typical gust radius.
+        gustlife : float [s]
+            Typical gust lifetime.
+        seed : int, optional
+            Seed for the gust generator.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.x0, self.y0 = float(extent[0]), float(extent[2])
+        self.cell = float(cell)
+        self.nx = int(np.ceil((extent[1] - extent[0])/cell)) + 1
+        self.ny = int(np.ceil((extent[3] - extent[2])/cell)) + 1
+        self.xs = self.x0 + np.arange(self.nx)*self.cell
+        self.ys = self.y0 + np.arange(self.ny)*self.cell
+        self.mean = np.array(mean, dtype=float)
+        self.shadow = np.ones((self.nx, self.ny))
+        self.heights = None
+        self._shadowdir = None
+
+        # gusts: position, radius, strength, age, lifetime
+        self.rng = np.random.default_rng(seed)
+        self.ngusts = ngusts
+        self.gustspeed = gustspeed
+        self.gustradius = gustradius
+        self.gustlife = gustlife
+        self.gpos = np.zeros((0, 2))
+        self.gradius = np.zeros((0,))
+        self.gstrength = np.zeros((0,))
+        self.gage = np.zeros((0,))
+        self.glife = np.zeros((0,))
+        self._spawn(ngusts, anywhere=True)
+
+        # the grid as clients have it, for the update messages
+        self.sent = None
+        self._compute()
+
+    def _spawn(self, n: int, anywhere: bool = False) -> None:
+        '''
+        Add new gusts, anywhere or along the upwind edge
+        '''
+        if n <= 0:
+            return
+        pos = np.stack((self.rng.uniform(self.xs[0], self.xs[-1], n),
+                        self.rng.uniform(self.ys[0], self.ys[-1], n)),
+                       axis=1)
+        if not anywhere:
+            # move to the upwind edge of the grid
+            V = np.hypot(*self.mean)
+            if V > 0.1:
+                d = self.mean / V
+                centre = np.array((0.5*(self.xs[0] + self.xs[-1]),
+                                   0.5*(self.ys[0] + self.ys[-1])))
+                half = 0.5*max(self.xs[-1] - self.xs[0],
+                               self.ys[-1] - self.ys[0])
+                pos += d*(-half - (pos - centre) @ d)[:,None]
+        self.gpos = np.vstack((self.gpos, pos))
+        self.gradius = np.concatenate((self.gradius, self.gustradius*
+                                       self.rng.uniform(0.5, 1.5, n)))
+        self.gstrength = np.concatenate((self.gstrength, self.rng.normal(
+            0.0, self.gustspeed, n)))
+        life = self.gustlife*self.rng.uniform(0.5, 1.5, n)
+        self.gage = np.concatenate((self.gage, self.rng.uniform(0.0, life)
+                                    if anywhere else np.zeros((n,))))
+        self.glife = np.concatenate((self.glife, life))
+
+    def setMean(self, mean) -> None:
+        '''
+        Set the mean wind [m/s]; takes effect at the next advance
+        '''
+        self.mean = np.array(mean[:2], dtype=float)
+
+    def setTerrain(self, verts, above: float = 0.5, ratio: float = 15.0,
+                   minfactor: float = 0.3) -> None:
+        '''
+        Derive the shore shadow from terrain vertices
+
+        Parameters
+        ----------
+        verts : array (n, 3)
+            Terrain vertices, ODE coordinates (z down).
+        above : float [m]
+            Terrain lower than this above the ice gives no shadow.
+        ratio : float
+            Distance (in terrain heights) in which the wind recovers.
+        minfactor : float
+            Wind factor right behind the terrain.
+
+        Returns
+        -------
+        None.
+
+        '''
+        # highest terrain per grid cell
+        ix = np.clip(np.round((verts[:,0] - self.x0)/self.cell).astype(int),
+                     0, self.nx - 1)
+        iy = np.clip(np.round((verts[:,1] - self.y0)/self.cell).astype(int),
+                     0, self.ny - 1)
+        self.heights = np.zeros((self.nx, self.ny))
+        np.maximum.at(self.heights, (ix, iy), -verts[:,2] - above)
+        self._shadowpar = (ratio, minfactor)
+        self._shadowdir = None
+        self._compute()
+
+    def _updateShadow(self) -> None:
+        '''
+        Shadow factor for the current mean wind direction
+        '''
+        V = np.hypot(*self.mean)
+        if self.heights is None or V < 0.1:
+            return
+        d = self.mean / V
+        if self._shadowdir is not None and d @ self._shadowdir > 0.985:
+            # less than ~10 deg change
+            return
+        self._shadowdir = d
+        ratio, minfactor = self._shadowpar
+
+        # look upwind, in steps of half a cell, for the most limiting
+        # terrain
+        X, Y = np.meshgrid(self.xs, self.ys, indexing='ij')
+        reach = ratio*np.max(self.heights)
+        factor = np.ones((self.nx, self.ny))
+        for r in np.arange(0.5*self.cell, reach + self.cell, 0.5*self.cell):
+            h = self._bilinear(self.heights[...,None], X - r*d[0],
+                               Y - r*d[1])[...,0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                f = np.where(h > 0.0, r/(ratio*h), 1.0)
+            factor = np.minimum(factor, np.clip(f, minfactor, 1.0))
+        self.shadow = factor
+
+    def _compute(self) -> None:
+        '''
+        Recompute the grid from mean, gusts and shadow
+        '''
+        self._updateShadow()
+        V = np.hypot(*self.mean)
+        d = self.mean/V if V > 0.1 else np.zeros(2)
+        speed = np.full((self.nx, self.ny), V)
+        for (gx, gy), R, s, age, life in zip(
+                self.gpos, self.gradius, self.gstrength, self.gage,
+                self.glife):
+            # grow and fade over the lifetime
+            fade = np.sin(np.pi*min(age/life, 1.0))
+            speed += s*fade*np.exp(
+                -(np.subtract.outer(self.xs, gx)**2 +
+                  np.subtract.outer(self.ys, gy)[None,:]**2)/(R*R))
+        self.grid = (np.maximum(speed, 0.0)*self.shadow)[...,None]*d
+        self._gridlist = self.grid.tolist()
+
+    def advance(self, dt: float) -> None:
+        '''
+        Move the gusts with the wind, and recompute the grid
+
+        Parameters
+        ----------
+        dt : float [s]
+            Time step.
+
+        Returns
+        -------
+        None.
+
+        '''
+        if len(self.gpos):
+            self.gpos += self.sample(self.gpos)*dt
+            self.gage += dt
+            keep = (self.gage < self.glife) & \
+                (self.gpos[:,0] > self.xs[0] - 3*self.gradius) & \
+                (self.gpos[:,0] < self.xs[-1] + 3*self.gradius) & \
+                (self.gpos[:,1] > self.ys[0] - 3*self.gradius) & \
+                (self.gpos[:,1] < self.ys[-1] + 3*self.gradius)
+            for a in ('gpos', 'gradius', 'gstrength', 'gage', 'glife'):
+                setattr(self, a, getattr(self, a)[keep])
+        self._spawn(self.ngusts - len(self.gpos))
+        self._compute()
+
+    def _bilinear(self, grid, x, y):
+        '''
+        Bilinear interpolation of a (nx, ny, k) grid at arrays x, y
+        '''
+        fx = np.clip((x - self.x0)/self.cell, 0.0, self.nx - 1.000001)
+        fy = np.clip((y - self.y0)/self.cell, 0.0, self.ny - 1.000001)
+        i = fx.astype(int)
+        j = fy.astype(int)
+        fx = (fx - i)[...,None]
+        fy = (fy - j)[...,None]
+        return (grid[i, j]*(1 - fx) + grid[i+1, j]*fx)*(1 - fy) + \
+            (grid[i, j+1]*(1 - fx) + grid[i+1, j+1]*fx)*fy
+
+    def sample(self, locs):
+        '''
+        Wind at a number of locations
+
+        Parameters
+        ----------
+        locs : array (n, 2) or (n, 3)
+            Locations, x and y are used.
+
+        Returns
+        -------
+        array (n, 2)
+            Horizontal wind [m/s].
+        '''
+        locs = np.asarray(locs, dtype=float)
+        return self._bilinear(self.grid, locs[:,0], locs[:,1])
+
+    def speeds(self, locs):
+        '''
+        Wind at a number of locations, as (n, 3) vectors
+        '''
+        res = np.zeros((len(locs), 3))
+        res[:,:2] = self.sample(locs)
+        return res
+
+    def speed(self, loc):
+        '''
+        Wind at one location, as 3-vector; plain Python, for single calls
+        '''
+        fx = (loc[0] - self.x0)/self.cell
+        fy = (loc[1] - self.y0)/self.cell
+        fx = min(max(fx, 0.0), self.nx - 1.000001)
+        fy = min(max(fy, 0.0), self.ny - 1.000001)
+        i, j = int(fx), int(fy)
+        fx -= i
+        fy -= j
+        g = self._gridlist
+        g00, g10, g01, g11 = g[i][j], g[i+1][j], g[i][j+1], g[i+1][j+1]
+        w00 = (1.0 - fx)*(1.0 - fy)
+        w10 = fx*(1.0 - fy)
+        w01 = (1.0 - fx)*fy
+        w11 = fx*fy
+        return np.array((
+            w00*g00[0] + w10*g10[0] + w01*g01[0] + w11*g11[0],
+            w00*g00[1] + w10*g10[1] + w01*g01[1] + w11*g11[1], 0.0))
+
+    def fullMessage(self, seq: int = 0) -> bytes:
+        '''
+        Message with the complete grid, as the clients have it
+        '''
+        if self.sent is None:
+            self.sent = np.round(self.grid*_deltascale)/_deltascale
+        q = np.round(self.sent*_fullscale).astype('<i2')
+        return encode(b'F', 0, seq, _fullhead.pack(
+            self.x0, self.y0, self.cell, self.nx, self.ny) +
+            zlib.compress(q.tobytes()))
+
+    def deltaMessage(self, seq: int = 0) -> bytes:
+        '''
+        Message with the changes since the previous message
+        '''
+        if self.sent is None:
+            self.sent = np.zeros_like(self.grid)
+        dq = np.clip(np.round((self.grid - self.sent)*_deltascale),
+                     -127, 127).astype(np.int8)
+        self.sent = self.sent + dq/_deltascale
+        return encode(b'G', 0, seq, zlib.compress(dq.tobytes()))
+
+    @classmethod
+    def fromMessage(cls, data: bytes):
+        '''
+        Create a client-side field from the payload of an F message
+        '''
+        x0, y0, cell, nx, ny = _fullhead.unpack_from(data)
+        field = cls((x0, x0 + (nx - 1)*cell, y0, y0 + (ny - 1)*cell), cell)
+        q = np.frombuffer(zlib.decompress(data[_fullhead.size:]),
+                          dtype='<i2').reshape((nx, ny, 2))
+        field.grid = q/_fullscale
+        field._gridlist = field.grid.tolist()
+        return field
+
+    def applyDelta(self, data: bytes) -> None:
+        '''
+        Apply the payload of a G message
+        '''
+        dq = np.frombuffer(zlib.decompress(data), dtype=np.int8)
+        self.grid = self.grid + dq.reshape(self.grid.shape)/_deltascale
+        self._gridlist = self.grid.tolist()
+
+
+if __name__ == '__main__':
+
+    import time
+    from wireformat import payload
+
+    field = WindField(mean=(-4.0, 0.5), ngusts=20, seed=1)
+
+    # a 30 m ridge at x = 500, y from -1000 to 1000; shadow to the south
+    yr = np.linspace(-1000, 1000, 200)
+    verts = np.stack((np.full_like(yr, 500.0), yr, np.full_like(yr, -30.0)),
+                     axis=1)
+    field.setTerrain(verts)
+    full = field.fullMessage()
+    client = WindField.fromMessage(payload(full))
+    nbytes = []
+    for i in range(30):
+        field.advance(2.0)
+        msg = field.deltaMessage(i)
+        client.applyDelta(payload(msg))
+        nbytes.append(len(msg))
+    print(f"grid {field.nx}x{field.ny}, full message {len(full)} bytes, "
+          f"updates {np.mean(nbytes):.0f} bytes, client grid error "
+          f"{np.max(np.abs(client.grid - field.grid)):.3f} m/s")
+    print("wind factor south of the ridge, at 100, 200, 400 m: " +
+          ", ".join(f"{field.shadow[np.searchsorted(field.xs, 500 - d), 30]:.2f}"
+                    for d in (100, 200, 400)))
+
+    # sampling cost, 50 craft
+    locs = np.random.default_rng(0).uniform(-2500, 2500, (50, 3))
+    t0 = time.perf_counter()
+    for i in range(1000):
+        field.speeds(locs)
+    t1 = time.perf_counter()
+    for loc in locs.tolist()*20:
+        field.speed(loc)
+    t2 = time.perf_counter()
+    assert np.allclose(field.speeds(locs)[7], field.speed(locs[7]))
+    print(f"speeds for 50 craft {(t1-t0)*1e3:.1f} us/call, "
+          f"speed {(t2-t1)*1e6/1000:.1f} us/call")
@@ -5,8 +5,9 @@ Created on Fri Feb 14 11:25:50 2020
 
 @author: repa
 """
-from numpy import zeros, array, sqrt, exp, float32
-from numpy.random import normal
+from numpy import zeros, array, sqrt, exp, float32, concatenate
+from numpy.random import normal, default_rng
+from scipy.signal import lfilter
 import base64
 
 class WindModel:
@@ -49,6 +50,109 @@ class WindModel:
             self.psi * normal(loc=self.vbase, scale=self.var)
         self.message = 'E'.encode('ascii') + base64.b64encode(self.vvar)
         return self.vvar
+
+
+class WindSchedule:
+    '''
+    Pre-generated wind history, the same process as WindModel
+
+    The complete series is generated from a seed, with one filter call,
+    and stored as float32. The wind at any simulation time is a linear
+    interpolation between the two neighbouring samples, so a fast or
+    fast-forwarded run gets exactly the wind of a live run with the same
+    seed. Looking past the end extends the series, in blocks, with the
+    same random generator.
+    '''
+
+    def __init__(self, vx: float, vy: float, var: float,
+                 tau: float = 100.0, duration: float = 3600.0,
+                 dt: float = 1.0, seed: int = None) -> None:
+        '''
+        Generate a wind schedule
+
+        Parameters
+        ----------
+        vx : float
+            Average wind, x / northing direction.
+        vy : float
+            Average wind, y / easting direction.
+        var : float
+            Standard deviation of variation process.
+        tau : float
+            Normalized time constant of variation process, in steps.
+        duration : float [s]
+            Time span generated initially, and the size of the blocks
+            added later.
+        dt : float [s]
+            Time step of the process; the server updates WindModel once
+            per second.
+        seed : int, optional
+            Seed for the random generator. The default (None) gives a
+            new wind history every time.
+
+        Returns
+        -------
+        None
+
+        '''
+        self.vbase = array((vx, vy), dtype=float32)
+        self.var = var / sqrt(0.5/tau)
+        self.psi = 1.0 - exp(-1.0/tau)
+        self.dt = dt
+        self.seed = seed
+        self.rng = default_rng(seed)
+        self.block = max(int(round(duration/dt)), 1)
+        self.series = self.vbase.reshape((1, 2)).copy()
+        self._extend()
+        self.vvar = self.series[0].copy()
+        self.message = 'E'.encode('ascii') + base64.b64encode(self.vvar)
+
+    def _extend(self) -> None:
+        '''
+        Add a block to the series, continuing from the last sample
+        '''
+        # v[k+1] = (1 - psi) v[k] + psi (vbase + var n[k]), as a first
+        # order filter over the whole block
+        x = self.rng.normal(loc=self.vbase, scale=self.var,
+                            size=(self.block, 2))
+        zi = ((1.0 - self.psi)*self.series[-1]).reshape((1, 2))
+        v, _ = lfilter([self.psi], [1.0, self.psi - 1.0], x, axis=0, zi=zi)
+        self.series = concatenate((self.series, v.astype(float32)))
+
+    def at(self, t: float):
+        '''
+        Wind at simulation time t
+
+        Parameters
+        ----------
+        t : float [s]
+            Time since the start of the schedule; negative times give
+            the initial wind.
+
+        Returns
+        -------
+        array of float, (2,)
+        '''
+        f = max(t, 0.0)/self.dt
+        i = int(f)
+        while i + 1 >= len(self.series):
+            self._extend()
+        f -= i
+        return (1.0 - f)*self.series[i] + f*self.series[i+1]
+
+    def update(self, t: float):
+        '''
+        Set the current wind to the wind at time t, as WindModel.update
+
+        Returns
+        -------
+        array of float (copied!).
+
+        '''
+        self.vvar = self.at(t).astype(float32)
+        self.message = 'E'.encode('ascii') + base64.b64encode(self.vvar)
+        return self.vvar
+
     
 if __name__ == '__main__':
     
@@ -79,4 +183,26 @@ if __name__ == '__main__':
 
     print(f'var 1 x {std(vxy1[:,0])} y {std(vxy1[:,1])}')
     print(f'var 2 x {std(vxy2[:,0])} y {std(vxy2[:,1])}')
-    
\ No newline at end of file
+    
+    # schedule: same process, generated at once, reproducible by seed
+    import time
+    t0 = time.perf_counter()
+    sched = WindSchedule(5, 1, 0.5, 100, duration=3600, seed=42)
+    t1 = time.perf_counter()
+    x = default_rng(42).normal(loc=sched.vbase, scale=sched.var,
+                               size=(3600, 2))
+    v = sched.vbase.astype(float)
+    for i in range(3600):
+        v = v - sched.psi*v + sched.psi*x[i]
+    print(f'schedule 3600 s in {(t1-t0)*1e3:.1f} ms, '
+          f'{sched.series.nbytes} bytes, step loop difference '
+          f'{abs(v - sched.series[3600]).max():.2e}')
+    sched2 = WindSchedule(5, 1, 0.5, 100, duration=3600, seed=42)
+    ts = default_rng(0).uniform(0, 7000, 1000)
+    t0 = time.perf_counter()
+    w1 = array([sched.at(t) for t in ts])
+    t1 = time.perf_counter()
+    w2 = array([sched2.at(t) for t in sorted(ts)])
+    print(f'lookup {(t1-t0)*1e3:.2f} us/call, same seed, other lookup '
+          f'order: {(w1[ts.argsort()] == w2).all()}')
+    print(f'schedule x {std(sched.series[:,0])} y {std(sched.series[:,1])}')
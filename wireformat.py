@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import struct
+import base64
+import numpy as np
+
+"""
+Binary message format, for the communication between clients and server
+
+The original (ASCII) protocol codes the float data in base64, and
+separates fields with ':', see communicator.py. In the binary format,
+each message starts with a fixed header:
+
+- marker byte, 0xB0 + protocol version; this never occurs as first
+  byte of an ASCII message
+- message type, one byte, the same letters as in the ASCII protocol
+- craft id, 16 bit unsigned
+- sequence number, 32 bit unsigned
+
+followed by the payload, for data messages raw little-endian 32 bit
+floats, which are decoded without copying.
+
+Binary messages:
+
+- birth, client to server, payload is the name (ascii)
+  "B", 0, 0, name
+
+- welcome, server to client, start position and quaternion
+  "W", <id>, 0, 7 floats
+
+- update, position, quaternion, velocity, rotation, dr, ds
+  "U", <id>, <seq>, 15 floats
+
+- snapshot, server to clients, n records with craft id and the 15
+  floats of an update
+  "X", <n>, <tick>, n x 16 floats
+
+- death
+  "D", <id>, <seq>
+
+- wind
+  "E", 0, <seq>, 2 floats
+
+A server accepts both formats; a client that announces itself with a
+binary birth message gets W, X, D and E messages in binary format;
+ASCII clients get the U messages of the other craft instead of X. The
+messages with text (B, L, O, M, S) from the server are ASCII in both
+cases.
+"""
+
+VERSION = 1
+MARKER = 0xB0 + VERSION
+_header = struct.Struct('<BBHI')
+HEADERSIZE = _header.size
+
+# float payload, little endian
+_f32 = np.dtype('<f4')
+
+
+def isBinary(data: bytes) -> bool:
+    '''
+    Test whether a message is in the binary format
+    '''
+    return len(data) >= HEADERSIZE and data[0] == MARKER
+
+
+def encode(mtype: bytes, idx: int = 0, seq: int = 0, payload=b'') -> bytes:
+    '''
+    Create a binary message
+
+    Parameters
+    ----------
+    mtype : bytes
+        Single-letter message type, e.g. b'U'.
+    idx : int
+        Craft id.
+    seq : int
+        Sequence number, wraps at 2**32.
+    payload : bytes or array of float
+        Message data; arrays are sent as little-endian float32.
+
+    Returns
+    -------
+    bytes
+        Coded message.
+    '''
+    if not isinstance(payload, bytes):
+        payload = np.asarray(payload, dtype=_f32).tobytes()
+    return _header.pack(MARKER, mtype[0], idx, seq & 0xffffffff) + payload
+
+
+def decodeHeader(data: bytes):
+    '''
+    Decode the header of a binary message
+
+    Returns
+    -------
+    tuple of (bytes, int, int)
+        Message type, craft id, sequence number.
+    '''
+    marker, mtype, idx, seq = _header.unpack_from(data)
+    if marker != MARKER:
+        raise ConnectionError(f"incorrect binary message version {marker}")
+    return bytes((mtype,)), idx, seq
+
+
+def decode(data: bytes):
+    '''
+    Decode a binary message with float data
+
+    Returns
+    -------
+    tuple of (bytes, int, int, array of float32)
+        Message type, craft id, sequence number, and payload. The
+        payload is a read-only view on the message.
+    '''
+    mtype, idx, seq = decodeHeader(data)
+    return mtype, idx, seq, np.frombuffer(data, dtype=_f32,
+                                          offset=HEADERSIZE)
+
+
+def payload(data: bytes) -> bytes:
+    '''
+    Raw payload of a binary message, e.g. the name in a birth message
+    '''
+    return data[HEADERSIZE:]
+
+
+def asciiMessage(mtype: bytes, idx: int = 0, payload=None) -> bytes:
+    '''
+    Create a W, U, D or E message in the original ASCII/base64 format
+    '''
+    if mtype == b'E':
+        return b'E' + base64.b64encode(np.asarray(payload, dtype=_f32))
+    head = mtype + str(idx).encode('ascii')
+    if payload is None:
+        return head
+    return head + b':' + base64.b64encode(np.asarray(payload, dtype=_f32))
+
+
+def message(binary: bool, mtype: bytes, idx: int = 0, seq: int = 0,
+            payload=None) -> bytes:
+    '''
+    Create a W, U, X, D or E message, binary or in ASCII format
+
+    Parameters
+    ----------
+    binary : bool
+        Select the binary format.
+    mtype : bytes
+        Single-letter message type.
+    idx : int
+        Craft id.
+    seq : int
+        Sequence number, only used in the binary format.
+    payload : array of float, optional
+        Message data.
+
+    Returns
+    -------
+    bytes
+        Coded message.
+    '''
+    if binary:
+        return encode(mtype, idx, seq, b'' if payload is None else payload)
+    return asciiMessage(mtype, idx, payload)